@@ -108,11 +108,36 @@ class DriverPassthruController(rest.RestController):
                 pecan.request.context, driver_name, method, data, topic=topic)
 
 
+class DriverImageCacheController(rest.RestController):
+    """REST controller for the image caches of a driver.
+
+    Lets operators have every conductor supporting a driver fetch images
+    into its image caches, ahead of the deployments using them.
+    """
+
+    @wsme_pecan.wsexpose(None, wtypes.text, body=[wtypes.text],
+                         status_code=202)
+    def post(self, driver_name, image_hrefs):
+        """Fetch images into the image caches of a driver.
+
+        :param driver_name: name of the driver.
+        :param image_hrefs: list of the hrefs of the images to fetch.
+        """
+        if not image_hrefs:
+            raise wsme.exc.ClientSideError(_("No images specified"))
+
+        for topic in pecan.request.rpcapi.get_topics_for_driver(driver_name):
+            pecan.request.rpcapi.warm_image_cache(
+                pecan.request.context, driver_name, image_hrefs, topic=topic)
+
+
 class DriversController(rest.RestController):
     """REST controller for Drivers."""
 
     vendor_passthru = DriverPassthruController()
 
+    image_cache = DriverImageCacheController()
+
     @wsme_pecan.wsexpose(DriverList)
     def get_all(self):
         """Retrieve a list of drivers.
@@ -0,0 +1,189 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Timing of the steps of deployments.
+
+A deployment goes through several phases, such as preparing the PXE
+environment, starting the deployment and, for the PXE driver, writing the
+image once the deploy ramdisk has called back. Each phase is traced with
+trace(), which records the start, duration, outcome and, where it applies,
+the number of bytes handled of every step run within it with step().
+
+When a phase is over, its trace is logged, sent as a 'baremetal.deploy.trace'
+notification if enabled, and kept in the node's driver_info under
+'ironic_deploy_trace', keyed by phase, as the summary of the node's last
+deploy. The instance_info of the node is left alone: it is owned by Nova,
+which replaces it on every deploy, and cleared on tear down.
+"""
+
+import contextlib
+import threading
+import time
+
+from oslo.config import cfg
+
+from ironic.common import rpc
+from ironic.openstack.common import jsonutils
+from ironic.openstack.common import log as logging
+from ironic.openstack.common import timeutils
+
+deploy_trace_opts = [
+    cfg.BoolOpt('send_deploy_trace_notifications',
+                default=False,
+                help='Send the timing of the steps of each deploy phase of '
+                     'the nodes as a baremetal.deploy.trace notification.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(deploy_trace_opts, group='conductor')
+
+LOG = logging.getLogger(__name__)
+
+EVENT_TYPE = 'baremetal.deploy.trace'
+
+# Key of the deploy traces in the driver_info of the nodes
+DRIVER_INFO_KEY = 'ironic_deploy_trace'
+
+_LOCAL = threading.local()
+
+
+class DeployTrace(object):
+    """Timing of the steps of a deploy phase of a node."""
+
+    def __init__(self, node_uuid, phase):
+        self.node_uuid = node_uuid
+        self.phase = phase
+        self.started_at = timeutils.isotime()
+        self.duration = None
+        self.outcome = None
+        self.steps = []
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """Time a step of the phase.
+
+        :param name: name of the step.
+        :returns: a context manager yielding the dictionary recording the
+                  step, in which the step may set the number of 'bytes' it
+                  handled.
+        """
+        start = time.time()
+        record = {'name': name, 'start': round(start - self._start, 3)}
+        try:
+            yield record
+        except Exception as e:
+            record['outcome'] = 'failure'
+            record['error'] = e.__class__.__name__
+            raise
+        else:
+            record['outcome'] = 'success'
+        finally:
+            record['duration'] = round(time.time() - start, 3)
+            with self._lock:
+                self.steps.append(record)
+
+    def finish(self, outcome):
+        """Mark the phase as over.
+
+        :param outcome: 'success' or 'failure'.
+        """
+        self.duration = round(time.time() - self._start, 3)
+        self.outcome = outcome
+
+    def summary(self):
+        """Return the trace as a dictionary."""
+        with self._lock:
+            steps = sorted(self.steps, key=lambda s: s['start'])
+        return {'node_uuid': self.node_uuid,
+                'phase': self.phase,
+                'started_at': self.started_at,
+                'duration': self.duration,
+                'outcome': self.outcome,
+                'steps': steps}
+
+
+def current():
+    """Return the trace of the current thread, None if there is none."""
+    return getattr(_LOCAL, 'trace', None)
+
+
+@contextlib.contextmanager
+def step(name, trace=None):
+    """Time a step of the deploy phase traced by the current thread.
+
+    Does nothing but yield a dictionary if no phase is being traced.
+
+    :param name: name of the step.
+    :param trace: the DeployTrace to record the step in, defaults to the
+                  trace of the current thread.
+    :returns: a context manager yielding the dictionary recording the step,
+              in which the step may set the number of 'bytes' it handled.
+    """
+    trace = trace or current()
+    if trace is None:
+        yield {}
+        return
+    with trace.step(name) as record:
+        yield record
+
+
+def _emit(node, trace, new_deploy):
+    summary = trace.summary()
+    LOG.info(_("Deploy trace of node %(node)s: %(trace)s"),
+             {'node': node.uuid, 'trace': jsonutils.dumps(summary)})
+    if CONF.conductor.send_deploy_trace_notifications:
+        try:
+            rpc.get_notifier('conductor').info({}, EVENT_TYPE, summary)
+        except Exception as e:
+            LOG.warning(_("Failed to send the deploy trace of node "
+                          "%(node)s: %(err)s"), {'node': node.uuid, 'err': e})
+
+    d_info = node.driver_info
+    traces = {} if new_deploy else dict(d_info.get(DRIVER_INFO_KEY) or {})
+    traces[trace.phase] = summary
+    d_info[DRIVER_INFO_KEY] = traces
+    node.driver_info = d_info
+
+
+@contextlib.contextmanager
+def trace(node, phase, new_deploy=False):
+    """Trace a deploy phase of a node.
+
+    The steps run within the phase in the current thread are recorded in
+    the trace. Once the phase is over, the trace is logged, sent as a
+    notification if CONF.conductor.send_deploy_trace_notifications is set,
+    and stored in the node's driver_info. Saving the node is up to the
+    caller.
+
+    :param node: the node being deployed.
+    :param phase: name of the phase.
+    :param new_deploy: whether the phase starts a new deploy, forgetting
+                       the traces of the previous one.
+    :returns: a context manager yielding the DeployTrace.
+    """
+    deploy_trace = DeployTrace(node.uuid, phase)
+    previous = current()
+    _LOCAL.trace = deploy_trace
+    try:
+        yield deploy_trace
+    except Exception:
+        deploy_trace.finish('failure')
+        raise
+    else:
+        deploy_trace.finish('success')
+    finally:
+        _LOCAL.trace = previous
+        _emit(node, deploy_trace, new_deploy)
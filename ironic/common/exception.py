@@ -175,6 +175,11 @@ class ImageConvertFailed(IronicException):
     message = _("Image %(image_id)s is unacceptable: %(reason)s")
 
 
+class ImageDownloadFailed(IronicException):
+    message = _("Failed to download image %(image_href)s, reason: "
+                "%(reason)s")
+
+
 # Cannot be templated as the error syntax varies.
 # msg needs to be constructed when raised.
 class InvalidParameterValue(Invalid):
@@ -15,18 +15,25 @@
 #    under the License.
 
 
+import collections
 import functools
+import hashlib
 import logging
 import os
 import sys
+import threading
 import time
 
 import sendfile
 
+from eventlet import tpool
 from glanceclient import client
+import requests
+import six
 import six.moves.urllib.parse as urlparse
 
 from ironic.common import exception
+from ironic.common.glance_service import metadata_cache
 from ironic.common.glance_service import service_utils
 
 from oslo.config import cfg
@@ -35,6 +42,35 @@ from oslo.config import cfg
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+glance_opts = [
+    cfg.IntOpt('glance_download_resumes',
+               default=3,
+               help='Number of times an image download interrupted by a '
+                    'connection error is resumed where it stopped, using '
+                    'an HTTP range request.'),
+    cfg.IntOpt('glance_download_concurrency',
+               default=1,
+               help='Number of parts of an image downloaded in parallel, '
+                    'using HTTP range requests, when the image is larger '
+                    'than one part. 1 disables parallel downloads. Images '
+                    'are downloaded as a whole if the server does not '
+                    'support range requests.'),
+    cfg.IntOpt('glance_download_part_size',
+               default=256,
+               help='Size (in MiB) of the parts of an image downloaded in '
+                    'parallel.'),
+    cfg.IntOpt('glance_client_pool_size',
+               default=32,
+               help='Number of Glance clients, one per Glance server and '
+                    'authentication token, kept by the conductor to be '
+                    'reused by later requests. 0 disables the pool.'),
+]
+
+CONF.register_opts(glance_opts, group='glance')
+
+# Size of the chunks read from HTTP responses
+CHUNK_SIZE = 64 * 1024
+
 
 def _translate_image_exception(image_id, exc_value):
     if isinstance(exc_value, (exception.Forbidden,
@@ -58,6 +94,163 @@ def _translate_plain_exception(exc_value):
     return exc_value
 
 
+class _DownloadProgress(object):
+    """Writes downloaded image data, keeping track of how much was written.
+
+    Also computes the MD5 checksum of the data, as Glance does.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.checksum = hashlib.md5()
+
+    def write(self, chunk):
+        self.data.write(chunk)
+        self.offset += len(chunk)
+        self.checksum.update(chunk)
+
+    def restart(self):
+        """Discard the data written so far."""
+        self.data.seek(0)
+        self.data.truncate()
+        self.offset = 0
+        self.checksum = hashlib.md5()
+
+
+class _RangeNotSupported(Exception):
+    pass
+
+
+def _file_md5(path):
+    """Compute the MD5 checksum of a file, as Glance does."""
+    checksum = hashlib.md5()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _pwrite(fd, data, offset, lock):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, data, offset)
+        return
+    # NOTE: os.pwrite is not available before Python 3.3, the file offset
+    # is shared by all writers
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+class _PartWriter(object):
+    """Writes downloaded image data to a part of a file."""
+
+    def __init__(self, fd, offset, lock):
+        self.fd = fd
+        self.offset = offset
+        self.lock = lock
+
+    def write(self, chunk):
+        _pwrite(self.fd, chunk, self.offset, self.lock)
+        self.offset += len(chunk)
+
+    def restart(self):
+        raise _RangeNotSupported()
+
+
+def _http_get(url, headers, progress, end=None):
+    """Download the data at url from progress.offset on.
+
+    :param url: an HTTP or HTTPS URL.
+    :param headers: a dictionary of HTTP headers to send.
+    :param progress: a _DownloadProgress or _PartWriter to write the data
+                     to.
+    :param end: if not None, offset at which to stop downloading.
+    :raises: IOError if the connection fails or is closed before the end
+             of the data.
+    :raises: ImageNotFound, ImageNotAuthorized, ImageDownloadFailed
+    :raises: _RangeNotSupported if the server ignores a range request for
+             part of the data.
+    """
+    headers = dict(headers)
+    if end is not None:
+        headers['Range'] = 'bytes=%d-%d' % (progress.offset, end - 1)
+    elif progress.offset:
+        headers['Range'] = 'bytes=%d-' % progress.offset
+    resp = requests.get(url, headers=headers, stream=True,
+                        verify=not CONF.glance.glance_api_insecure)
+    try:
+        if resp.status_code == 206:
+            # NOTE: Content-Range: bytes <first>-<last>/<total>
+            content_range = resp.headers.get('content-range', '')
+            first, last = content_range.split()[-1].split('/')[0].split('-')
+            if int(first) != progress.offset:
+                raise exception.ImageDownloadFailed(
+                    image_href=url,
+                    reason=_("unexpected Content-Range %s") % content_range)
+            stop = int(last) + 1
+        elif resp.status_code == 200:
+            if progress.offset or end is not None:
+                LOG.debug("Range requests not supported for %s, restarting "
+                          "the download", url)
+                progress.restart()
+            length = resp.headers.get('content-length')
+            stop = int(length) if length is not None else None
+        elif resp.status_code == 416 and progress.offset:
+            # NOTE: the data was complete
+            return
+        elif resp.status_code == 404:
+            raise exception.ImageNotFound(image_id=url)
+        elif resp.status_code in (401, 403):
+            raise exception.ImageNotAuthorized(image_id=url)
+        else:
+            raise exception.ImageDownloadFailed(
+                image_href=url,
+                reason=_("HTTP status %d") % resp.status_code)
+
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            progress.write(chunk)
+    finally:
+        resp.close()
+
+    if stop is not None and progress.offset < stop:
+        raise IOError(_("Connection closed after %(offset)d of %(end)d "
+                        "bytes") % {'offset': progress.offset, 'end': stop})
+
+
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS = collections.OrderedDict()
+
+
+def _get_client(version, endpoint, **params):
+    """Return a Glance client, reusing a pooled one if possible.
+
+    Clients are pooled by API version, endpoint, and connection parameters
+    (including the authentication token); the least recently used client is
+    dropped when the pool is full.
+    """
+    pool_size = CONF.glance.glance_client_pool_size
+    if pool_size <= 0:
+        return client.Client(version, endpoint, **params)
+
+    key = (version, endpoint, tuple(sorted(params.items())))
+    with _CLIENTS_LOCK:
+        glance_client = _CLIENTS.pop(key, None)
+        if glance_client is None:
+            glance_client = client.Client(version, endpoint, **params)
+        _CLIENTS[key] = glance_client
+        while len(_CLIENTS) > pool_size:
+            _CLIENTS.popitem(last=False)
+    return glance_client
+
+
+def clear_clients():
+    """Drop all the pooled Glance clients."""
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
 def check_image_service(func):
     """Creates a glance client if doesn't exists and calls the function."""
     @functools.wraps(func)
@@ -82,8 +275,7 @@ def check_image_service(func):
         if CONF.glance.auth_strategy == 'keystone':
             params['token'] = self.context.auth_token
         endpoint = '%s://%s:%s' % (scheme, self.glance_host, self.glance_port)
-        self.client = client.Client(self.version,
-                                    endpoint, **params)
+        self.client = _get_client(self.version, endpoint, **params)
         return func(self, *args, **kwargs)
     return wrapper
 
@@ -154,6 +346,38 @@ class BaseImageService(object):
                         args[0], exc_value)
                 raise new_exc, None, exc_trace
 
+    def _get_image(self, image_id, method='get'):
+        """Return the Glance record of an image.
+
+        The record is read from the conductor's image metadata cache if
+        Glance was asked for it recently.
+
+        :param image_id: The opaque image identifier.
+        :returns: The image record returned by the Glance client.
+
+        :raises: ImageNotFound
+        """
+        cache = metadata_cache.get_cache()
+        # NOTE: records are only shared by the requests made with the same
+        #       token, so that Glance checks the access to every image
+        #       for every user.
+        scope = (getattr(self, 'glance_host', None),
+                 getattr(self, 'glance_port', None),
+                 getattr(self.context, 'auth_token', None))
+        image = cache.get(image_id, scope)
+        if image is metadata_cache.NOT_FOUND:
+            raise exception.ImageNotFound(image_id=image_id)
+        if image is not None:
+            return image
+
+        try:
+            image = self.call(method, image_id)
+        except exception.ImageNotFound:
+            cache.set(image_id, metadata_cache.NOT_FOUND, scope)
+            raise
+        cache.set(image_id, image, scope)
+        return image
+
     @check_image_service
     def _detail(self, method='list', **kwargs):
         """Calls out to Glance for a list of detailed image information.
@@ -186,7 +410,7 @@ class BaseImageService(object):
         (image_id, self.glance_host,
          self.glance_port, use_ssl) = service_utils.parse_image_ref(image_href)
 
-        image = self.call(method, image_id)
+        image = self._get_image(image_id, method)
 
         if not service_utils.is_image_available(self.context, image):
             raise exception.ImageNotFound(image_id=image_id)
@@ -204,24 +428,229 @@ class BaseImageService(object):
         (image_id, self.glance_host,
          self.glance_port, use_ssl) = service_utils.parse_image_ref(image_id)
 
-        if self.version == 2 \
-                and 'file' in CONF.glance.allowed_direct_url_schemes:
+        if self.version == 2 and CONF.glance.allowed_direct_url_schemes:
 
             location = self._get_location(image_id)
-            url = urlparse.urlparse(location)
-            if url.scheme == "file":
+            url = urlparse.urlparse(location or '')
+            allowed = url.scheme in CONF.glance.allowed_direct_url_schemes
+            if allowed and url.scheme == "file":
                 with open(url.path, "r") as f:
                     filesize = os.path.getsize(f.name)
                     sendfile.sendfile(data.fileno(), f.fileno(), 0, filesize)
                 return
+            if (allowed and url.scheme in ('http', 'https')
+                    and data is not None):
+                if self._parallel_download(image_id, data, url=location,
+                                           headers={}):
+                    return
+                progress = _DownloadProgress(data)
+                self._resume_download(image_id, progress, url=location,
+                                      headers={}, verify=True)
+                return
+
+        if data is not None and self._parallel_download(image_id, data):
+            return
 
         image_chunks = self.call(method, image_id)
 
         if data is None:
             return image_chunks
         else:
-            for chunk in image_chunks:
-                data.write(chunk)
+            progress = _DownloadProgress(data)
+            self._resume_download(image_id, progress, chunks=image_chunks)
+
+    def _image_data_url(self, image_id):
+        """Returns the URL of the data of an image in the Glance API."""
+        endpoint = getattr(self.client, 'endpoint', None)
+        if not endpoint:
+            endpoint = self.client.http_client.endpoint
+        if self.version == 1:
+            return '%s/v1/images/%s' % (endpoint.rstrip('/'), image_id)
+        return '%s/v2/images/%s/file' % (endpoint.rstrip('/'), image_id)
+
+    def _auth_headers(self):
+        if (CONF.glance.auth_strategy == 'keystone'
+                and self.context is not None and self.context.auth_token):
+            return {'X-Auth-Token': self.context.auth_token}
+        return {}
+
+    def _parallel_download(self, image_id, data, url=None, headers=None):
+        """Download an image as parts written in parallel, if possible.
+
+        The parts are downloaded with HTTP range requests and written to
+        the file, preallocated to the size of the image, at their offset.
+        The data is then verified against the checksum of the image.
+
+        :param image_id: The opaque image identifier.
+        :param data: File object to write data to.
+        :param url: URL from which the data can be downloaded with range
+                    requests, None for the image data URL of the Glance API.
+        :param headers: HTTP headers to send along with range requests,
+                        None for the authentication headers of the Glance
+                        API.
+        :returns: False if the image was not downloaded because parallel
+                  downloads are disabled, data is not a regular file, the
+                  image is not larger than one part or the server does not
+                  support range requests. True otherwise.
+        :raises: ImageDownloadFailed
+        """
+        concurrency = CONF.glance.glance_download_concurrency
+        part_size = CONF.glance.glance_download_part_size * 1024 * 1024
+        if (concurrency <= 1 or part_size <= 0 or not isinstance(data, file)
+                or not os.path.isfile(data.name)):
+            return False
+        image = self._get_image(image_id)
+        size = getattr(image, 'size', None)
+        if not size or size <= part_size:
+            return False
+        if url is None:
+            url = self._image_data_url(image_id)
+        if headers is None:
+            headers = self._auth_headers()
+
+        data.flush()
+        fd = data.fileno()
+        os.ftruncate(fd, size)
+        lock = threading.Lock()
+        parts = [(start, min(start + part_size, size))
+                 for start in range(0, size, part_size)]
+        try:
+            # NOTE: the first part tells whether range requests work
+            self._download_part(image_id, url, headers, fd, lock, *parts[0])
+        except _RangeNotSupported:
+            LOG.debug("Range requests not supported for %s, downloading "
+                      "image %s as a whole", url, image_id)
+            os.ftruncate(fd, 0)
+            return False
+
+        LOG.debug("Downloading image %(image)s in %(parts)d parts of "
+                  "%(size)d bytes, %(concurrency)d at a time",
+                  {'image': image_id, 'parts': len(parts),
+                   'size': part_size, 'concurrency': concurrency})
+        parts = parts[1:]
+        errors = []
+
+        def _worker():
+            while True:
+                with lock:
+                    if not parts or errors:
+                        return
+                    start, end = parts.pop(0)
+                try:
+                    self._download_part(image_id, url, headers, fd, lock,
+                                        start, end)
+                except Exception:
+                    errors.append(sys.exc_info())
+                    return
+
+        workers = [threading.Thread(target=_worker)
+                   for i in range(min(concurrency, len(parts)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            exc_type, exc_value, exc_trace = errors[0]
+            if isinstance(exc_value, _RangeNotSupported):
+                exc_value = exception.ImageDownloadFailed(
+                    image_href=image_id,
+                    reason=_("range requests stopped working"))
+            six.reraise(type(exc_value), exc_value, exc_trace)
+
+        data.seek(size)
+        # NOTE: the parts were written out of order, the image is read
+        #       back in a native thread not to block the other green
+        #       threads.
+        checksum = tpool.execute(_file_md5, data.name)
+        expected = getattr(image, 'checksum', None)
+        if expected and expected != checksum:
+            raise exception.ImageDownloadFailed(
+                image_href=image_id,
+                reason=_("checksum %(actual)s does not match the checksum "
+                         "of the image %(expected)s") %
+                {'actual': checksum, 'expected': expected})
+        return True
+
+    def _download_part(self, image_id, url, headers, fd, lock, start, end):
+        """Download a part of an image, resuming it after errors.
+
+        :raises: ImageDownloadFailed, _RangeNotSupported
+        """
+        writer = _PartWriter(fd, start, lock)
+        resumes = 0
+        while True:
+            try:
+                _http_get(url, headers, writer, end=end)
+                return
+            except (IOError, exception.CommunicationError) as e:
+                if resumes >= CONF.glance.glance_download_resumes:
+                    raise exception.ImageDownloadFailed(image_href=image_id,
+                                                        reason=e)
+                resumes += 1
+                LOG.warning(_("Download of bytes %(start)d-%(end)d of image "
+                              "%(image)s interrupted at %(offset)d, resuming "
+                              "it (%(resume)d/%(resumes)d): %(exc)s"),
+                            {'image': image_id, 'start': start,
+                             'end': end - 1, 'offset': writer.offset,
+                             'resume': resumes, 'exc': e,
+                             'resumes': CONF.glance.glance_download_resumes})
+                time.sleep(1)
+
+    def _resume_download(self, image_id, progress, url=None, headers=None,
+                         chunks=None, verify=False):
+        """Download image data, resuming the download after errors.
+
+        :param image_id: The opaque image identifier.
+        :param progress: a _DownloadProgress to write the data to.
+        :param url: URL from which the data can be downloaded with range
+                    requests, None for the image data URL of the Glance API.
+        :param headers: HTTP headers to send along with range requests,
+                        None for the authentication headers of the Glance
+                        API.
+        :param chunks: iterable of data chunks to write before downloading
+                       the rest of the data from url, if any.
+        :param verify: whether to verify the data against the checksum of
+                       the image. The data is always verified when the
+                       download had to be resumed.
+        :raises: ImageDownloadFailed
+        """
+        resumes = 0
+        while True:
+            try:
+                if chunks is not None:
+                    first_chunks, chunks = chunks, None
+                    for chunk in first_chunks:
+                        progress.write(chunk)
+                else:
+                    if url is None:
+                        url = self._image_data_url(image_id)
+                    if headers is None:
+                        headers = self._auth_headers()
+                    _http_get(url, headers, progress)
+                break
+            except (IOError, exception.CommunicationError) as e:
+                if resumes >= CONF.glance.glance_download_resumes:
+                    raise exception.ImageDownloadFailed(image_href=image_id,
+                                                        reason=e)
+                resumes += 1
+                verify = True
+                LOG.warning(_("Download of image %(image)s interrupted "
+                              "after %(offset)d bytes, resuming it "
+                              "(%(resume)d/%(resumes)d): %(exc)s"),
+                            {'image': image_id, 'offset': progress.offset,
+                             'resume': resumes, 'exc': e,
+                             'resumes': CONF.glance.glance_download_resumes})
+                time.sleep(1)
+
+        if verify:
+            checksum = getattr(self._get_image(image_id), 'checksum', None)
+            if checksum and checksum != progress.checksum.hexdigest():
+                raise exception.ImageDownloadFailed(
+                    image_href=image_id,
+                    reason=_("checksum %(actual)s does not match the "
+                             "checksum of the image %(expected)s") %
+                    {'actual': progress.checksum.hexdigest(),
+                     'expected': checksum})
 
     @check_image_service
     def _create(self, image_meta, data=None, method='create'):
@@ -239,6 +668,8 @@ class BaseImageService(object):
             sent_service_image_meta['data'] = data
 
         recv_service_image_meta = self.call(method, **sent_service_image_meta)
+        metadata_cache.get_cache().invalidate(
+            getattr(recv_service_image_meta, 'id', None))
 
         return service_utils.translate_from_glance(recv_service_image_meta)
 
@@ -269,6 +700,7 @@ class BaseImageService(object):
         image_meta.pop('id', None)
 
         image_meta = self.call(method, image_id, **image_meta)
+        metadata_cache.get_cache().invalidate(image_id)
 
         if self.version == 2 and data:
             self.call('upload', image_id, data)
@@ -291,3 +723,4 @@ class BaseImageService(object):
          glance_port, use_ssl) = service_utils.parse_image_ref(image_id)
 
         self.call(method, image_id)
+        metadata_cache.get_cache().invalidate(image_id)
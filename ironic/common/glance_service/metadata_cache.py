@@ -0,0 +1,143 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Conductor-wide cache of Glance image metadata.
+
+A single deployment asks Glance for the metadata of the same image several
+times: when the driver validates the node, when it works out which images
+to put in the TFTP directory, when it checks whether the image fits on the
+node's disk... This cache remembers, for a short time, the image records
+returned by Glance, keyed by image id, so that those callers share a single
+request. Images which Glance reported as not found are remembered too, for
+an even shorter time.
+
+Entries are also keyed by the Glance server and by the authentication
+token of the request context, so that a record read with one token is
+never returned to a request made with another: Glance checks the access
+of every user to the image, and an image hidden from one project is not
+reported as missing to another.
+"""
+
+import threading
+import time
+
+from oslo.config import cfg
+
+metadata_cache_opts = [
+    cfg.IntOpt('glance_metadata_cache_ttl',
+               default=10,
+               help='Number of seconds the metadata of an image read from '
+                    'Glance is kept in the conductor\'s image metadata '
+                    'cache and reused instead of asking Glance again. '
+                    '0 disables caching.'),
+    cfg.IntOpt('glance_metadata_negative_cache_ttl',
+               default=2,
+               help='Number of seconds an image reported as not found by '
+                    'Glance is remembered as such in the conductor\'s image '
+                    'metadata cache. 0 disables negative caching.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metadata_cache_opts, group='glance')
+
+# Cached in place of the image record of images Glance did not find.
+NOT_FOUND = object()
+
+
+class ImageMetadataCache(object):
+    """Cache of the image records returned by Glance."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # image id -> {(server, token): (image or NOT_FOUND, expiry)}
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_id, scope=None):
+        """Get the cached image record of an image.
+
+        :param image_id: the id of the image.
+        :param scope: the Glance server and token the record was read with.
+        :returns: the image record, NOT_FOUND if Glance reported the image as
+                  not found, or None if there is no fresh entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(image_id, {}).get(scope)
+            if entry is not None and now < entry[1]:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, image_id, image, scope=None):
+        """Record the image record of an image.
+
+        :param image_id: the id of the image.
+        :param image: the image record returned by Glance, or NOT_FOUND.
+        :param scope: the Glance server and token the record was read with.
+        """
+        if image is NOT_FOUND:
+            ttl = CONF.glance.glance_metadata_negative_cache_ttl
+        else:
+            ttl = CONF.glance.glance_metadata_cache_ttl
+        if ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._entries.setdefault(image_id, {})[scope] = (image, now + ttl)
+
+    def _purge(self, now):
+        for image_id in list(self._entries):
+            scopes = self._entries[image_id]
+            for scope in [s for s, e in scopes.items() if e[1] <= now]:
+                del scopes[scope]
+            if not scopes:
+                del self._entries[image_id]
+
+    def invalidate(self, image_id):
+        """Forget the cached records of an image, for all scopes.
+
+        :param image_id: the id of the image.
+        """
+        with self._lock:
+            self._entries.pop(image_id, None)
+
+    def clear(self):
+        """Forget all cached records and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the cache counters.
+
+        :returns: a dictionary with the number of cache 'hits' and 'misses',
+                  and the number of cached records ('size').
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': sum(len(s) for s in self._entries.values())}
+
+
+_CACHE = ImageMetadataCache()
+
+
+def get_cache():
+    """Return the image metadata cache of this conductor."""
+    return _CACHE
@@ -61,7 +61,7 @@ class GlanceImageService(base_image_service.BaseImageService,
         """Returns the direct url representing the backend storage location,
         or None if this attribute is not shown by Glance.
         """
-        image_meta = self.call('get', image_id)
+        image_meta = self._get_image(image_id)
 
         if not service_utils.is_image_available(self.context, image_meta):
             raise exc.ImageNotFound(image_id=image_id)
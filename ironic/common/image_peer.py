@@ -0,0 +1,379 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Sharing of master images between conductors.
+
+Every conductor keeps its own master image caches, and would otherwise
+download every image from Glance by itself. When peer sharing is enabled,
+each conductor serves the master images of its caches over a small HTTP
+endpoint, and asks the other active conductors for an image before
+downloading it from Glance.
+
+Master images are named after the checksum of the image in Glance, so a
+master image with the same name on another conductor has the same
+contents. Peers also send the MD5 checksum of the master image itself,
+which is checked once the image has been received.
+
+Master images may be private tenant images, so conductors only trust each
+other through a secret they share: requests for master images carry an
+HMAC of the requested image and of the time of the request made with the
+secret, and the checksums sent back are signed with it too. Requests which
+are not signed, or were signed too long ago so that they cannot be
+replayed, are refused, and sharing is disabled as long as no secret is
+configured. The endpoint listens on the management address of the
+conductor by default, and is plain HTTP: it should only be reachable from
+the management network.
+"""
+
+import hashlib
+import hmac
+import os
+import random
+import threading
+import time
+
+from eventlet import tpool
+import requests
+import six.moves.BaseHTTPServer as BaseHTTPServer
+import six.moves.socketserver as SocketServer
+
+from oslo.config import cfg
+
+from ironic.db import api as dbapi
+from ironic.openstack.common import log as logging
+
+image_peer_opts = [
+    cfg.IntOpt('image_peer_port',
+               default=0,
+               help='Port on which the conductor serves the master images '
+                    'of its image caches to the other conductors, and on '
+                    'which the other conductors are expected to serve '
+                    'theirs. Conductors then fetch images from each other '
+                    'before downloading them from Glance. 0 disables '
+                    'image sharing between conductors.'),
+    cfg.StrOpt('image_peer_host',
+               default='$my_ip',
+               help='IP address on which the conductor serves the master '
+                    'images of its image caches to the other conductors. '
+                    'Should be an address of the management network, '
+                    'which only the other conductors can reach.'),
+    cfg.StrOpt('image_peer_secret',
+               secret=True,
+               help='Secret shared by all the conductors, with which the '
+                    'requests for master images and the checksums of the '
+                    'images served are signed. Master images may be '
+                    'private tenant images, which anyone knowing the '
+                    'secret and reaching image_peer_port can fetch, so it '
+                    'must be kept as confidential as the database '
+                    'credentials. Image sharing between conductors is '
+                    'disabled unless it is set.'),
+    cfg.IntOpt('image_peer_token_validity',
+               default=60,
+               help='Time (in seconds) during which a signed request for a '
+                    'master image is accepted by another conductor, '
+                    'allowing for that much clock skew between '
+                    'conductors. Older requests are refused, so that they '
+                    'cannot be replayed.'),
+    cfg.StrOpt('image_peer_url',
+               default='http://%(host)s:%(port)s',
+               help='URL of the endpoint serving the master images of '
+                    'another conductor. %(host)s is replaced with the '
+                    'conductor\'s host name and %(port)s with '
+                    'image_peer_port.'),
+    cfg.IntOpt('image_peer_timeout',
+               default=5,
+               help='Timeout (in seconds) of the requests made to other '
+                    'conductors for their master images.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(image_peer_opts, group='conductor')
+
+LOG = logging.getLogger(__name__)
+
+# Header holding the MD5 checksum of the served master image
+CHECKSUM_HEADER = 'X-Image-Checksum'
+# Header holding the signature of a request for a master image
+TOKEN_HEADER = 'X-Image-Peer-Token'
+# Header holding the signature of the checksum of the served master image
+SIGNATURE_HEADER = 'X-Image-Checksum-Signature'
+
+# Size of the chunks master images are read and written in
+CHUNK_SIZE = 64 * 1024
+
+_CACHES_LOCK = threading.Lock()
+# name -> master directory of the caches served to other conductors
+_CACHES = {}
+# path -> (inode, mtime, size, MD5 checksum) of served master images
+_CHECKSUMS = {}
+
+
+def enabled():
+    """Whether master images are shared between conductors."""
+    return (CONF.conductor.image_peer_port > 0 and
+            bool(CONF.conductor.image_peer_secret))
+
+
+def _sign(*parts):
+    """Sign data with the secret shared by the conductors.
+
+    :param parts: strings to sign.
+    :returns: the HMAC-SHA256 of the parts, as a hex string.
+    """
+    return hmac.new(CONF.conductor.image_peer_secret.encode('utf-8'),
+                    '\n'.join(parts).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def _check_signature(signature, *parts):
+    """Check a signature made by _sign() in constant time."""
+    expected = _sign(*parts)
+    if not signature or len(signature) != len(expected):
+        return False
+    result = 0
+    for x, y in zip(signature, expected):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _make_token(image_name):
+    """Sign a request for a master image.
+
+    :param image_name: <cache name>/<master image> name of the image.
+    :returns: the <timestamp>:<signature> token of the request.
+    """
+    timestamp = str(int(time.time()))
+    return '%s:%s' % (timestamp, _sign(image_name, timestamp))
+
+
+def _check_token(token, image_name):
+    """Check the token of a request for a master image.
+
+    :returns: False if the token was not made by _make_token() for the image
+              with the shared secret, or not recently enough.
+    """
+    timestamp, sep, signature = (token or '').partition(':')
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    if abs(age) > CONF.conductor.image_peer_token_validity:
+        return False
+    return _check_signature(signature, image_name, timestamp)
+
+
+def register_cache(name, master_dir):
+    """Serve the master images of an image cache to other conductors.
+
+    :param name: name of the cache, the same on all conductors.
+    :param master_dir: master image directory of the cache.
+    """
+    with _CACHES_LOCK:
+        _CACHES[name] = master_dir
+
+
+def _hash_file(path):
+    checksum = hashlib.md5()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _file_checksum(path, stat):
+    key = (stat.st_ino, stat.st_mtime, stat.st_size)
+    with _CACHES_LOCK:
+        cached = _CHECKSUMS.get(path)
+    if cached is not None and cached[:3] == key:
+        return cached[3]
+
+    # NOTE: hashing a whole image would block the other green threads.
+    checksum = tpool.execute(_hash_file, path)
+    with _CACHES_LOCK:
+        _CHECKSUMS[path] = key + (checksum,)
+    return checksum
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves GET /<cache name>/<master image> requests."""
+
+    def _image_name(self):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) != 2 or parts[1].startswith('.'):
+            return None
+        return '/'.join(parts)
+
+    def _master_path(self, image_name):
+        cache_name, master_file_name = image_name.split('/')
+        with _CACHES_LOCK:
+            master_dir = self.server.caches.get(cache_name)
+        if master_dir is None:
+            return None
+        return os.path.join(master_dir, master_file_name)
+
+    def _send_headers(self):
+        image_name = self._image_name()
+        if not _check_token(self.headers.get(TOKEN_HEADER),
+                            image_name or self.path):
+            self.send_error(403)
+            return None
+
+        path = self._master_path(image_name) if image_name else None
+        try:
+            image_file = open(path, 'rb') if path else None
+        except IOError:
+            image_file = None
+        if image_file is None:
+            self.send_error(404)
+            return None
+
+        stat = os.fstat(image_file.fileno())
+        checksum = _file_checksum(path, stat)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(stat.st_size))
+        self.send_header(CHECKSUM_HEADER, checksum)
+        self.send_header(SIGNATURE_HEADER, _sign(image_name, checksum))
+        self.end_headers()
+        return image_file
+
+    def do_HEAD(self):
+        image_file = self._send_headers()
+        if image_file is not None:
+            image_file.close()
+
+    def do_GET(self):
+        image_file = self._send_headers()
+        if image_file is None:
+            return
+        with image_file:
+            for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b''):
+                self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        LOG.debug("Image peer request from %(client)s: %(msg)s",
+                  {'client': self.client_address[0], 'msg': format % args})
+
+
+class ImagePeerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server serving master images to other conductors."""
+
+    daemon_threads = True
+
+    def __init__(self, host=None, port=None, caches=None):
+        """Constructor.
+
+        :param host: IP address to listen on, defaults to
+                     CONF.conductor.image_peer_host.
+        :param port: port to listen on, defaults to
+                     CONF.conductor.image_peer_port.
+        :param caches: dictionary mapping cache names to master directories,
+                       defaults to the caches registered with
+                       register_cache().
+        """
+        if host is None:
+            host = CONF.conductor.image_peer_host
+        if port is None:
+            port = CONF.conductor.image_peer_port
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           _RequestHandler)
+        self.port = self.server_address[1]
+        self.caches = _CACHES if caches is None else caches
+        self._thread = None
+
+    def start(self):
+        """Start serving requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving requests."""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def get_peer_urls():
+    """Return the URLs of the image endpoints of the other conductors.
+
+    :returns: a list of URLs, in random order.
+    """
+    hosts = set()
+    for driver_hosts in dbapi.get_instance().get_active_driver_dict().values():
+        hosts.update(driver_hosts)
+    hosts.discard(CONF.host)
+    urls = [CONF.conductor.image_peer_url %
+            {'host': host, 'port': CONF.conductor.image_peer_port}
+            for host in hosts]
+    random.shuffle(urls)
+    return urls
+
+
+def _fetch_from(url, image_name, dest_path):
+    response = requests.get(url, stream=True,
+                            headers={TOKEN_HEADER: _make_token(image_name)},
+                            timeout=CONF.conductor.image_peer_timeout)
+    try:
+        if response.status_code != 200:
+            return False
+        expected = response.headers.get(CHECKSUM_HEADER)
+        if not expected or not _check_signature(
+                response.headers.get(SIGNATURE_HEADER), image_name,
+                expected):
+            LOG.warning(_("Master image checksum sent by %(url)s is not "
+                          "signed with the image peer secret, ignoring "
+                          "it."), {'url': url})
+            return False
+        checksum = hashlib.md5()
+        with open(dest_path, 'wb') as dest_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                dest_file.write(chunk)
+                checksum.update(chunk)
+    finally:
+        response.close()
+
+    if checksum.hexdigest() != expected:
+        LOG.warning(_("Master image received from %(url)s has checksum "
+                      "%(actual)s instead of %(expected)s, ignoring it."),
+                    {'url': url, 'actual': checksum.hexdigest(),
+                     'expected': expected})
+        return False
+    return True
+
+
+def fetch(name, master_file_name, dest_path):
+    """Fetch a master image from another conductor.
+
+    :param name: name of the image cache.
+    :param master_file_name: name of the master image in the cache.
+    :param dest_path: path to write the master image to.
+    :returns: True if the master image was fetched from another conductor,
+              False if no other conductor could provide it.
+    """
+    image_name = '%s/%s' % (name, master_file_name)
+    for peer_url in get_peer_urls():
+        url = '%s/%s' % (peer_url.rstrip('/'), image_name)
+        try:
+            if _fetch_from(url, image_name, dest_path):
+                LOG.info(_("Fetched master image %(master)s from %(url)s"),
+                         {'master': master_file_name, 'url': url})
+                return True
+        except (requests.RequestException, IOError) as e:
+            LOG.debug("Could not fetch master image %(master)s from "
+                      "%(url)s: %(err)s",
+                      {'master': master_file_name, 'url': url, 'err': e})
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+    return False
@@ -21,6 +21,10 @@ Handling of VM disk images.
 
 import os
 import re
+import struct
+import threading
+import time
+import zlib
 
 from oslo.config import cfg
 
@@ -36,7 +40,20 @@ LOG = logging.getLogger(__name__)
 image_opts = [
     cfg.BoolOpt('force_raw_images',
                 default=True,
-                help='Force backing images to raw format.'),
+                help='Force backing images to raw format. Otherwise images '
+                     'are kept in their own format, qcow2 for instance, and '
+                     'deployments convert them to raw format straight onto '
+                     'the node\'s disk.'),
+    cfg.IntOpt('image_download_bandwidth',
+               default=0,
+               help='Maximum aggregate bandwidth, in MiB per second, used '
+                    'by all the image downloads of this process. 0 means '
+                    'unlimited.'),
+    cfg.BoolOpt('sniff_image_format',
+                default=True,
+                help='Detect the format of raw, qcow2, vmdk and vhd images '
+                     'by reading their headers, and only run "qemu-img info" '
+                     'for other images.'),
 ]
 
 CONF = cfg.CONF
@@ -158,6 +175,281 @@ class QemuImgInfo(object):
         return contents
 
 
+# Number of bytes of an image read to detect its format
+SNIFF_SIZE = 4096
+
+# Magic numbers, and their offsets, of the image formats supported by
+# qemu-img which sniff_image_info() does not parse, as checked by the
+# format probes of qemu's block drivers. Images starting with one of these
+# are handed to qemu-img.
+_OTHER_FORMAT_MAGICS = (
+    (0, b'vhdxfile'),                   # vhdx
+    (0, b'QED\x00'),                    # qed
+    (64, b'\x7f\x10\xda\xbe'),          # vdi
+    (0, b'COWD'),                       # vmdk3
+    (0, b'# Disk DescriptorFile'),      # vmdk descriptor
+    (0, b'OOOM'),                       # cow
+    (0, b'WithoutFreeSpace'),           # parallels
+    (0, b'WithouFreSpacExt'),           # parallels
+    (0, b'Bochs Virtual HD Image'),     # bochs
+    (0, b'#!/bin/sh\n#V2.0 Format'),    # cloop
+    (0, b'LUKS\xba\xbe'),               # luks
+)
+
+# Magic numbers, and their offsets from the end of the image, of the
+# formats whose header is a trailer.
+_OTHER_FORMAT_TRAILERS = (
+    (512, b'koly'),                     # dmg
+)
+
+_QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+# crypt_method, l1_size and l1_table_offset, following _QCOW2_HEADER
+_QCOW2_L1_HEADER = struct.Struct('>IIQ')
+_QCOW2_ENTRY = struct.Struct('>Q')
+_QCOW2_COMPRESSED = 1 << 62
+_QCOW2_ZERO = 1
+_QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+_VMDK_HEADER = struct.Struct('<4sIIQQQQ')
+_VHD_FOOTER = struct.Struct('>8sIIQ16xQQ4sI')
+
+_VHD_DIFFERENCING = 4
+# Largest VMDK embedded descriptor read looking for a parent
+_VMDK_MAX_DESCRIPTOR = 64 * 1024
+_VMDK_PARENT_RE = re.compile(r'^\s*parentFileNameHint\s*=\s*"(.*)"', re.M)
+
+
+def _read_at(image_file, offset, size):
+    image_file.seek(offset)
+    return image_file.read(size)
+
+
+def _sniff_qcow2(image_file, header):
+    (magic, version, backing_offset, backing_size, cluster_bits,
+     size) = _QCOW2_HEADER.unpack_from(header)
+    if version not in (2, 3):
+        return None
+    backing_file = None
+    if backing_offset:
+        backing_file = _read_at(image_file, backing_offset,
+                                min(backing_size, 1023)) or '<unknown>'
+    return 'qcow2', size, backing_file
+
+
+def _sniff_vmdk(image_file, header):
+    (magic, version, flags, capacity, grain_size, descriptor_offset,
+     descriptor_size) = _VMDK_HEADER.unpack_from(header)
+    backing_file = None
+    if descriptor_offset:
+        descriptor = _read_at(image_file, descriptor_offset * 512,
+                              min(descriptor_size * 512,
+                                  _VMDK_MAX_DESCRIPTOR))
+        parent = _VMDK_PARENT_RE.search(descriptor.split(b'\x00', 1)[0])
+        if parent:
+            backing_file = parent.group(1) or '<unknown>'
+    return 'vmdk', capacity * 512, backing_file
+
+
+def _sniff_vhd(image_file, header):
+    (cookie, features, version, data_offset, original_size, current_size,
+     geometry, disk_type) = _VHD_FOOTER.unpack_from(header)
+    backing_file = None
+    if disk_type == _VHD_DIFFERENCING:
+        # NOTE: the parent's name is in the dynamic disk header
+        name = _read_at(image_file, data_offset + 64, 512)
+        try:
+            name = name.decode('utf-16-be').rstrip(u'\x00')
+        except UnicodeDecodeError:
+            name = None
+        backing_file = name or '<unknown>'
+    return 'vpc', current_size, backing_file
+
+
+def sniff_image_info(path):
+    """Detect the format of an image by reading its header.
+
+    Recognizes qcow2, vmdk (monolithic sparse) and vhd images, and treats
+    images which carry none of the magic numbers known to qemu-img as raw,
+    as qemu-img does. Images whose format is not certain, such as other
+    formats or truncated headers, are left to qemu-img. Only the first few
+    KiB of the image are read, and a few more for the dmg trailer and for
+    the backing file name of images which have one.
+
+    :param path: path of the image.
+    :returns: a QemuImgInfo object with the image's file_format,
+              virtual_size and backing_file, or None if the image format
+              has to be detected by qemu-img.
+    """
+    try:
+        with open(path, 'rb') as image_file:
+            header = image_file.read(SNIFF_SIZE)
+            # NOTE: truncated headers are left to qemu-img
+            if header.startswith(b'QFI\xfb'):
+                result = (_sniff_qcow2(image_file, header)
+                          if len(header) >= 40 else None)
+            elif header.startswith(b'KDMV'):
+                result = (_sniff_vmdk(image_file, header)
+                          if len(header) >= 44 else None)
+            elif header.startswith(b'conectix'):
+                result = (_sniff_vhd(image_file, header)
+                          if len(header) >= 64 else None)
+            elif any(header[offset:offset + len(magic)] == magic
+                     for offset, magic in _OTHER_FORMAT_MAGICS):
+                result = None
+            else:
+                size = os.fstat(image_file.fileno()).st_size
+                if any(size >= offset and
+                       _read_at(image_file, size - offset,
+                                len(magic)) == magic
+                       for offset, magic in _OTHER_FORMAT_TRAILERS):
+                    result = None
+                else:
+                    result = 'raw', size, None
+    except (IOError, OSError, struct.error):
+        return None
+    if result is None:
+        return None
+
+    info = QemuImgInfo()
+    info.image = os.path.basename(path)
+    info.file_format, info.virtual_size, info.backing_file = result
+    return info
+
+
+def _qcow2_cluster(image_file, cluster_bits, l1_size, l1_offset, index):
+    """Read a cluster of the disk held by a qcow2 image."""
+    cluster_size = 1 << cluster_bits
+    l2_bits = cluster_bits - 3
+    l1_index = index >> l2_bits
+    if l1_index >= l1_size:
+        return b''
+    l1_entry, = _QCOW2_ENTRY.unpack(
+        _read_at(image_file, l1_offset + 8 * l1_index, 8))
+    l2_offset = l1_entry & _QCOW2_OFFSET_MASK
+    if not l2_offset:
+        return b''
+    entry, = _QCOW2_ENTRY.unpack(_read_at(
+        image_file, l2_offset + 8 * (index & ((1 << l2_bits) - 1)), 8))
+    if entry & _QCOW2_COMPRESSED:
+        offset_bits = 62 - (cluster_bits - 8)
+        offset = entry & ((1 << offset_bits) - 1)
+        sectors = (entry >> offset_bits) & ((1 << (cluster_bits - 8)) - 1)
+        data = _read_at(image_file, offset,
+                        (sectors + 1) * 512 - (offset & 511))
+        return zlib.decompressobj(-12).decompress(data, cluster_size)
+    if entry & _QCOW2_ZERO or not entry & _QCOW2_OFFSET_MASK:
+        return b''
+    return _read_at(image_file, entry & _QCOW2_OFFSET_MASK, cluster_size)
+
+
+def read_image_head(path, length):
+    """Read the beginning of the disk held by an image.
+
+    Reads raw images as they are, and qcow2 images without a backing file
+    and without encryption by following their cluster tables, so that the
+    partition table of a qcow2 image can be looked at without converting
+    the whole image.
+
+    :param path: path of the image.
+    :param length: number of bytes to read from the start of the disk.
+    :returns: the data, shorter than length if the disk is, or None if the
+              format of the image is not supported.
+    """
+    info = sniff_image_info(path)
+    if info is None or info.backing_file is not None:
+        return None
+    try:
+        with open(path, 'rb') as image_file:
+            if info.file_format == 'raw':
+                return image_file.read(length)
+            if info.file_format != 'qcow2':
+                return None
+            header = image_file.read(_QCOW2_HEADER.size +
+                                     _QCOW2_L1_HEADER.size)
+            cluster_bits = _QCOW2_HEADER.unpack_from(header)[4]
+            crypt_method, l1_size, l1_offset = _QCOW2_L1_HEADER.unpack_from(
+                header, _QCOW2_HEADER.size)
+            if crypt_method:
+                return None
+            length = min(length, info.virtual_size)
+            cluster_size = 1 << cluster_bits
+            data = []
+            for index in range((length + cluster_size - 1) // cluster_size):
+                cluster = _qcow2_cluster(image_file, cluster_bits, l1_size,
+                                         l1_offset, index)
+                data.append(cluster.ljust(cluster_size, b'\x00'))
+            return b''.join(data)[:length]
+    except (IOError, OSError, struct.error, zlib.error):
+        return None
+
+
+def image_info(path):
+    """Return the format, virtual size and backing file of an image.
+
+    Reads the image header if CONF.sniff_image_format is set and the
+    format is one sniff_image_info() knows about, runs "qemu-img info"
+    otherwise.
+
+    :param path: path of the image.
+    :returns: a QemuImgInfo object.
+    """
+    if CONF.sniff_image_format:
+        info = sniff_image_info(path)
+        if info is not None:
+            return info
+    return qemu_img_info(path)
+
+
+class Throttle(object):
+    """Limits the aggregate rate at which data is written.
+
+    Every write reserves a time slot proportional to its size after the
+    slots reserved by previous writes, from any writer sharing the throttle,
+    and sleeps until that slot starts.
+    """
+
+    def __init__(self, bandwidth=None):
+        """Constructor.
+
+        :param bandwidth: function returning the maximum bandwidth, in MiB
+                          per second, 0 meaning unlimited. Defaults to
+                          returning CONF.image_download_bandwidth.
+        """
+        self._bandwidth = bandwidth or (lambda: CONF.image_download_bandwidth)
+        self._lock = threading.Lock()
+        self._available_at = 0
+
+    def consume(self, nbytes):
+        rate = self._bandwidth() * 1024 * 1024
+        if rate <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(self._available_at, now)
+            self._available_at = start + float(nbytes) / rate
+        if start > now:
+            time.sleep(start - now)
+
+
+_THROTTLE = Throttle()
+
+
+class _ThrottledFile(object):
+    """File object whose writes are subject to the download bandwidth cap.
+
+    Anything but write() is passed through to the wrapped file object.
+    """
+
+    def __init__(self, image_file):
+        self._file = image_file
+
+    def write(self, data):
+        _THROTTLE.consume(len(data))
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
 def qemu_img_info(path):
     """Return an object containing the parsed output from qemu-img info."""
     if not os.path.exists(path):
@@ -184,6 +476,8 @@ def fetch(context, image_href, path, image_service=None):
 
     with fileutils.remove_path_on_error(path):
         with open(path, "wb") as image_file:
+            if CONF.image_download_bandwidth > 0:
+                image_file = _ThrottledFile(image_file)
             image_service.download(image_href, image_file)
 
 
@@ -195,7 +489,7 @@ def fetch_to_raw(context, image_href, path, image_service=None):
 
 def image_to_raw(image_href, path, path_tmp):
     with fileutils.remove_path_on_error(path_tmp):
-        data = qemu_img_info(path_tmp)
+        data = image_info(path_tmp)
 
         fmt = data.file_format
         if fmt is None:
@@ -218,7 +512,7 @@ def image_to_raw(image_href, path, path_tmp):
                 convert_image(path_tmp, staged, 'raw')
                 os.unlink(path_tmp)
 
-                data = qemu_img_info(staged)
+                data = image_info(staged)
                 if data.file_format != "raw":
                     raise exception.ImageConvertFailed(image_id=image_href,
                         reason=_("Converted to raw, but format is now %s") %
@@ -229,7 +523,11 @@ def image_to_raw(image_href, path, path_tmp):
             os.rename(path_tmp, path)
 
 
-def download_size(context, image_href, image_service=None):
+def image_show(context, image_href, image_service=None):
     if not image_service:
         image_service = service.Service(version=1, context=context)
-    return image_service.show(image_href)['size']
+    return image_service.show(image_href)
+
+
+def download_size(context, image_href, image_service=None):
+    return image_show(context, image_href, image_service)['size']
@@ -23,8 +23,7 @@ CONF = cfg.CONF
 acl.register_opts(CONF)
 
 
-def get_service_url(service_type='baremetal', endpoint_type='internal'):
-    """Wrapper for get service url from keystone service catalog."""
+def _get_ksclient():
     auth_url = CONF.keystone_authtoken.auth_uri
     if not auth_url:
         raise exception.CatalogFailure(_('Keystone API endpoint is missing'))
@@ -53,7 +52,12 @@ def get_service_url(service_type='baremetal', endpoint_type='internal'):
         raise exception.CatalogFailure(_('Could not perform authorization '
                                          'process for service catalog: %s')
                                           % err)
+    return ksclient
 
+
+def get_service_url(service_type='baremetal', endpoint_type='internal'):
+    """Wrapper for get service url from keystone service catalog."""
+    ksclient = _get_ksclient()
     if not ksclient.has_service_catalog():
         raise exception.CatalogFailure(_('No keystone service catalog loaded'))
 
@@ -65,3 +69,12 @@ def get_service_url(service_type='baremetal', endpoint_type='internal'):
                                         endpoint_type=endpoint_type)
 
     return endpoint
+
+
+def get_admin_auth_token():
+    """Get an auth token for the admin credentials of keystone_authtoken.
+
+    :returns: the token.
+    :raises: CatalogFailure, CatalogUnauthorized
+    """
+    return _get_ksclient().auth_token
@@ -14,16 +14,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import sys
+import threading
 import time
 
+from eventlet import greenpool
+from eventlet import greenthread
 from neutronclient.common import exceptions as neutron_client_exc
 from neutronclient.v2_0 import client as clientv20
 from oslo.config import cfg
+import six
 
 from ironic.api import acl
 from ironic.common import exception
 from ironic.common import keystone
 from ironic.drivers.modules import ssh
+from ironic.openstack.common import context as ironic_context
 from ironic.openstack.common import log as logging
 
 
@@ -40,7 +47,38 @@ neutron_opts = [
                     'to neutron. Can be either "keystone" or "noauth". '
                     'Running neutron in noauth mode (related to but not '
                     'affected by this setting) is insecure and should only be '
-                    'used for testing.')
+                    'used for testing.'),
+    cfg.IntOpt('client_pool_size',
+               default=32,
+               help='Number of Neutron clients, one per authentication '
+                    'token or set of credentials, kept by the conductor to '
+                    'be reused by later requests. 0 disables the pool.'),
+    cfg.IntOpt('dhcp_update_min_wait',
+               default=15,
+               help='Time, in seconds, to wait after updating the DHCP '
+                    'options of the ports of a node before checking them. '
+                    'Neutron reports the new options as soon as it saved '
+                    'them, before its DHCP agents reloaded their '
+                    'configuration (bug 1334447). Only virtual machine '
+                    'nodes, powered by the SSH driver, are waited for.'),
+    cfg.IntOpt('dhcp_update_timeout',
+               default=15,
+               help='Maximum time, in seconds, to wait after '
+                    'dhcp_update_min_wait for Neutron to report the ports '
+                    'of a node active with their new DHCP options, before '
+                    'booting the node anyway.'),
+    cfg.FloatOpt('dhcp_update_poll_interval',
+                 default=0.5,
+                 help='Time, in seconds, between the first checks of the '
+                      'ports of a node after updating their DHCP options. '
+                      'The interval doubles after every check, up to 4 '
+                      'seconds.'),
+    cfg.FloatOpt('dhcp_batch_window',
+                 default=0.0,
+                 help='Time, in seconds, during which the DHCP option '
+                      'updates of the nodes deployed at the same time are '
+                      'collected, to be sent together and waited for '
+                      'together. 0 disables batching.'),
    ]
 
 CONF = cfg.CONF
@@ -49,6 +87,56 @@ CONF.register_opts(neutron_opts, group='neutron')
 acl.register_opts(CONF)
 LOG = logging.getLogger(__name__)
 
+# Maximum interval between two checks of the ports of a node
+MAX_POLL_INTERVAL = 4
+# Maximum number of ports updated at the same time
+MAX_CONCURRENT_UPDATES = 8
+
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS = collections.OrderedDict()
+
+
+def _client_key(params):
+    return tuple(sorted(params.items()))
+
+
+def _get_client(**params):
+    """Return a Neutron client, reusing a pooled one if possible.
+
+    Clients are pooled by connection parameters (including the
+    authentication token or credentials, so that clients authenticating
+    with the admin credentials keep their token); the least recently used
+    client is dropped when the pool is full.
+    """
+    pool_size = CONF.neutron.client_pool_size
+    if pool_size <= 0:
+        return clientv20.Client(**params)
+
+    key = _client_key(params)
+    with _CLIENTS_LOCK:
+        neutron_client = _CLIENTS.pop(key, None)
+        if neutron_client is None:
+            neutron_client = clientv20.Client(**params)
+        _CLIENTS[key] = neutron_client
+        while len(_CLIENTS) > pool_size:
+            _CLIENTS.popitem(last=False)
+    return neutron_client
+
+
+def clear_clients():
+    """Drop all the pooled Neutron clients."""
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
+def _port_has_options(port, dhcp_options):
+    if port.get('status') != 'ACTIVE':
+        return False
+    current = dict((opt['opt_name'], opt['opt_value'])
+                   for opt in port.get('extra_dhcp_opts') or [])
+    return all(current.get(opt['opt_name']) == opt['opt_value']
+               for opt in dhcp_options or [])
+
 
 class NeutronAPI(object):
     """API for communicating to neutron 2.x API."""
@@ -82,7 +170,9 @@ class NeutronAPI(object):
             params['endpoint_url'] = CONF.neutron.url
             params['auth_strategy'] = None
 
-        self.client = clientv20.Client(**params)
+        # NOTE: identifies the endpoint and credentials of the client
+        self.client_key = _client_key(params)
+        self.client = _get_client(**params)
 
     def update_port_dhcp_opts(self, port_id, dhcp_options):
         """Update a port's attributes.
@@ -110,6 +200,42 @@ class NeutronAPI(object):
             LOG.exception(_("Failed to update Neutron port %s."), port_id)
             raise exception.FailedToUpdateDHCPOptOnPort(port_id=port_id)
 
+    def is_port_ready(self, port_id, dhcp_options):
+        """Whether a port is active with the given DHCP options.
+
+        :param port_id: Neutron port id.
+        :param dhcp_options: list of DHCP options the port should have, as
+                             passed to update_port_dhcp_opts().
+        :returns: False if the port is not active, does not have the DHCP
+                  options yet, or could not be looked at.
+        """
+        try:
+            port = self.client.show_port(port_id)['port']
+        except neutron_client_exc.NeutronClientException as e:
+            LOG.debug("Failed to get Neutron port %(port)s: %(err)s",
+                      {'port': port_id, 'err': e})
+            return False
+        return _port_has_options(port, dhcp_options)
+
+    def get_ready_ports(self, dhcp_options):
+        """Return the ports active with the given DHCP options.
+
+        Looks at all the ports with a single request.
+
+        :param dhcp_options: dictionary of Neutron port ids and the list of
+                             DHCP options each port should have.
+        :returns: the set of the ids of the ports which are active with
+                  their DHCP options.
+        """
+        try:
+            ports = self.client.list_ports(id=list(dhcp_options))['ports']
+        except neutron_client_exc.NeutronClientException as e:
+            LOG.debug("Failed to list Neutron ports %(ports)s: %(err)s",
+                      {'ports': sorted(dhcp_options), 'err': e})
+            return set()
+        return set(port['id'] for port in ports
+                   if _port_has_options(port, dhcp_options.get(port['id'])))
+
     def update_port_address(self, port_id, address):
         """Update a port's mac address.
 
@@ -152,17 +278,17 @@ def update_neutron(task, options):
                       {'node': task.node.uuid})
         return
 
-    # TODO(deva): decouple instantiation of NeutronAPI from task.context.
-    #             Try to use the user's task.context.auth_token, but if it
-    #             is not present, fall back to a server-generated context.
-    #             We don't need to recreate this in every method call.
-    api = NeutronAPI(task.context)
-    failures = []
-    for port_id, port_vif in vifs.iteritems():
-        try:
-            api.update_port_dhcp_opts(port_vif, options)
-        except exception.FailedToUpdateDHCPOptOnPort:
-            failures.append(port_id)
+    if CONF.neutron.dhcp_batch_window > 0:
+        api = None
+        failures = _update_batched(task, vifs, options)
+    else:
+        # NOTE: clients are pooled by authentication token, or credentials
+        #       if task.context has no token, so this only authenticates
+        #       once.
+        api = NeutronAPI(task.context)
+        failures = _update_ports(api, dict((port_id, (port_vif, options))
+                                           for port_id, port_vif
+                                           in vifs.items()))
 
     if failures:
         if len(failures) == len(vifs):
@@ -175,15 +301,248 @@ def update_neutron(task, options):
                           "following ports: %(ports)s."),
                           {'node': task.node.uuid, 'ports': failures})
 
-    _wait_for_neutron_update(task)
+    if api is not None:
+        _wait_for_neutron_update(task, api, vifs, options)
+
+
+def _update_ports(api, updates):
+    """Update the DHCP options of several VIFs concurrently.
+
+    At most MAX_CONCURRENT_UPDATES VIFs are updated at the same time.
+
+    :param api: a NeutronAPI.
+    :param updates: dictionary of keys, such as port UUIDs, and the
+                    (VIF, DHCP options) to update.
+    :returns: the keys of the VIFs which could not be updated.
+    """
+    failures = []
+    errors = []
+
+    def _update(key, port_vif, options):
+        try:
+            api.update_port_dhcp_opts(port_vif, options)
+        except exception.FailedToUpdateDHCPOptOnPort:
+            failures.append(key)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    pool = greenpool.GreenPool(min(len(updates), MAX_CONCURRENT_UPDATES) or 1)
+    for key, (port_vif, options) in updates.items():
+        pool.spawn_n(_update, key, port_vif, options)
+    pool.waitall()
+
+    if errors:
+        six.reraise(*errors[0])
+    return failures
 
 
-def _wait_for_neutron_update(task):
-    """Wait for Neutron agents to process all requested changes if required."""
+def _needs_wait(task):
     # TODO(adam_g): Hack to workaround bug 1334447 until we have a mechanism
-    # for synchronizing events with Neutron.  We need to sleep only if we are
+    # for synchronizing events with Neutron.  We need to wait only if we are
     # booting VMs, which is implied by SSHPower, to ensure they do not boot
     # before Neutron agents have setup sufficent DHCP config for netboot.
-    if isinstance(task.driver.power, ssh.SSHPower):
-        LOG.debug(_("Waiting 15 seconds for Neutron."))
-        time.sleep(15)
+    return isinstance(task.driver.power, ssh.SSHPower)
+
+
+def _wait_until_ready(get_ready, port_vifs):
+    """Poll ports until they are ready or the timeout expires.
+
+    Waits for CONF.neutron.dhcp_update_min_wait seconds first, since the
+    ports are reported with their new DHCP options before the DHCP agents
+    apply them, then backs off from CONF.neutron.dhcp_update_poll_interval,
+    for at most CONF.neutron.dhcp_update_timeout seconds.
+
+    :param get_ready: function returning which of the VIFs it is given are
+                      ready.
+    :param port_vifs: the VIFs to wait for.
+    :returns: the VIFs which are still not ready.
+    """
+    if CONF.neutron.dhcp_update_min_wait > 0:
+        time.sleep(CONF.neutron.dhcp_update_min_wait)
+    deadline = time.time() + CONF.neutron.dhcp_update_timeout
+    interval = CONF.neutron.dhcp_update_poll_interval
+    pending = set(port_vifs)
+    while True:
+        pending -= get_ready(pending)
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            return pending
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
+def _wait_for_neutron_update(task, api, vifs, options):
+    """Wait for Neutron agents to process all requested changes if required.
+
+    Waits for the DHCP agents, then polls the ports until Neutron reports
+    them active with the new DHCP options, see _wait_until_ready().
+    """
+    if not _needs_wait(task):
+        return
+
+    start = time.time()
+    pending = _wait_until_ready(
+        lambda port_vifs: set(port_vif for port_vif in port_vifs
+                              if api.is_port_ready(port_vif, options)),
+        vifs.values())
+    if pending:
+        LOG.warning(_("Neutron ports %(ports)s of node %(node)s were "
+                      "not reported active with their new DHCP options "
+                      "after %(timeout)d seconds, continuing."),
+                    {'ports': sorted(pending), 'node': task.node.uuid,
+                     'timeout': (CONF.neutron.dhcp_update_min_wait +
+                                 CONF.neutron.dhcp_update_timeout)})
+    else:
+        LOG.debug("Neutron ports of node %(node)s ready after "
+                  "%(time).1f seconds.",
+                  {'node': task.node.uuid, 'time': time.time() - start})
+
+
+class _BatchCall(object):
+    """An update_neutron() call waiting in a _DHCPBatch."""
+
+    def __init__(self, vifs, wait):
+        self.vifs = set(vifs.values())
+        # VIFs to wait for before releasing the call
+        self.wait_vifs = set(self.vifs) if wait else set()
+        self.failed = set()
+        self.error = None
+        self.done = threading.Event()
+
+
+class _DHCPBatch(object):
+    """DHCP option updates of several nodes, sent and waited for together.
+
+    The first update_neutron() call opening the batch has it sent in the
+    background, with the updates collected during
+    CONF.neutron.dhcp_batch_window, or right away if no other batch is
+    running. All the ports which need to be waited for are then polled at
+    once. Every call is released as soon as the ports of its own node are
+    updated, or ready if its node needs to be waited for. Batches are sent
+    with the admin credentials, so that the deploys of all users share
+    them.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        # VIF -> DHCP options
+        self.updates = {}
+        self.calls = []
+        self.failed = set()
+        self.pending = set()
+        self.error = None
+
+    def add(self, vifs, options, wait):
+        """Add the updates of a node to the batch.
+
+        :returns: a _BatchCall, whose done event is set once the call can
+                  return.
+        """
+        for port_vif in vifs.values():
+            self.updates[port_vif] = options
+        call = _BatchCall(vifs, wait)
+        self.calls.append(call)
+        return call
+
+    def release(self, ready=(), force=False):
+        """Release the calls which have no VIF left to wait for.
+
+        :param ready: VIFs found ready since the last release.
+        :param force: release all the remaining calls.
+        """
+        waiting = []
+        for call in self.calls:
+            call.wait_vifs -= self.failed
+            call.wait_vifs -= set(ready)
+            if call.wait_vifs and not force:
+                waiting.append(call)
+                continue
+            call.failed = call.vifs & self.failed
+            call.error = self.error
+            call.done.set()
+        self.calls = waiting
+
+    def _get_ready(self, port_vifs):
+        ready = self.api.get_ready_ports(
+            dict((port_vif, self.updates[port_vif])
+                 for port_vif in port_vifs))
+        self.release(ready)
+        return ready
+
+    def run(self):
+        start = time.time()
+        try:
+            self.failed = set(_update_ports(
+                self.api, dict((port_vif, (port_vif, options))
+                               for port_vif, options
+                               in self.updates.items())))
+            self.release()
+            wait_vifs = set()
+            for call in self.calls:
+                wait_vifs.update(call.wait_vifs)
+            if wait_vifs:
+                self.pending = _wait_until_ready(self._get_ready, wait_vifs)
+        except Exception:
+            self.error = sys.exc_info()
+
+        if self.pending:
+            LOG.warning(_("Neutron ports %(ports)s were not reported active "
+                          "with their new DHCP options after %(timeout)d "
+                          "seconds, continuing."),
+                        {'ports': sorted(self.pending),
+                         'timeout': (CONF.neutron.dhcp_update_min_wait +
+                                 CONF.neutron.dhcp_update_timeout)})
+        LOG.debug("Updated the DHCP options of %(count)d Neutron ports in "
+                  "%(time).1f seconds.",
+                  {'count': len(self.updates), 'time': time.time() - start})
+
+
+_BATCHES_LOCK = threading.Lock()
+# Neutron endpoint and credentials -> _DHCPBatch collecting updates
+_BATCHES = {}
+# Neutron endpoint and credentials -> number of batches being run
+_RUNNING_BATCHES = collections.defaultdict(int)
+
+
+def _run_batch(key, batch, wait):
+    """Send a batch of DHCP option updates, then release all its calls."""
+    if wait:
+        time.sleep(CONF.neutron.dhcp_batch_window)
+    with _BATCHES_LOCK:
+        del _BATCHES[key]
+        _RUNNING_BATCHES[key] += 1
+    try:
+        batch.run()
+    finally:
+        with _BATCHES_LOCK:
+            _RUNNING_BATCHES[key] -= 1
+            if not _RUNNING_BATCHES[key]:
+                del _RUNNING_BATCHES[key]
+        batch.release(force=True)
+
+
+def _update_batched(task, vifs, options):
+    """Update the DHCP options of a node with those of other nodes.
+
+    :returns: the UUIDs of the ports whose VIF could not be updated.
+    """
+    api = NeutronAPI(ironic_context.get_admin_context())
+    key = api.client_key
+    with _BATCHES_LOCK:
+        batch = _BATCHES.get(key)
+        leader = batch is None
+        if leader:
+            batch = _BATCHES[key] = _DHCPBatch(api)
+            # NOTE: only wait for other deploys while others are being
+            #       done, a lone deploy is not delayed.
+            wait = _RUNNING_BATCHES[key] > 0
+        call = batch.add(vifs, options, _needs_wait(task))
+
+    if leader:
+        greenthread.spawn_n(_run_batch, key, batch, wait)
+    call.done.wait()
+
+    if call.error is not None:
+        six.reraise(*call.error)
+    return [port_id for port_id, port_vif in vifs.items()
+            if port_vif in call.failed]
@@ -15,6 +15,7 @@
 #    under the License.
 
 import os
+import threading
 
 import jinja2
 from oslo.config import cfg
@@ -30,6 +31,10 @@ LOG = logging.getLogger(__name__)
 
 PXE_CFG_DIR_NAME = 'pxelinux.cfg'
 
+_TEMPLATES_LOCK = threading.Lock()
+# path -> (modification time, compiled template) of the PXE templates
+_TEMPLATES = {}
+
 
 def _ensure_config_dirs_exist(node_uuid):
     """Ensure that the node's and PXE configuration directories exist.
@@ -53,24 +58,60 @@ def _build_pxe_config(pxe_options, template):
     :returns: A formatted string with the file content.
 
     """
+    return _get_template(template).render({'pxe_options': pxe_options,
+                                           'ROOT': '{{ ROOT }}'})
+
+
+def _get_template(template):
+    """Return a compiled template.
+
+    Templates are compiled once and reused until their file is modified.
+
+    :param template: path of the template.
+    :returns: a jinja2.Template.
+    """
+    mtime = os.stat(template).st_mtime
+    with _TEMPLATES_LOCK:
+        cached = _TEMPLATES.get(template)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
     tmpl_path, tmpl_file = os.path.split(template)
     env = jinja2.Environment(loader=jinja2.FileSystemLoader(tmpl_path))
-    template = env.get_template(tmpl_file)
-    return template.render({'pxe_options': pxe_options,
-                            'ROOT': '{{ ROOT }}'})
+    compiled = env.get_template(tmpl_file)
+    with _TEMPLATES_LOCK:
+        _TEMPLATES[template] = (mtime, compiled)
+    return compiled
 
 
 def _link_mac_pxe_configs(task):
     """Link each MAC address with the PXE configuration file.
 
+    Links already pointing to the configuration file are left untouched.
+    The others are replaced atomically, so a node booting meanwhile never
+    finds its link missing.
+
     :param task: A TaskManager instance.
 
     """
     pxe_config_file_path = get_pxe_config_file_path(task.node.uuid)
     for mac in driver_utils.get_node_mac_addresses(task):
         mac_path = _get_pxe_mac_path(mac)
-        utils.unlink_without_raise(mac_path)
-        utils.create_link_without_raise(pxe_config_file_path, mac_path)
+        try:
+            if os.readlink(mac_path) == pxe_config_file_path:
+                continue
+        except OSError:
+            pass
+        tmp_path = '%s.%s' % (mac_path, task.node.uuid)
+        utils.unlink_without_raise(tmp_path)
+        try:
+            os.symlink(pxe_config_file_path, tmp_path)
+            os.rename(tmp_path, mac_path)
+        except OSError as e:
+            LOG.warn(_("Failed to link %(link)s to %(config)s, error: "
+                       "%(e)s"), {'link': mac_path,
+                                  'config': pxe_config_file_path, 'e': e})
+            utils.unlink_without_raise(tmp_path)
 
 
 def _get_pxe_mac_path(mac):
@@ -34,6 +34,7 @@ import paramiko
 import six
 
 from ironic.common import exception
+from ironic.openstack.common import excutils
 from ironic.openstack.common import log as logging
 from ironic.openstack.common import processutils
 
@@ -457,8 +458,25 @@ def rmtree_without_raise(path):
 
 
 def write_to_file(path, contents):
-    with open(path, 'w') as f:
-        f.write(contents)
+    """Write contents to a file, replacing it atomically.
+
+    The contents are written to a temporary file in the same directory,
+    which is then renamed to path, so that readers of the file, like TFTP
+    servers, see either its former or its new contents.
+
+    :param path: path of the file.
+    :param contents: the new contents of the file.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.%s.%s' % (name, generate_uuid()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.rename(tmp_path, path)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            unlink_without_raise(tmp_path)
 
 
 def create_link_without_raise(source, link):
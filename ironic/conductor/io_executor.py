@@ -0,0 +1,236 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Executor of the bulk data-plane work of the conductor.
+
+Deployments fetch, convert and copy images, which keeps a conductor busy
+for minutes per node. Running that work in the pool of workers shared with
+power operations lets a mass deploy starve them, or have API calls fail
+with NoFreeConductorWorker. The conductor rather hands it to an IOExecutor,
+which runs a limited number of tasks at once and keeps the others waiting
+in a first-in first-out queue.
+
+The I/O scheduling priority of the conductor, inherited by the processes it
+runs such as qemu-img, can also be set with set_io_priority().
+"""
+
+import collections
+import os
+import threading
+import time
+
+from eventlet import greenpool
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic.common import utils
+from ironic.openstack.common import log as logging
+from ironic.openstack.common import processutils
+
+io_executor_opts = [
+    cfg.IntOpt('deploy_io_workers',
+               default=8,
+               help='Maximum number of deployment tasks, which fetch, '
+                    'convert and copy images, run at once by the '
+                    'conductor. Other deployment tasks wait for their turn '
+                    'in order of arrival.'),
+    cfg.IntOpt('deploy_io_queue_size',
+               default=16,
+               help='Maximum number of deployment tasks waiting for a '
+                    'deploy I/O worker, beyond which new ones are rejected '
+                    'with NoFreeConductorWorker. Waiting tasks keep their '
+                    'node locked. 0 means unlimited.'),
+    cfg.StrOpt('io_priority',
+               help='I/O scheduling class, and priority within the class, '
+                    'of the conductor and of the processes it runs, as '
+                    '"idle", "best-effort:<0-7>" or "realtime:<0-7>", 0 '
+                    'being the highest priority, for instance '
+                    '"best-effort:7". Set with ionice when the conductor '
+                    'starts. The default is left unchanged if unset.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(io_executor_opts, group='conductor')
+
+LOG = logging.getLogger(__name__)
+
+# ionice scheduling class of each value of CONF.conductor.io_priority
+IO_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+class _Work(object):
+    """A task submitted to an IOExecutor.
+
+    Stands for the greenthread running the task, which only exists once the
+    task left the queue.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.time()
+        self._thread = None
+        self._links = []
+        self._started = threading.Event()
+
+    def start(self, thread):
+        self._thread = thread
+        for func, args, kwargs in self._links:
+            thread.link(func, *args, **kwargs)
+        self._links = []
+        self._started.set()
+
+    def run(self):
+        waited = time.time() - self.submitted_at
+        if waited >= 1:
+            LOG.debug("Deploy I/O task %(func)s started after waiting "
+                      "%(waited).1f seconds.",
+                      {'func': getattr(self.func, '__name__', self.func),
+                       'waited': waited})
+        return self.func(*self.args, **self.kwargs)
+
+    def link(self, func, *args, **kwargs):
+        """Call func(thread, *args, **kwargs) once the task is over.
+
+        :param func: the callback, called with the greenthread which ran
+                     the task, as GreenThread.link() does.
+        """
+        if self._thread is None:
+            self._links.append((func, args, kwargs))
+        else:
+            self._thread.link(func, *args, **kwargs)
+
+    def wait(self):
+        """Wait for the task to be over and return its result."""
+        self._started.wait()
+        return self._thread.wait()
+
+
+class IOExecutor(object):
+    """Runs bulk data-plane tasks, a limited number at once, in FIFO order."""
+
+    def __init__(self, size=None, max_queue=None):
+        """Constructor.
+
+        :param size: maximum number of tasks run at once, defaults to
+                     CONF.conductor.deploy_io_workers.
+        :param max_queue: maximum number of waiting tasks, 0 for unlimited,
+                          defaults to CONF.conductor.deploy_io_queue_size.
+        """
+        if size is None:
+            size = CONF.conductor.deploy_io_workers
+        if max_queue is None:
+            max_queue = CONF.conductor.deploy_io_queue_size
+        self.size = size
+        self.max_queue = max_queue
+        self._pool = greenpool.GreenPool(size=size)
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) now or once the tasks before it ran.
+
+        Returns immediately.
+
+        :returns: an object which, like a GreenThread, has link() and wait()
+                  methods.
+        :raises: NoFreeConductorWorker if the queue is full.
+        """
+        work = _Work(func, args, kwargs)
+        with self._lock:
+            if not self._queue and self._pool.free():
+                self._start(work)
+                return work
+            if self.max_queue and len(self._queue) >= self.max_queue:
+                raise exception.NoFreeConductorWorker()
+            self._queue.append(work)
+            depth = len(self._queue)
+        LOG.info(_("All %(size)d deploy I/O workers are busy, queued "
+                   "%(func)s. %(depth)d deploy I/O task(s) waiting."),
+                 {'size': self.size, 'depth': depth,
+                  'func': getattr(func, '__name__', func)})
+        return work
+
+    def _start(self, work):
+        thread = self._pool.spawn(work.run)
+        # NOTE: linked after the pool's own callback, which frees the slot
+        # of the thread first.
+        thread.link(self._next)
+        work.start(thread)
+
+    def _next(self, thread):
+        with self._lock:
+            while self._queue and self._pool.free():
+                self._start(self._queue.popleft())
+
+    def stats(self):
+        """Return the numbers of running and waiting tasks.
+
+        :returns: a dictionary with the 'size' of the executor and the
+                  numbers of 'running' and 'queued' tasks.
+        """
+        with self._lock:
+            return {'size': self.size,
+                    'running': self._pool.running(),
+                    'queued': len(self._queue)}
+
+    def waitall(self):
+        """Wait until no task is running nor waiting."""
+        while True:
+            self._pool.waitall()
+            with self._lock:
+                if not self._queue and not self._pool.running():
+                    return
+
+
+def set_io_priority(priority=None):
+    """Set the I/O scheduling priority of the conductor.
+
+    The processes run by the conductor afterwards inherit it. Failures are
+    logged, the conductor keeps running with its former priority.
+
+    :param priority: "idle", "best-effort:<level>" or "realtime:<level>",
+                     defaults to CONF.conductor.io_priority. Nothing is done
+                     if it is empty.
+    """
+    if priority is None:
+        priority = CONF.conductor.io_priority
+    if not priority:
+        return
+
+    io_class, sep, level = priority.partition(':')
+    io_class = io_class.strip()
+    level = level.strip()
+    if io_class == 'idle':
+        valid = not level
+    else:
+        valid = (io_class in IO_CLASSES and
+                 level in [str(i) for i in range(8)])
+    if not valid:
+        LOG.warning(_("Invalid I/O priority %s, expected 'idle', "
+                      "'best-effort:<0-7>' or 'realtime:<0-7>'."), priority)
+        return
+
+    args = ['ionice', '-c', IO_CLASSES[io_class]]
+    if level:
+        args += ['-n', level]
+    try:
+        utils.execute(*(args + ['-p', str(os.getpid())]))
+    except (processutils.ProcessExecutionError, OSError) as e:
+        LOG.warning(_("Could not set the I/O priority of the conductor to "
+                      "%(priority)s: %(err)s"),
+                    {'priority': priority, 'err': e})
+    else:
+        LOG.info(_("I/O priority of the conductor set to %s."), priority)
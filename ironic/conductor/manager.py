@@ -50,11 +50,17 @@ from eventlet import greenpool
 from oslo.config import cfg
 from oslo import messaging
 
+from ironic.common import context as ironic_context
 from ironic.common import driver_factory
 from ironic.common import exception
 from ironic.common import hash_ring as hash
+from ironic.common import image_peer
+from ironic.common import keystone
 from ironic.common import neutron
 from ironic.common import states
+from ironic.conductor import io_executor
+from ironic.conductor import power_state_cache
+from ironic.conductor import power_timing
 from ironic.conductor import task_manager
 from ironic.conductor import utils
 from ironic.db import api as dbapi
@@ -90,6 +96,13 @@ conductor_opts = [
                    default=60,
                    help='Interval between checks of provision timeouts, '
                         'in seconds.'),
+        cfg.IntOpt('status_log_interval',
+                   default=600,
+                   help='Interval between logs of the status of the '
+                        'conductor, such as the usage of its deploy I/O '
+                        'workers and the observed power state transition '
+                        'times, in seconds. A negative value disables '
+                        'them.'),
         cfg.IntOpt('deploy_callback_timeout',
                    default=1800,
                    help='Timeout (seconds) for waiting callback from deploy '
@@ -120,17 +133,37 @@ conductor_opts = [
         cfg.IntOpt('node_locked_retry_interval',
                    default=1,
                    help='Seconds to sleep between node lock attempts.'),
+        cfg.IntOpt('image_prefetch_count',
+                   default=0,
+                   help='Number of the images most used by recently deployed '
+                        'nodes which every conductor fetches into its image '
+                        'caches ahead of deployments, per driver. When '
+                        'Glance uses the keystone auth strategy, images are '
+                        'fetched with a token of the admin credentials of '
+                        'the keystone_authtoken section, which must be '
+                        'allowed to read them. 0 disables image '
+                        'prefetching.'),
+        cfg.IntOpt('image_prefetch_nodes',
+                   default=100,
+                   help='Number of most recently deployed nodes whose images '
+                        'are considered for image prefetching.'),
+        cfg.IntOpt('image_prefetch_interval',
+                   default=600,
+                   help='Interval between image prefetching runs, in '
+                        'seconds.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(conductor_opts, 'conductor')
+CONF.import_opt('auth_strategy', 'ironic.common.image_service',
+                group='glance')
 
 
 class ConductorManager(periodic_task.PeriodicTasks):
     """Ironic Conductor manager main class."""
 
     # NOTE(rloo): This must be in sync with rpcapi.ConductorAPI's.
-    RPC_API_VERSION = '1.15'
+    RPC_API_VERSION = '1.16'
 
     target = messaging.Target(version=RPC_API_VERSION)
 
@@ -140,6 +173,8 @@ class ConductorManager(periodic_task.PeriodicTasks):
         self.host = host
         self.topic = topic
         self.power_state_sync_count = collections.defaultdict(int)
+        self._image_peer_server = None
+        """HTTP server sharing master images with other conductors."""
 
     def init_host(self):
         self.dbapi = dbapi.get_instance()
@@ -166,6 +201,18 @@ class ConductorManager(periodic_task.PeriodicTasks):
                                 size=CONF.conductor.workers_pool_size)
         """GreenPool of background workers for performing tasks async."""
 
+        self._io_executor = io_executor.IOExecutor()
+        """Executor of the bulk data-plane work, like deployments."""
+        io_executor.set_io_priority()
+
+        if image_peer.enabled():
+            self._image_peer_server = image_peer.ImagePeerServer()
+            self._image_peer_server.start()
+        elif CONF.conductor.image_peer_port > 0:
+            LOG.warning(_("Not sharing master images with the other "
+                          "conductors, [conductor]image_peer_secret is not "
+                          "set."))
+
         # Spawn a dedicated greenthread for the keepalive
         try:
             self._keepalive_evt = threading.Event()
@@ -180,6 +227,9 @@ class ConductorManager(periodic_task.PeriodicTasks):
 
     def del_host(self):
         self._keepalive_evt.set()
+        if self._image_peer_server is not None:
+            self._image_peer_server.stop()
+            self._image_peer_server = None
         try:
             self.dbapi.unregister_conductor(self.host)
             LOG.info(_LI('Successfully stopped conductor with hostname '
@@ -222,8 +272,7 @@ class ConductorManager(periodic_task.PeriodicTasks):
             #             instance_uuid needs to be unset, and handle it.
             if 'instance_uuid' in delta:
                 task.driver.power.validate(task)
-                node_obj['power_state'] = \
-                        task.driver.power.get_power_state(task)
+                node_obj['power_state'] = utils.node_get_power_state(task)
 
                 if node_obj['power_state'] != states.POWER_OFF:
                     raise exception.NodeInWrongPowerState(
@@ -298,7 +347,10 @@ class ConductorManager(periodic_task.PeriodicTasks):
 
             task.driver.vendor.validate(task, method=driver_method,
                                         **info)
-            task.spawn_after(self._spawn_worker,
+            spawn = self._spawn_worker
+            if task.driver.vendor.is_bulk_io(driver_method):
+                spawn = self._spawn_io_worker
+            task.spawn_after(spawn,
                              task.driver.vendor.vendor_passthru, task,
                              method=driver_method, **info)
 
@@ -340,6 +392,41 @@ class ConductorManager(periodic_task.PeriodicTasks):
                                                     method=driver_method,
                                                     **info)
 
+    @messaging.expected_exceptions(exception.NoFreeConductorWorker,
+                                   exception.DriverNotFound)
+    def warm_image_cache(self, context, driver_name, image_hrefs):
+        """RPC method to fetch images into this conductor's image caches.
+
+        The images are fetched in a background task, so that they are
+        already cached when nodes are deployed with them.
+
+        :param context: an admin context.
+        :param driver_name: name of the driver whose image caches to fill.
+        :param image_hrefs: list of image hrefs.
+        :raises: DriverNotFound if the supplied driver is not loaded.
+        :raises: NoFreeConductorWorker when there is no free worker to start
+                 async task.
+
+        """
+        LOG.debug("RPC warm_image_cache for driver %s." % driver_name)
+        try:
+            driver = self.driver_factory[driver_name].obj
+        except KeyError:
+            raise exception.DriverNotFound(driver_name=driver_name)
+
+        self._spawn_worker(self._do_warm_image_cache, context, driver_name,
+                           driver, image_hrefs)
+
+    def _do_warm_image_cache(self, context, driver_name, driver, image_hrefs):
+        try:
+            driver.deploy.cache_images(context, image_hrefs)
+        except exception.UnsupportedDriverExtension:
+            LOG.info(_("Driver %s does not support caching images, "
+                       "skipping image cache warm-up.") % driver_name)
+        except Exception:
+            LOG.exception(_("Error while warming the image caches of "
+                            "driver %s.") % driver_name)
+
     @messaging.expected_exceptions(exception.NoFreeConductorWorker,
                                    exception.NodeLocked,
                                    exception.NodeInMaintenance,
@@ -400,7 +487,7 @@ class ConductorManager(periodic_task.PeriodicTasks):
             node.target_provision_state = states.DEPLOYDONE
             node.last_error = None
             node.save(context)
-            task.spawn_after(self._spawn_worker, self._do_node_deploy,
+            task.spawn_after(self._spawn_io_worker, self._do_node_deploy,
                              context, task)
 
     def _do_node_deploy(self, context, task):
@@ -536,7 +623,7 @@ class ConductorManager(periodic_task.PeriodicTasks):
                 return
 
         try:
-            power_state = task.driver.power.get_power_state(task)
+            power_state = utils.node_get_power_state(task)
         except Exception as e:
             # TODO(rloo): change to IronicException, after
             #             https://bugs.launchpad.net/ironic/+bug/1267693
@@ -708,6 +795,74 @@ class ConductorManager(periodic_task.PeriodicTasks):
             if workers_count == CONF.conductor.periodic_max_workers:
                 break
 
+    @periodic_task.periodic_task(
+            spacing=CONF.conductor.status_log_interval)
+    def _log_status(self, context):
+        """Periodic task to log the status of the conductor."""
+        LOG.info(_("Deploy I/O workers: %(running)d of %(size)d busy, "
+                   "%(queued)d deploy I/O task(s) waiting."),
+                 self._io_executor.stats())
+        if CONF.conductor.power_state_cache_ttl > 0:
+            LOG.info(_("Power state cache: %(hits)d hit(s), %(misses)d "
+                       "miss(es), %(size)d node(s) cached."),
+                     power_state_cache.get_cache().stats())
+        times = power_timing.get_transition_times().stats()
+        for model, states_times in sorted(times.items()):
+            for state, summary in sorted(states_times.items()):
+                LOG.info(_("Power state transitions of %(model)s to "
+                           "%(state)s: %(count)d observed, taking "
+                           "%(p50).1f, %(p90).1f and %(p99).1f seconds at "
+                           "the 50th, 90th and 99th percentiles."),
+                         dict(summary, model=model, state=state))
+
+    @periodic_task.periodic_task(
+            spacing=CONF.conductor.image_prefetch_interval)
+    def _prefetch_images(self, context):
+        """Periodic task to keep the most used images cached.
+
+        Looks at the images of the most recently deployed nodes, and fetches
+        the most used ones into the image caches of this conductor, for
+        each driver it supports.
+        """
+        count = CONF.conductor.image_prefetch_count
+        if count <= 0:
+            return
+
+        if CONF.glance.auth_strategy == 'keystone':
+            # NOTE: the context of periodic tasks has no token Glance
+            #       would accept.
+            try:
+                token = keystone.get_admin_auth_token()
+            except exception.IronicException as e:
+                LOG.warning(_("Not prefetching images, could not get a "
+                              "token for the admin credentials: %s"), e)
+                return
+            context = ironic_context.RequestContext(auth_token=token,
+                                                    is_admin=True)
+
+        filters = {'provision_state': states.ACTIVE}
+        columns = ['driver', 'instance_info']
+        node_list = self.dbapi.get_nodeinfo_list(
+                                    columns=columns,
+                                    filters=filters,
+                                    limit=CONF.conductor.image_prefetch_nodes,
+                                    sort_key='provision_updated_at',
+                                    sort_dir='desc')
+
+        usage = collections.defaultdict(collections.Counter)
+        for driver, instance_info in node_list:
+            image_source = (instance_info or {}).get('image_source')
+            if driver in self.drivers and image_source:
+                usage[driver][image_source] += 1
+
+        for driver_name, counter in usage.items():
+            image_hrefs = [image for image, uses
+                           in counter.most_common(count)]
+            try:
+                self.warm_image_cache(context, driver_name, image_hrefs)
+            except exception.NoFreeConductorWorker:
+                break
+
     def rebalance_node_ring(self):
         """Perform any actions necessary when rebalancing the consistent hash.
 
@@ -813,6 +968,21 @@ class ConductorManager(periodic_task.PeriodicTasks):
         else:
             raise exception.NoFreeConductorWorker()
 
+    def _spawn_io_worker(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) with the deploy I/O executor.
+
+        Bulk data-plane work, like fetching and copying images, is run
+        by a separate executor so as not to starve the worker pool. It
+        is queued if all the deploy I/O workers are busy. Execution
+        control returns immediately to the caller.
+
+        :returns: an object with the link() and wait() methods of a
+                  GreenThread.
+        :raises: NoFreeConductorWorker if the queue of the executor is full.
+
+        """
+        return self._io_executor.submit(func, *args, **kwargs)
+
     @messaging.expected_exceptions(exception.NodeLocked,
                                    exception.NodeAssociated,
                                    exception.NodeInWrongPowerState)
@@ -839,6 +1009,7 @@ class ConductorManager(periodic_task.PeriodicTasks):
             # FIXME(comstud): Remove context argument after we ensure
             # every instantiation of Node includes the context
             node.destroy(context)
+            power_state_cache.get_cache().invalidate(node.uuid)
             LOG.info(_LI('Successfully deleted node %(node)s.'),
                      {'node': node.uuid})
 
@@ -0,0 +1,117 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Conductor-local cache of node power states.
+
+Power state queries go out to the node's BMC, which is slow and, on some
+hardware, fragile. Several code paths (API requests, the periodic
+_sync_power_states task, power actions) tend to ask for the power state of
+the same node within a very short time. This cache remembers the last known
+power state of each node, keyed by node UUID, so that those callers can share
+a single BMC query.
+"""
+
+import threading
+import time
+
+from oslo.config import cfg
+
+power_state_cache_opts = [
+    cfg.IntOpt('power_state_cache_ttl',
+               default=0,
+               help='Number of seconds a power state read from a node\'s '
+                    'BMC is considered fresh and may be returned from the '
+                    'conductor\'s power state cache instead of querying the '
+                    'BMC again. Power actions performed by the conductor '
+                    'update the cache. 0 disables caching.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(power_state_cache_opts, group='conductor')
+
+
+class PowerStateCache(object):
+    """Cache of the last known power state of each node."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, node_uuid, max_age=None):
+        """Get the cached power state of a node.
+
+        :param node_uuid: the UUID of the node.
+        :param max_age: the maximum age (in seconds) of a cached entry which
+                        is acceptable to the caller. 0 means that the caller
+                        needs a fresh answer from the BMC.
+                        Default: CONF.conductor.power_state_cache_ttl
+        :returns: one of ironic.common.states, or None if there is no entry
+                  which is fresh enough.
+        """
+        if max_age is None:
+            max_age = CONF.conductor.power_state_cache_ttl
+
+        with self._lock:
+            entry = self._entries.get(node_uuid)
+            if (max_age > 0 and entry is not None
+                    and time.time() - entry[1] <= max_age):
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, node_uuid, power_state):
+        """Record the power state of a node.
+
+        :param node_uuid: the UUID of the node.
+        :param power_state: one of ironic.common.states.
+        """
+        with self._lock:
+            self._entries[node_uuid] = (power_state, time.time())
+
+    def invalidate(self, node_uuid):
+        """Forget the power state of a node.
+
+        :param node_uuid: the UUID of the node.
+        """
+        with self._lock:
+            self._entries.pop(node_uuid, None)
+
+    def clear(self):
+        """Forget the power state of all nodes and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the cache counters.
+
+        :returns: a dictionary with the number of cache 'hits' and 'misses',
+                  and the number of nodes currently in the cache ('size').
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries)}
+
+
+_CACHE = PowerStateCache()
+
+
+def get_cache():
+    """Return the power state cache of this conductor."""
+    return _CACHE
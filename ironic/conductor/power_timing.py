@@ -0,0 +1,194 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Conductor-local record of how long power state transitions take.
+
+Power drivers change a node's power state and then poll the BMC until the
+change is visible. How long that takes depends mostly on the hardware: some
+BMCs report the new state within a second, others need most of a minute.
+This module keeps, for each hardware model (the node's driver plus its
+properties) and each target power state, a window of the most recently
+observed transition times. Power drivers use the learned percentiles to
+delay their first poll, and back off from there.
+
+A transition seen at the first poll may have completed long before it, so
+the time recorded for it is only an upper bound. To let the learned times
+come down again when the hardware gets faster, the first poll is issued at
+a fraction of the learned percentile rather than at the percentile itself.
+"""
+
+import collections
+import threading
+
+from oslo.config import cfg
+
+power_timing_opts = [
+    cfg.BoolOpt('adaptive_power_polling',
+                default=True,
+                help='Whether power drivers which support it should delay '
+                     'the first power state poll after a power action '
+                     'until the transition is expected to have completed, '
+                     'based on the transition times previously observed '
+                     'on nodes with the same driver and properties.'),
+    cfg.IntOpt('power_timing_samples',
+               default=100,
+               help='Number of most recent power state transition times '
+                    'kept for each hardware model and target power state.'),
+    cfg.IntOpt('power_timing_min_samples',
+               default=5,
+               help='Minimum number of observed power state transitions '
+                    'for a hardware model before adaptive power polling '
+                    'is used for it.'),
+    cfg.IntOpt('power_timing_percentile',
+               default=50,
+               help='Percentile of the observed power state transition '
+                    'times, half of which is the delay of the first power '
+                    'state poll when adaptive power polling is used.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(power_timing_opts, group='conductor')
+
+# Percentiles reported by TransitionTimes.stats().
+REPORTED_PERCENTILES = (50, 90, 99)
+
+# Fraction of the learned percentile at which the first poll is issued.
+FIRST_POLL_FRACTION = 0.5
+
+
+def model_key(node):
+    """Return the key identifying the hardware model of a node.
+
+    Nodes with the same driver and the same properties are assumed to be
+    the same model of hardware, and hence to take about the same time to
+    change their power state.
+
+    :param node: a Node object.
+    :returns: a string.
+    """
+    properties = node.properties or {}
+    return '%s:%s' % (node.driver,
+                      ','.join('%s=%s' % item
+                               for item in sorted(properties.items())))
+
+
+def _percentile(sorted_samples, percentile):
+    """Nearest-rank percentile of a non-empty sorted list."""
+    rank = int(round(percentile / 100.0 * len(sorted_samples)))
+    rank = min(max(rank, 1), len(sorted_samples))
+    return sorted_samples[rank - 1]
+
+
+class TransitionTimes(object):
+    """Observed power state transition times, per hardware model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, model, target_state, duration):
+        """Record how long a power state transition took.
+
+        :param model: the hardware model, as returned by model_key().
+        :param target_state: the target power state, one of
+                             ironic.common.states.
+        :param duration: the time, in seconds, it took between issuing the
+                         power action and seeing the target power state.
+        """
+        with self._lock:
+            samples = self._samples.get((model, target_state))
+            if samples is None:
+                samples = collections.deque(
+                    maxlen=max(CONF.conductor.power_timing_samples, 1))
+                self._samples[(model, target_state)] = samples
+            samples.append(duration)
+
+    def percentile(self, model, target_state, percentile):
+        """Return a percentile of the observed transition times.
+
+        :param model: the hardware model, as returned by model_key().
+        :param target_state: the target power state, one of
+                             ironic.common.states.
+        :param percentile: the percentile, between 0 and 100.
+        :returns: the transition time in seconds, or None if fewer than
+                  CONF.conductor.power_timing_min_samples transitions have
+                  been observed.
+        """
+        with self._lock:
+            samples = sorted(self._samples.get((model, target_state), ()))
+        if len(samples) < max(CONF.conductor.power_timing_min_samples, 1):
+            return None
+        return _percentile(samples, percentile)
+
+    def first_poll_delay(self, model, target_state, default, maximum=None):
+        """Return how long to wait before polling for a transition.
+
+        That is FIRST_POLL_FRACTION of the learned percentile of the
+        transition times, so that the transitions faster than the learned
+        ones are still observed as such.
+
+        :param model: the hardware model, as returned by model_key().
+        :param target_state: the target power state, one of
+                             ironic.common.states.
+        :param default: the delay to use when adaptive polling is disabled
+                        or not enough transitions have been observed.
+        :param maximum: if not None, the largest delay to return.
+        :returns: the delay in seconds.
+        """
+        delay = None
+        if CONF.conductor.adaptive_power_polling and model is not None:
+            delay = self.percentile(model, target_state,
+                                    CONF.conductor.power_timing_percentile)
+        if delay is not None:
+            delay *= FIRST_POLL_FRACTION
+        else:
+            delay = default
+        if maximum is not None:
+            delay = min(delay, maximum)
+        return delay
+
+    def clear(self):
+        """Forget all observed transition times."""
+        with self._lock:
+            self._samples.clear()
+
+    def stats(self):
+        """Return a summary of the observed transition times.
+
+        :returns: a dictionary mapping each hardware model to a dictionary
+                  mapping each target power state to the number of observed
+                  transitions ('count') and the 50th, 90th and 99th
+                  percentiles of the transition times ('p50', 'p90',
+                  'p99').
+        """
+        with self._lock:
+            items = [(key, sorted(samples))
+                     for key, samples in self._samples.items()]
+        result = {}
+        for (model, target_state), samples in items:
+            if not samples:
+                continue
+            summary = {'count': len(samples)}
+            for percentile in REPORTED_PERCENTILES:
+                summary['p%d' % percentile] = _percentile(samples, percentile)
+            result.setdefault(model, {})[target_state] = summary
+        return result
+
+
+_TRANSITION_TIMES = TransitionTimes()
+
+
+def get_transition_times():
+    """Return the power state transition times of this conductor."""
+    return _TRANSITION_TIMES
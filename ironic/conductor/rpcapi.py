@@ -53,11 +53,12 @@ class ConductorAPI(object):
         1.13 - Added update_port.
         1.14 - Added driver_vendor_passthru.
         1.15 - Added rebuild parameter to do_node_deploy.
+        1.16 - Added warm_image_cache.
 
     """
 
     # NOTE(rloo): This must be in sync with manager.ConductorManager's.
-    RPC_API_VERSION = '1.15'
+    RPC_API_VERSION = '1.16'
 
     def __init__(self, topic=None):
         super(ConductorAPI, self).__init__()
@@ -105,6 +106,18 @@ class ConductorAPI(object):
         host = random.choice(hash_ring.hosts)
         return self.topic + "." + host
 
+    def get_topics_for_driver(self, driver_name):
+        """Get the RPC topics of all the conductors which support the
+        specified driver.
+
+        :param driver_name: the name of the driver to route to.
+        :returns: a list of RPC topic strings.
+        :raises: DriverNotFound
+
+        """
+        hash_ring = self.ring_manager.get_hash_ring(driver_name)
+        return [self.topic + "." + host for host in hash_ring.hosts]
+
     def update_node(self, context, node_obj, topic=None):
         """Synchronously, have a conductor update the node's information.
 
@@ -184,6 +197,21 @@ class ConductorAPI(object):
                           driver_method=driver_method,
                           info=info)
 
+    def warm_image_cache(self, context, driver_name, image_hrefs,
+                         topic=None):
+        """Asynchronously, have a conductor fetch images into the image
+        caches of a driver.
+
+        :param context: request context.
+        :param driver_name: name of the driver whose image caches to fill.
+        :param image_hrefs: list of image hrefs.
+        :param topic: RPC topic. Defaults to self.topic.
+
+        """
+        cctxt = self.client.prepare(topic=topic or self.topic, version='1.16')
+        cctxt.cast(context, 'warm_image_cache', driver_name=driver_name,
+                   image_hrefs=image_hrefs)
+
     def do_node_deploy(self, context, node_id, rebuild, topic=None):
         """Signal to conductor service to perform a deployment.
 
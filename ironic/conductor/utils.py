@@ -14,6 +14,7 @@
 
 from ironic.common import exception
 from ironic.common import states
+from ironic.conductor import power_state_cache
 from ironic.conductor import task_manager
 from ironic.openstack.common import excutils
 from ironic.openstack.common.gettextutils import _LI
@@ -53,6 +54,40 @@ def node_set_boot_device(task, device, persistent=False):
         pass
 
 
+def node_get_power_state(task, max_age=None):
+    """Get the power state of a node, from the power state cache if possible.
+
+    Returns the cached power state of the task's node if the cache holds an
+    entry which is not older than max_age seconds, otherwise asks the node's
+    power driver and records the answer in the cache.
+
+    :param task: a TaskManager instance containing the node to act on.
+    :param max_age: the maximum age (in seconds) of a cached power state
+        which is acceptable to the caller. 0 forces a query to the power
+        driver. Default: CONF.conductor.power_state_cache_ttl.
+    :returns: one of ironic.common.states POWER_OFF, POWER_ON or ERROR.
+    :raises: any exception raised by the power driver's get_power_state().
+
+    """
+    cache = power_state_cache.get_cache()
+    node_uuid = task.node.uuid
+    power_state = cache.get(node_uuid, max_age=max_age)
+    if power_state is not None:
+        return power_state
+
+    try:
+        power_state = task.driver.power.get_power_state(task)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            cache.invalidate(node_uuid)
+
+    if power_state == states.ERROR:
+        cache.invalidate(node_uuid)
+    else:
+        cache.set(node_uuid, power_state)
+    return power_state
+
+
 @task_manager.require_exclusive_lock
 def node_power_action(task, state):
     """Change power state or reset for a node.
@@ -75,7 +110,7 @@ def node_power_action(task, state):
 
     if state != states.REBOOT:
         try:
-            curr_state = task.driver.power.get_power_state(task)
+            curr_state = node_get_power_state(task)
         except Exception as e:
             with excutils.save_and_reraise_exception():
                 node['last_error'] = \
@@ -109,6 +144,7 @@ def node_power_action(task, state):
     node.save(context)
 
     # take power action
+    cache = power_state_cache.get_cache()
     try:
         if state != states.REBOOT:
             task.driver.power.set_power_state(task, new_state)
@@ -116,6 +152,7 @@ def node_power_action(task, state):
             task.driver.power.reboot(task)
     except Exception as e:
         with excutils.save_and_reraise_exception():
+            cache.invalidate(node.uuid)
             node['last_error'] = \
                 _("Failed to change power state to '%(target)s'. "
                   "Error: %(error)s") % {
@@ -123,6 +160,7 @@ def node_power_action(task, state):
     else:
         # success!
         node['power_state'] = new_state
+        cache.set(node.uuid, new_state)
         LOG.info(_LI('Succesfully set node %(node)s power state to '
                      '%(state)s.'),
                  {'node': node.uuid, 'state': new_state})
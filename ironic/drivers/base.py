@@ -206,6 +206,20 @@ class DeployInterface(object):
         :param task: a TaskManager instance containing the node to act on.
         """
 
+    def cache_images(self, context, image_hrefs):
+        """Fetch images into this conductor's image caches ahead of time.
+
+        Deploying a node whose images are already in the conductor's caches
+        does not have to wait for them to be downloaded. DeployInterface
+        subclasses are not required to implement this.
+
+        :param context: a context for this action.
+        :param image_hrefs: a list of image hrefs, as they would appear in
+                            a node's instance_info['image_source'].
+        """
+        raise exception.UnsupportedDriverExtension(
+            _('Deploy interface does not support caching images.'))
+
 
 @six.add_metaclass(abc.ABCMeta)
 class PowerInterface(object):
@@ -385,6 +399,18 @@ class VendorInterface(object):
         :raises: InvalidParameterValue if **kwargs does not contain 'method'.
         """
 
+    def is_bulk_io(self, method):
+        """Whether a vendor passthru method does bulk data-plane work.
+
+        The conductor runs such methods, for instance copying an image to
+        the node's disk, with its deploy I/O executor rather than with the
+        workers running power actions.
+
+        :param method: name of the vendor passthru method.
+        :returns: False, unless overridden.
+        """
+        return False
+
     def driver_vendor_passthru(self, context, method, **kwargs):
         """Handle top-level (ie, no node is specified) vendor actions. These
         allow a vendor interface to expose additional cross-node API
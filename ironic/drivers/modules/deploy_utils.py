@@ -14,22 +14,120 @@
 #    under the License.
 
 
+import errno
+import fcntl
+import io
+import mmap
 import os
 import re
+import shutil
 import socket
 import stat
+import struct
+import sys
+import tempfile
+import threading
 import time
 
+from eventlet import tpool
+from oslo.config import cfg
+import six
+
+from ironic.common import deploy_trace
 from ironic.common import disk_partitioner
 from ironic.common import exception
+from ironic.common import images
 from ironic.common import utils
 from ironic.openstack.common import excutils
 from ironic.openstack.common import log as logging
 from ironic.openstack.common import processutils
 
 
+deploy_opts = [
+    cfg.BoolOpt('sparse_copy',
+                default=True,
+                help='Copy images to the nodes\' disks by writing only their '
+                     'data extents and skipping holes and blocks of zeros, '
+                     'instead of running dd over the whole image. The '
+                     'conductor needs write access to the iSCSI devices; '
+                     'dd is used when it does not have it.'),
+    cfg.StrOpt('sparse_copy_holes',
+               default='zero',
+               help='What to do with the ranges of the disk matching holes '
+                    'and blocks of zeros of the image when copying it '
+                    'sparsely: "zero" zeroes them, offloading it to the '
+                    'device when possible, "discard" discards them and '
+                    '"skip" discards the whole range of the disk the image '
+                    'is copied to beforehand, then leaves them untouched. '
+                    '"discard" and "skip" fall back to "zero" for disks '
+                    'whose discarded blocks are not guaranteed to read back '
+                    'as zeros.'),
+    cfg.IntOpt('copy_buffer_mb',
+               default=8,
+               help='Size (in MiB) of the buffer images are copied to the '
+                    'nodes\' disks with, bypassing the page cache.'),
+    cfg.IntOpt('fanout_window',
+               default=0,
+               help='Number of seconds the first deploy of an image waits '
+                    'for other deploys of the same image, before copying the '
+                    'image to the disks of all of them in a single pass over '
+                    'the image. 0 disables grouping deploys.'),
+    cfg.IntOpt('copy_bandwidth',
+               default=0,
+               help='Maximum aggregate bandwidth, in MiB per second, at '
+                    'which the conductor writes images to the nodes\' '
+                    'disks, across all the deploys it runs. Only applies to '
+                    'sparse copies, not to dd nor to the conversion of '
+                    'non-raw images. 0 means unlimited.'),
+    cfg.IntOpt('notify_timeout',
+               default=60,
+               help='Maximum time, in seconds, to keep trying to connect to '
+                    'the deploy ramdisk to tell it the deployment is done, '
+                    'before failing the deployment.'),
+    cfg.FloatOpt('notify_retry_interval',
+                 default=0.1,
+                 help='Time, in seconds, to wait before the second attempt '
+                      'to connect to the deploy ramdisk. The interval '
+                      'doubles after every attempt, up to '
+                      'notify_max_retry_interval.'),
+    cfg.FloatOpt('notify_max_retry_interval',
+                 default=2.0,
+                 help='Maximum time, in seconds, between two attempts to '
+                      'connect to the deploy ramdisk.'),
+]
+
+CONF = cfg.CONF
+opt_group = cfg.OptGroup(name='deploy',
+                         title='Options for copying images to nodes')
+CONF.register_group(opt_group)
+CONF.register_opts(deploy_opts, opt_group)
+
 LOG = logging.getLogger(__name__)
 
+# Limits the bandwidth of all the copies to CONF.deploy.copy_bandwidth
+_COPY_THROTTLE = images.Throttle(lambda: CONF.deploy.copy_bandwidth)
+
+# Python 2 does not define these, values for Linux
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+# ioctls of linux/fs.h
+BLKDISCARD = 0x1277
+BLKDISCARDZEROES = 0x127c
+BLKZEROOUT = 0x127f
+
+# Alignment of the writes made with O_DIRECT
+COPY_ALIGNMENT = 4096
+# Granularity at which blocks of zeros are detected in image data
+ZERO_BLOCK_SIZE = 64 * 1024
+_ZERO_BLOCK = b'\0' * ZERO_BLOCK_SIZE
+# Root device placeholder and default entry of PXE configurations
+_ROOT_RE = re.compile(r'\{\{ ROOT \}\}')
+_DEFAULT_RE = re.compile('^default .*$', re.MULTILINE)
+# Beginning of the disk held by an image looked at for a partition table,
+# large enough for file system superblocks too
+PARTITION_TABLE_SIZE = 1024 * 1024
+
 
 # All functions are called from deploy() directly or indirectly.
 # They are split for stub-out.
@@ -132,8 +230,29 @@ def is_block_device(dev):
     return stat.S_ISBLK(s.st_mode)
 
 
-def has_partition_table(dev):
-    return disk_partitioner.get_partition_table(dev) != 'loop'
+def has_partition_table(image_path):
+    """Check whether an image holds a whole disk, with a partition table.
+
+    The beginning of images which are not raw is read into a temporary raw
+    image, for parted to look at.
+    """
+    info = images.sniff_image_info(image_path)
+    head = None
+    if info is not None and info.file_format != 'raw':
+        head = images.read_image_head(image_path, PARTITION_TABLE_SIZE)
+    if head is None:
+        return disk_partitioner.get_partition_table(image_path) != 'loop'
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        head_path = os.path.join(tmp_dir, 'head')
+        with open(head_path, 'wb') as head_file:
+            head_file.write(head)
+            # NOTE: parted expects the backup GPT at the end of the disk
+            head_file.truncate(info.virtual_size)
+        return disk_partitioner.get_partition_table(head_path) != 'loop'
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 def dd(src, dst):
@@ -147,6 +266,376 @@ def dd(src, dst):
                   check_exit_code=[0])
 
 
+def _data_extents(fd, size):
+    """Yield the (offset, length) of the data extents of a file.
+
+    Holes are found with SEEK_DATA and SEEK_HOLE. If the file system does
+    not support them, the whole file is a single data extent.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data after offset
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            yield offset, size - offset
+            return
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _nonzero_runs(buf, count):
+    """Yield the (start, end) of the runs of non-zero blocks of a buffer."""
+    run_start = None
+    for start in range(0, count, ZERO_BLOCK_SIZE):
+        end = min(start + ZERO_BLOCK_SIZE, count)
+        if buf[start:end] == _ZERO_BLOCK[:end - start]:
+            if run_start is not None:
+                yield run_start, start
+                run_start = None
+        elif run_start is None:
+            run_start = start
+    if run_start is not None:
+        yield run_start, count
+
+
+def _set_direct(fd, direct):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if direct:
+        flags |= O_DIRECT
+    else:
+        flags &= ~O_DIRECT
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def _write_all(fd, offset, buf, start, end):
+    os.lseek(fd, offset, os.SEEK_SET)
+    while start < end:
+        start += os.write(fd, buffer(buf, start, end - start))
+
+
+def _write_at(fd, offset, buf, start, length):
+    _COPY_THROTTLE.consume(length)
+    # NOTE: O_DIRECT would reject unaligned writes, like the tail of an
+    # image, they are made through the page cache.
+    direct = (length % COPY_ALIGNMENT and
+              fcntl.fcntl(fd, fcntl.F_GETFL) & O_DIRECT)
+    if direct:
+        _set_direct(fd, False)
+    try:
+        tpool.execute(_write_all, fd, offset, buf, start, start + length)
+    finally:
+        if direct:
+            _set_direct(fd, True)
+
+
+def _discard_zeroes_data(fd):
+    """Whether the discarded blocks of a block device read back as zeros."""
+    try:
+        result = fcntl.ioctl(fd, BLKDISCARDZEROES, struct.pack('I', 0))
+    except IOError:
+        return False
+    return struct.unpack('I', result)[0] == 1
+
+
+def _fill_hole(fd, offset, length, holes, zeros):
+    """Discard or zero a range of the target of a sparse copy.
+
+    Ranges which cannot be discarded are zeroed, and ranges which cannot be
+    zeroed by the device are written zeros to.
+    """
+    if length <= 0 or holes == 'skip':
+        return
+    requests = [BLKZEROOUT]
+    if holes == 'discard':
+        requests.insert(0, BLKDISCARD)
+    for request in requests:
+        try:
+            tpool.execute(fcntl.ioctl, fd, request,
+                          struct.pack('QQ', offset, length))
+            return
+        except IOError as e:
+            LOG.debug("Could not %(action)s %(length)d bytes at "
+                      "%(offset)d: %(err)s",
+                      {'action': 'discard' if request == BLKDISCARD
+                       else 'zero', 'length': length, 'offset': offset,
+                       'err': e})
+    end = offset + length
+    while offset < end:
+        count = min(len(zeros), end - offset)
+        _write_at(fd, offset, zeros, 0, count)
+        offset += count
+
+
+class _CopyTarget(object):
+    """A device an image is being copied to by _copy_to_targets()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.is_block_device = False
+        # what to do with the holes of the image, see _fill_hole()
+        self.holes = 'zero'
+        self.written = 0
+        # exception which stopped the copy to this device
+        self.error = None
+        # set once the copy to this device is over
+        self.done = threading.Event()
+
+    def open(self, size, holes):
+        try:
+            self.fd = os.open(self.path,
+                              os.O_WRONLY | os.O_CREAT | O_DIRECT, 0o644)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # file systems like tmpfs do not support O_DIRECT
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.is_block_device = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        if not self.is_block_device:
+            # NOTE: the holes of a truncated file read back as zeros
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+            self.holes = 'skip'
+            return
+        self.holes = holes
+        if holes == 'zero':
+            return
+        if not _discard_zeroes_data(self.fd):
+            LOG.debug("Discarded blocks of %s may not read back as zeros, "
+                      "zeroing the holes of the image instead.", self.path)
+            self.holes = 'zero'
+        elif holes == 'skip' and size:
+            try:
+                tpool.execute(fcntl.ioctl, self.fd, BLKDISCARD,
+                              struct.pack('QQ', 0, size))
+            except IOError as e:
+                LOG.debug("Could not discard %(dst)s, zeroing the holes of "
+                          "the image instead: %(err)s",
+                          {'dst': self.path, 'err': e})
+                self.holes = 'zero'
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _copy_to_targets(src, targets, holes, buffer_size):
+    """Copy an image to several devices, reading it once.
+
+    A failure to write to a device stops the copy to this device only, the
+    exception is stored in the error attribute of its target.
+
+    Reads, writes and other blocking calls are made in eventlet's pool of
+    native threads, so that the copy does not stall the other green threads
+    of the conductor.
+
+    :returns: The size of the image.
+    """
+    # NOTE: anonymous mappings are page aligned, as O_DIRECT requires.
+    buf = mmap.mmap(-1, buffer_size)
+    zeros = mmap.mmap(-1, buffer_size)
+
+    def _for_each_target(func, *args):
+        for target in targets:
+            if target.error is not None:
+                continue
+            try:
+                func(target, *args)
+            except (IOError, OSError) as e:
+                LOG.error(_("Failed to copy image %(src)s to %(dst)s: "
+                            "%(err)s"), {'src': src, 'dst': target.path,
+                                         'err': e})
+                target.error = e
+                target.close()
+
+    def _write_run(target, hole_start, offset, run_start, length):
+        _fill_hole(target.fd, hole_start, offset + run_start - hole_start,
+                   target.holes, zeros)
+        _write_at(target.fd, offset + run_start, buf, run_start, length)
+        target.written += length
+
+    def _finish(target, hole_start, size):
+        _fill_hole(target.fd, hole_start, size - hole_start, target.holes,
+                   zeros)
+        tpool.execute(os.fsync, target.fd)
+
+    try:
+        with io.FileIO(src, 'rb') as src_file:
+            size = os.fstat(src_file.fileno()).st_size
+            _for_each_target(_CopyTarget.open, size, holes)
+            # end of the data written so far
+            position = 0
+            for start, length in _data_extents(src_file.fileno(), size):
+                end = start + length
+                end = min(end + -end % COPY_ALIGNMENT, size)
+                start = max(start - start % COPY_ALIGNMENT, position)
+                for offset in range(start, end, buffer_size):
+                    if all(t.error is not None for t in targets):
+                        return size
+                    src_file.seek(offset)
+                    count = min(tpool.execute(src_file.readinto, buf),
+                                end - offset)
+                    for run_start, run_end in _nonzero_runs(buf, count):
+                        _for_each_target(_write_run, position, offset,
+                                         run_start, run_end - run_start)
+                        position = offset + run_end
+            _for_each_target(_finish, position, size)
+    finally:
+        for target in targets:
+            target.close()
+    return size
+
+
+def sparse_copy(src, dst, holes=None, buffer_size=None):
+    """Copy an image to a device, writing only its data.
+
+    Only the data extents of the image are read, and blocks of zeros within
+    them are skipped as well. Data is written with O_DIRECT through a large
+    page aligned buffer.
+
+    :param src: Path of the image.
+    :param dst: Path of the device, or of a file.
+    :param holes: What to do with the ranges of the device matching holes of
+        the image, 'zero', 'discard' or 'skip', as described for
+        CONF.deploy.sparse_copy_holes, which it defaults to.
+    :param buffer_size: Size of the copy buffer in bytes, a multiple of
+        COPY_ALIGNMENT. Defaults to CONF.deploy.copy_buffer_mb MiB.
+    :returns: The number of bytes of data written.
+    """
+    if holes is None:
+        holes = CONF.deploy.sparse_copy_holes
+    if buffer_size is None:
+        buffer_size = CONF.deploy.copy_buffer_mb * 1024 * 1024
+    target = _CopyTarget(dst)
+    size = _copy_to_targets(src, [target], holes, buffer_size)
+    if target.error is not None:
+        raise target.error
+    LOG.debug("Copied image %(src)s to %(dst)s: wrote %(written)d of "
+              "%(size)d bytes.", {'src': src, 'dst': dst,
+                                  'written': target.written, 'size': size})
+    return target.written
+
+
+class _FanOutSession(object):
+    """Copy of an image to the devices of the deploys which joined it."""
+
+    def __init__(self, src):
+        self.src = src
+        self.targets = []
+
+    def run(self):
+        LOG.info(_("Copying image %(src)s to %(count)d devices: %(dsts)s"),
+                 {'src': self.src, 'count': len(self.targets),
+                  'dsts': ', '.join(t.path for t in self.targets)})
+        try:
+            _copy_to_targets(self.src, self.targets,
+                             CONF.deploy.sparse_copy_holes,
+                             CONF.deploy.copy_buffer_mb * 1024 * 1024)
+        except Exception as e:
+            # NOTE: failing to read the image fails all the deploys
+            for target in self.targets:
+                if target.error is None:
+                    target.error = e
+        finally:
+            for target in self.targets:
+                target.done.set()
+
+
+_FANOUT_LOCK = threading.Lock()
+# (st_dev, st_ino) of an image -> session still accepting devices
+_FANOUT_SESSIONS = {}
+
+
+def fanout_copy(src, dst):
+    """Copy an image to a device along with the other deploys of the image.
+
+    The first deploy of an image waits for CONF.deploy.fanout_window
+    seconds for deploys of the same image to join it, then reads the image
+    once and writes it to the devices of all these deploys, like
+    sparse_copy() does. Instance images are hard links to their master
+    image, deploys of the same image are found by the inode of the image.
+
+    :param src: Path of the image.
+    :param dst: Path of the device, or of a file.
+    :returns: The number of bytes of data written.
+    """
+    src_stat = os.stat(src)
+    key = (src_stat.st_dev, src_stat.st_ino)
+    target = _CopyTarget(dst)
+    with _FANOUT_LOCK:
+        session = _FANOUT_SESSIONS.get(key)
+        leader = session is None
+        if leader:
+            session = _FANOUT_SESSIONS[key] = _FanOutSession(src)
+        session.targets.append(target)
+
+    if leader:
+        time.sleep(CONF.deploy.fanout_window)
+        with _FANOUT_LOCK:
+            del _FANOUT_SESSIONS[key]
+        session.run()
+    else:
+        LOG.debug("Copy of image %(src)s to %(dst)s joined the copy to "
+                  "%(first)s", {'src': src, 'dst': dst,
+                                'first': session.targets[0].path})
+        target.done.wait()
+
+    if target.error is not None:
+        raise target.error
+    return target.written
+
+
+def convert_image(src, dst):
+    """Convert an image to raw format straight onto a device."""
+    utils.execute('qemu-img', 'convert', '-t', 'none', '-O', 'raw',
+                  src, dst,
+                  run_as_root=True,
+                  check_exit_code=[0])
+
+
+def copy_image(src, dst):
+    """Copy an image to a device.
+
+    Images which are not raw, as the image caches keep them when
+    CONF.force_raw_images is not set, are converted onto the device with
+    convert_image(). If CONF.deploy.sparse_copy is set, raw images are
+    copied with sparse_copy(), or with fanout_copy() if
+    CONF.deploy.fanout_window is set too, falling back to dd() if the
+    device cannot be opened for writing.
+
+    :returns: The number of bytes written, None if unknown.
+    """
+    image_format = images.image_info(src).file_format
+    if image_format not in (None, 'raw'):
+        LOG.debug("Converting %(format)s image %(src)s onto %(dst)s",
+                  {'format': image_format, 'src': src, 'dst': dst})
+        convert_image(src, dst)
+        return None
+
+    if CONF.deploy.sparse_copy:
+        try:
+            if CONF.deploy.fanout_window > 0:
+                return fanout_copy(src, dst)
+            return sparse_copy(src, dst)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise exception.InstanceDeployFailure(
+                    _("Failed to copy image %(src)s to %(dst)s: %(err)s") %
+                    {'src': src, 'dst': dst, 'err': e})
+            LOG.warning(_("Cannot write to %(dst)s, copying image %(src)s "
+                          "with dd instead: %(err)s"),
+                        {'src': src, 'dst': dst, 'err': e})
+    dd(src, dst)
+    return os.path.getsize(src)
+
+
 def mkswap(dev, label='swap1'):
     """Execute mkswap on a device."""
     utils.mkfs('swap', dev, label)
@@ -167,25 +656,62 @@ def block_uuid(dev):
 def switch_pxe_config(path, root_uuid):
     """Switch a pxe config from deployment mode to service mode."""
     with open(path) as f:
-        lines = f.readlines()
-    root = 'UUID=%s' % root_uuid
-    rre = re.compile(r'\{\{ ROOT \}\}')
-    dre = re.compile('^default .*$')
-    with open(path, 'w') as f:
-        for line in lines:
-            line = rre.sub(root, line)
-            line = dre.sub('default boot', line)
-            f.write(line)
-
-
-def notify(address, port):
-    """Notify a node that it becomes ready to reboot."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect((address, port))
-        s.send('done')
-    finally:
-        s.close()
+        config = f.read()
+    config = _ROOT_RE.sub('UUID=%s' % root_uuid, config)
+    config = _DEFAULT_RE.sub('default boot', config)
+    utils.write_to_file(path, config)
+
+
+def notify(address, port, timeout=None):
+    """Notify a node that it becomes ready to reboot.
+
+    The deploy ramdisk starts listening on the port after calling back the
+    conductor, connecting is retried until it does, backing off from
+    CONF.deploy.notify_retry_interval.
+
+    :param address: IP address of the node.
+    :param port: port the deploy ramdisk listens on.
+    :param timeout: time, in seconds, after which to give up, defaults to
+                    CONF.deploy.notify_timeout.
+    :returns: the time, in seconds, the deploy ramdisk took to accept the
+              connection.
+    :raises: socket.error if the deploy ramdisk could not be connected to
+             before the timeout.
+    """
+    if timeout is None:
+        timeout = CONF.deploy.notify_timeout
+    start = time.time()
+    deadline = start + timeout
+    interval = CONF.deploy.notify_retry_interval
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            s = socket.create_connection(
+                (address, port), max(deadline - time.time(), 1))
+        except socket.error as e:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                LOG.error(_("Could not connect to the deploy ramdisk at "
+                            "%(address)s:%(port)s after %(attempts)d "
+                            "attempts: %(err)s"),
+                          {'address': address, 'port': port,
+                           'attempts': attempts, 'err': e})
+                raise
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2,
+                           CONF.deploy.notify_max_retry_interval)
+            continue
+        try:
+            s.sendall('done')
+        finally:
+            s.close()
+        latency = time.time() - start
+        LOG.debug("Deploy ramdisk at %(address)s:%(port)s notified after "
+                  "%(attempts)d attempt(s) and %(latency).2f seconds.",
+                  {'address': address, 'port': port, 'attempts': attempts,
+                   'latency': latency})
+        return latency
 
 
 def get_dev(address, port, iqn, lun):
@@ -196,9 +722,13 @@ def get_dev(address, port, iqn, lun):
 
 
 def get_image_mb(image_path):
-    """Get size of an image in Megabyte."""
+    """Get size of the disk held by an image in Megabyte."""
     mb = 1024 * 1024
-    image_byte = os.path.getsize(image_path)
+    info = images.sniff_image_info(image_path)
+    if info is not None and info.file_format != 'raw':
+        image_byte = info.virtual_size
+    else:
+        image_byte = os.path.getsize(image_path)
     # round up size to MB
     image_mb = int((image_byte + mb - 1) / mb)
     return image_mb
@@ -261,6 +791,53 @@ def destroy_disk_metadata(dev, node_uuid):
                            'error': err.stderr})
 
 
+def _start_step(name, func, *args):
+    """Start running a deploy step in a background thread.
+
+    The step is timed in the deploy trace of the calling thread.
+
+    :returns: a function waiting for the step to be over, which raises the
+        exception raised by the step, if any.
+    """
+    result = {}
+    trace = deploy_trace.current()
+
+    def run():
+        try:
+            with deploy_trace.step(name, trace=trace):
+                func(*args)
+        except Exception:
+            result['exc_info'] = sys.exc_info()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'exc_info' in result:
+            six.reraise(*result['exc_info'])
+    return wait
+
+
+def _wait_for_steps(steps, reraise=True):
+    """Wait for deploy steps started with _start_step() to be over.
+
+    All the steps are waited for. The exception raised by the first step
+    which failed is raised if reraise is True, the others are logged.
+    """
+    exc_info = None
+    for wait in steps:
+        try:
+            wait()
+        except Exception as e:
+            if exc_info is None and reraise:
+                exc_info = sys.exc_info()
+            else:
+                LOG.error(_("Deploy step failed: %s"), e)
+    if exc_info is not None:
+        six.reraise(*exc_info)
+
+
 def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
                  image_path, node_uuid, preserve_ephemeral=False):
     """Create partitions and copy an image to the root partition.
@@ -288,9 +865,11 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
     commit = not preserve_ephemeral
     # now if we are committing the changes to disk clean first.
     if commit:
-        destroy_disk_metadata(dev, node_uuid)
-    part_dict = make_partitions(dev, root_mb, swap_mb, ephemeral_mb,
-                                commit=commit)
+        with deploy_trace.step('destroy_disk_metadata'):
+            destroy_disk_metadata(dev, node_uuid)
+    with deploy_trace.step('make_partitions'):
+        part_dict = make_partitions(dev, root_mb, swap_mb, ephemeral_mb,
+                                    commit=commit)
 
     ephemeral_part = part_dict.get('ephemeral')
     swap_part = part_dict.get('swap')
@@ -306,16 +885,29 @@ def work_on_disk(dev, root_mb, swap_mb, ephemeral_mb, ephemeral_format,
         raise exception.InstanceDeployFailure(
                          _("Ephemeral device '%s' not found") % ephemeral_part)
 
-    dd(image_path, root_part)
-
+    # NOTE: the partitions are disjoint, format them while the image is
+    # copied to the root partition.
+    steps = []
     if swap_part:
-        mkswap(swap_part)
+        steps.append(_start_step('mkswap', mkswap, swap_part))
 
     if ephemeral_part and not preserve_ephemeral:
-        mkfs_ephemeral(ephemeral_part, ephemeral_format)
+        steps.append(_start_step('mkfs_ephemeral', mkfs_ephemeral,
+                                 ephemeral_part, ephemeral_format))
 
+    # let the formatting commands start before copying
+    time.sleep(0)
     try:
-        root_uuid = block_uuid(root_part)
+        with deploy_trace.step('copy_image') as record:
+            record['bytes'] = copy_image(image_path, root_part)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            _wait_for_steps(steps, reraise=False)
+    _wait_for_steps(steps)
+
+    try:
+        with deploy_trace.step('block_uuid'):
+            root_uuid = block_uuid(root_part)
     except processutils.ProcessExecutionError:
         with excutils.save_and_reraise_exception():
             LOG.error(_("Failed to detect root device UUID."))
@@ -334,7 +926,8 @@ def work_on_disk_image(dev, image_path, **kwargs):
         raise exception.InstanceDeployFailure(
             _("Parent device '%s' not found") % dev)
 
-    dd(image_path, dev)
+    with deploy_trace.step('copy_image') as record:
+        record['bytes'] = copy_image(image_path, dev)
 
 
 def deploy(address, port, iqn, lun, image_path, pxe_config_path,
@@ -358,16 +951,22 @@ def deploy(address, port, iqn, lun, image_path, pxe_config_path,
     :param preserve_ephemeral: If True, no filesystem is written to the
         ephemeral block device, preserving whatever content it had (if the
         partition table has not changed).
+    :returns: the time, in seconds, the node took to accept the notification
+        that the deployment is done.
 
     """
     dev = get_dev(address, port, iqn, lun)
     image_mb = get_image_mb(image_path)
     if image_mb > root_mb:
         root_mb = image_mb
-    discovery(address, port)
-    login_iscsi(address, port, iqn)
+    with deploy_trace.step('iscsi_discovery'):
+        discovery(address, port)
+    with deploy_trace.step('iscsi_login'):
+        login_iscsi(address, port, iqn)
     try:
-        if has_partition_table(image_path):
+        with deploy_trace.step('partition_table_check'):
+            whole_disk_image = has_partition_table(image_path)
+        if whole_disk_image:
             root_uuid = work_on_disk_image(dev, image_path)
         else:
             root_uuid = work_on_disk(dev, root_mb, swap_mb, ephemeral_mb,
@@ -384,9 +983,12 @@ def deploy(address, port, iqn, lun, image_path, pxe_config_path,
             LOG.error(_("Deploy to address %s failed.") % address)
             LOG.error(e)
     finally:
-        logout_iscsi(address, port, iqn)
-        delete_iscsi(address, port, iqn)
-    switch_pxe_config(pxe_config_path, root_uuid)
-    # Ensure the node started netcat on the port after POST the request.
-    time.sleep(3)
-    notify(address, 10000)
+        with deploy_trace.step('iscsi_logout'):
+            logout_iscsi(address, port, iqn)
+            delete_iscsi(address, port, iqn)
+    with deploy_trace.step('switch_pxe_config'):
+        switch_pxe_config(pxe_config_path, root_uuid)
+    with deploy_trace.step('notify') as record:
+        latency = notify(address, 10000)
+        record['latency'] = latency
+    return latency
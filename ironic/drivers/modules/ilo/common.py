@@ -16,6 +16,10 @@
 Common functionalities shared between different iLO modules.
 """
 
+import collections
+import threading
+import time
+
 from oslo.config import cfg
 
 from ironic.common import exception
@@ -37,6 +41,15 @@ opts = [
     cfg.IntOpt('client_port',
                default=443,
                help='Port to be used for iLO operations'),
+    cfg.IntOpt('client_cache_size',
+               default=128,
+               help='Maximum number of IloClient objects kept for reuse, '
+                    'the least recently used ones being dropped first. '
+                    '0 disables the cache'),
+    cfg.IntOpt('license_cache_ttl',
+               default=3600,
+               help='Time (in seconds) for which the licenses installed '
+                    'on an iLO are cached. 0 disables the cache'),
 ]
 
 CONF = cfg.CONF
@@ -97,11 +110,26 @@ def parse_driver_info(node):
     return d_info
 
 
+# IloClient objects, least recently used first, and results of
+# get_all_licenses() as tuples (time fetched, licenses), keyed by
+# _ilo_key().
+_ILO_OBJECTS = collections.OrderedDict()
+_LICENSES = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def _ilo_key(driver_info):
+    return (driver_info['ilo_address'], driver_info['ilo_username'],
+            driver_info['ilo_password'], driver_info['client_timeout'],
+            driver_info['client_port'])
+
+
 def get_ilo_object(node):
     """Gets an IloClient object from proliantutils library.
 
     Given an ironic node object, this method gives back a IloClient object
-    to do operations on the iLO.
+    to do operations on the iLO. IloClient objects are cached per iLO
+    address and credentials.
 
     :param node: an ironic node object.
     :returns: an IloClient object.
@@ -109,14 +137,86 @@ def get_ilo_object(node):
         is missing on the node or on invalid inputs.
     """
     driver_info = parse_driver_info(node)
+    key = _ilo_key(driver_info)
+    with _CACHE_LOCK:
+        ilo_object = _ILO_OBJECTS.pop(key, None)
+        if ilo_object is not None:
+            _ILO_OBJECTS[key] = ilo_object
+            return ilo_object
+
     ilo_object = ilo_client.IloClient(driver_info['ilo_address'],
                                       driver_info['ilo_username'],
                                       driver_info['ilo_password'],
                                       driver_info['client_timeout'],
                                       driver_info['client_port'])
+    if CONF.ilo.client_cache_size > 0:
+        with _CACHE_LOCK:
+            _ILO_OBJECTS[key] = ilo_object
+            while len(_ILO_OBJECTS) > CONF.ilo.client_cache_size:
+                _ILO_OBJECTS.popitem(last=False)
     return ilo_object
 
 
+def invalidate_ilo_object(node):
+    """Drops the cached IloClient object of the iLO of a node.
+
+    To be called whenever an operation on the iLO fails, so that a broken
+    client is not reused.
+
+    :param node: an ironic node object.
+    :raises: InvalidParameterValue if some mandatory information
+        is missing on the node or on invalid inputs.
+    """
+    key = _ilo_key(parse_driver_info(node))
+    with _CACHE_LOCK:
+        _ILO_OBJECTS.pop(key, None)
+
+
+def invalidate_ilo_license(node):
+    """Drops the cached licenses of the iLO of a node.
+
+    To be called whenever the licenses installed on the iLO change, or
+    may have changed.
+
+    :param node: an ironic node object.
+    :raises: InvalidParameterValue if some mandatory information
+        is missing on the node or on invalid inputs.
+    """
+    key = _ilo_key(parse_driver_info(node))
+    with _CACHE_LOCK:
+        _LICENSES.pop(key, None)
+
+
+def clear_ilo_caches():
+    """Drops all the cached IloClient objects and licenses."""
+    with _CACHE_LOCK:
+        _ILO_OBJECTS.clear()
+        _LICENSES.clear()
+
+
+def _get_all_licenses(node):
+    """Gets the licenses installed on the iLO of a node, possibly cached.
+
+    :param node: an ironic node object.
+    :returns: the licenses, as returned by IloClient.get_all_licenses().
+    :raises: InvalidParameterValue if some mandatory information
+        is missing on the node or on invalid inputs.
+    :raises: IloError on an error from IloClient library.
+    """
+    key = _ilo_key(parse_driver_info(node))
+    with _CACHE_LOCK:
+        cached = _LICENSES.get(key)
+    if (cached is not None and
+            time.time() - cached[0] <= CONF.ilo.license_cache_ttl):
+        return cached[1]
+
+    license_info = get_ilo_object(node).get_all_licenses()
+    if CONF.ilo.license_cache_ttl > 0:
+        with _CACHE_LOCK:
+            _LICENSES[key] = (time.time(), license_info)
+    return license_info
+
+
 def get_ilo_license(node):
     """Gives the current installed license on the node.
 
@@ -131,11 +231,12 @@ def get_ilo_license(node):
     :raises: IloOperationError if it failed to retrieve the
         installed licenses from the iLO.
     """
-    # Get the ilo client object, and then the license from the iLO
-    ilo_object = get_ilo_object(node)
+    # Get the license from the iLO, unless it was recently fetched
     try:
-        license_info = ilo_object.get_all_licenses()
+        license_info = _get_all_licenses(node)
     except ilo_client.IloError as ilo_exception:
+        invalidate_ilo_object(node)
+        invalidate_ilo_license(node)
         raise exception.IloOperationError(operation=_('iLO license check'),
                                           error=str(ilo_exception))
 
@@ -16,10 +16,13 @@
 iLO Power Driver
 """
 
+import time
+
 from oslo.config import cfg
 
 from ironic.common import exception
 from ironic.common import states
+from ironic.conductor import power_timing
 from ironic.conductor import task_manager
 from ironic.drivers import base
 from ironic.drivers.modules.ilo import common as ilo_common
@@ -65,6 +68,7 @@ def _get_power_state(node):
         LOG.error(_("iLO get_power_state failed for node %(node_id)s with "
                     "error: %(error)s."),
                   {'node_id': node.uuid, 'error': ilo_exception})
+        ilo_common.invalidate_ilo_object(node)
         operation = _('iLO get_power_status')
         raise exception.IloOperationError(operation=operation,
                                           error=ilo_exception)
@@ -77,10 +81,34 @@ def _get_power_state(node):
         return states.ERROR
 
 
-def _wait_for_state_change(node, target_state):
-    """Wait for the power state change to get reflected."""
+def _wait_for_state_change(node, target_state, reboot=False):
+    """Wait for the power state change to get reflected.
+
+    If enough transitions to target_state have already been observed on
+    the same model of hardware, the first poll is delayed until the
+    transition is expected to have completed. Reboots are timed apart from
+    power ons.
+
+    :param node: an ironic node object.
+    :param target_state: the power state to wait for.
+    :param reboot: whether the node is being rebooted, in which case it is
+                   in target_state before the change is reflected too.
+    """
     state = [None]
     retries = [0]
+    start = time.time()
+    model = power_timing.model_key(node)
+    timing_state = states.REBOOT if reboot else target_state
+    transition_times = power_timing.get_transition_times()
+
+    initial_delay = transition_times.first_poll_delay(
+        model, timing_state, 0,
+        maximum=CONF.ilo.power_wait * CONF.ilo.power_retry)
+    # Polls skipped by the initial delay, counted against power_retry.
+    skipped = int(initial_delay // (CONF.ilo.power_wait or 1))
+    # The result of the first poll after a power on or off issued at the
+    # expected transition time is not deferred.
+    checked = [bool(initial_delay) and not reboot]
 
     def _wait(state):
 
@@ -88,10 +116,11 @@ def _wait_for_state_change(node, target_state):
 
         # NOTE(rameshg87): For reboot operations, initially the state
         # will be same as the final state. So defer the check for one retry.
-        if retries[0] != 0 and state[0] == target_state:
+        if (retries[0] != 0 or checked[0]) and state[0] == target_state:
+            transition_times.record(model, timing_state, time.time() - start)
             raise loopingcall.LoopingCallDone()
 
-        if retries[0] > CONF.ilo.power_retry:
+        if retries[0] + skipped > CONF.ilo.power_retry:
             state[0] = states.ERROR
             raise loopingcall.LoopingCallDone()
 
@@ -99,7 +128,8 @@ def _wait_for_state_change(node, target_state):
 
     # Start a timer and wait for the operation to complete.
     timer = loopingcall.FixedIntervalLoopingCall(_wait, state)
-    timer.start(interval=CONF.ilo.power_wait).wait()
+    timer.start(interval=CONF.ilo.power_wait,
+                initial_delay=initial_delay).wait()
 
     return state[0]
 
@@ -115,6 +145,7 @@ def _set_power_state(node, target_state):
     """
 
     ilo_object = ilo_common.get_ilo_object(node)
+    reboot = False
 
     # Trigger the operation based on the target state.
     try:
@@ -124,6 +155,7 @@ def _set_power_state(node, target_state):
             ilo_object.set_host_power('ON')
         elif target_state == states.REBOOT:
             ilo_object.reset_server()
+            reboot = True
             target_state = states.POWER_ON
         else:
             msg = _("_set_power_state called with invalid power state "
@@ -135,12 +167,13 @@ def _set_power_state(node, target_state):
                     " for node %(node_id)s with error: %(error)s"),
                    {'tstate': target_state, 'node_id': node.uuid,
                      'error': ilo_exception})
+        ilo_common.invalidate_ilo_object(node)
         operation = _('iLO set_power_state')
         raise exception.IloOperationError(operation=operation,
                                           error=ilo_exception)
 
     # Wait till the state change gets reflected.
-    state = _wait_for_state_change(node, target_state)
+    state = _wait_for_state_change(node, target_state, reboot=reboot)
 
     if state != target_state:
         timeout = (CONF.ilo.power_wait) * (CONF.ilo.power_retry)
@@ -18,16 +18,27 @@
 Utility for caching master images.
 """
 
+import errno
+import hashlib
+import heapq
+import itertools
 import os
+import sys
 import tempfile
+import threading
 import time
 
+from eventlet import tpool
 from oslo.config import cfg
+import six
 
+from ironic.common import exception
 from ironic.common.glance_service import service_utils
+from ironic.common import image_peer
 from ironic.common import images
 from ironic.common import utils
 from ironic.openstack.common import fileutils
+from ironic.openstack.common import jsonutils
 from ironic.openstack.common import lockutils
 from ironic.openstack.common import log as logging
 
@@ -39,75 +50,553 @@ img_cache_opts = [
                 default=False,
                 help='Run image downloads and raw format conversions in '
                      'parallel.'),
+    cfg.IntOpt('max_parallel_image_downloads',
+               default=4,
+               help='Maximum number of image downloads and raw format '
+                    'conversions run at the same time when '
+                    'parallel_image_downloads is enabled. Further downloads '
+                    'are queued, kernel and ramdisk images ahead of '
+                    'instance images.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(img_cache_opts)
 
+# NOTE: master images are named after the MD5 digest of the image contents
+# (which is what Glance reports as the image checksum), so that images with
+# the same contents share one master file. This index maps (cache directory,
+# image UUID or href) to the digest of that image. It is persisted in each
+# cache directory, in DIGESTS_FILE_NAME, so that the master images of images
+# without a checksum are still found after a restart. _DIGEST_DIRS holds the
+# cache directories whose persisted index was loaded.
+_DIGESTS = {}
+_DIGEST_DIRS = set()
+_DIGESTS_LOCK = threading.Lock()
+
+# Download priorities, lower values are downloaded first.
+PRIORITY_BOOT = 0
+PRIORITY_INSTANCE = 10
+
+
+class _Download(object):
+    """A download, shared by all callers asking for the same image."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        # NOTE: set if its owner died before the download could start
+        self.cancelled = False
+
+
+class _DownloadScheduler(object):
+    """Schedules image downloads of this process.
+
+    Only one download per image runs at a time: callers asking for an image
+    which is already being downloaded wait for that download to finish and
+    share its result. At most max_parallel_image_downloads downloads run at
+    the same time (only one if parallel_image_downloads is disabled), the
+    others are queued by priority, then in order of arrival. A queued
+    download whose caller dies, for instance because its thread is killed,
+    is dropped from the queue, and the callers waiting for it start it
+    over.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._downloads = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = 0
+
+    def _max_running(self):
+        if not CONF.parallel_image_downloads:
+            return 1
+        return max(CONF.max_parallel_image_downloads, 1)
+
+    def run(self, key, priority, func, *args, **kwargs):
+        """Run a download, or wait for the same download to finish.
+
+        :param key: key identifying the downloaded image, or None if the
+                    download can not be shared with other callers.
+        :param priority: priority of the download, one of the PRIORITY_*
+                         constants.
+        :param func: function doing the download.
+        :param args: positional arguments of func.
+        :param kwargs: keyword arguments of func.
+        :returns: tuple (result of func, whether this caller ran func).
+        :raises: the exception raised by func, to all waiting callers.
+        """
+        with self._cond:
+            download = self._downloads.get(key) if key is not None else None
+            if download is None:
+                download = _Download()
+                if key is not None:
+                    self._downloads[key] = download
+                heapq.heappush(self._queue,
+                               (priority, next(self._counter), download))
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            LOG.debug("Waiting for the download of image %s already in "
+                      "progress", key)
+            download.done.wait()
+            if download.cancelled:
+                return self.run(key, priority, func, *args, **kwargs)
+            if download.exc_info is not None:
+                six.reraise(*download.exc_info)
+            return download.result, False
+
+        with self._cond:
+            try:
+                while True:
+                    while self._queue and self._queue[0][2].cancelled:
+                        heapq.heappop(self._queue)
+                    if (self._running < self._max_running()
+                            and self._queue[0][2] is download):
+                        break
+                    self._cond.wait()
+            except BaseException:
+                # NOTE: the caller died while waiting for its turn, its
+                # download is dropped from the queue when reaching its head
+                download.cancelled = True
+                if key is not None and self._downloads.get(key) is download:
+                    del self._downloads[key]
+                self._cond.notify_all()
+                download.done.set()
+                raise
+            heapq.heappop(self._queue)
+            self._running += 1
+
+        try:
+            download.result = func(*args, **kwargs)
+        except Exception:
+            download.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._cond:
+                self._running -= 1
+                if key is not None:
+                    self._downloads.pop(key, None)
+                self._cond.notify_all()
+            download.done.set()
+        return download.result, True
+
+
+_SCHEDULER = _DownloadScheduler()
+
+
+# NOTE: name of the journal of the cache index, in the cache directory
+INDEX_FILE_NAME = '.index'
+# NOTE: name of the persisted digests of the images, in the cache directory.
+# Starts with INDEX_FILE_NAME so that it is not taken for a master image.
+DIGESTS_FILE_NAME = INDEX_FILE_NAME + '.digests'
+
+
+class LRUPolicy(object):
+    """Evict the least recently used master images first."""
+
+    def priority(self, size, last_used, hits):
+        """Compute the priority of a master image added to or used from
+        the cache. Master images with the lowest priority are evicted first.
+
+        :param size: size of the master image in bytes.
+        :param last_used: time of the last use of the master image.
+        :param hits: number of uses of the master image from the cache.
+        :returns: the priority, any comparable value.
+        """
+        return last_used
+
+    def evicted(self, priority):
+        """Called when a master image is removed from the cache.
+
+        :param priority: priority of the removed master image.
+        """
+
+
+class LFUPolicy(LRUPolicy):
+    """Evict the least frequently used master images first.
+
+    Master images used equally often are evicted least recently used first.
+    """
+
+    def priority(self, size, last_used, hits):
+        return (hits, last_used)
+
+
+class GreedyDualSizePolicy(LRUPolicy):
+    """GreedyDual-Size eviction, with the same cost for every master image.
+
+    Each master image gets the priority L + 1 / size when it is added to
+    the cache or used, and the master image with the lowest priority is
+    evicted first. L starts at 0 and is raised to the priority of every
+    evicted master image, so that images which are not used age. Large
+    images are evicted before small ones used as recently.
+    """
+
+    def __init__(self):
+        self.inflation = 0.0
+
+    def priority(self, size, last_used, hits):
+        return self.inflation + 1.0 / max(size, 1)
+
+    def evicted(self, priority):
+        self.inflation = max(self.inflation, priority)
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gds': GreedyDualSizePolicy,
+}
+
+
+class _CacheIndex(object):
+    """Index of the master images of a cache directory.
+
+    Keeps the size, last use time and number of uses of every master image,
+    the total size of the cache, a heap of master images ordered by last use
+    time and a heap ordered by the eviction policy of the cache, so that
+    cleaning up does not need to list and stat the whole directory. Uses of
+    master images are those recorded by the cache, access times are only
+    used for images which are not in the index yet.
+
+    The index is persisted as a journal of changes, which is compacted from
+    time to time. When loaded, the index is reconciled with the contents of
+    the directory, so a journal which is lost or not up to date because of
+    a crash only costs stat calls on the master images it misses. Link
+    counts change when images are used or released outside of the cache,
+    so they are not indexed, but checked when an image is about to be
+    deleted.
+    """
+
+    def __init__(self, master_dir, policy_name='lru'):
+        self.master_dir = master_dir
+        self.policy_name = policy_name
+        self.total_size = 0
+        self._policy = EVICTION_POLICIES[policy_name]()
+        self._path = os.path.join(master_dir, INDEX_FILE_NAME)
+        self._lock = threading.Lock()
+        # name -> [size, last used time, number of uses, priority]
+        self._entries = {}
+        # (last used time, name) and (priority, name), may contain outdated
+        # items
+        self._age_heap = []
+        self._heap = []
+        self._records = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._path) as journal:
+                for line in journal:
+                    try:
+                        self._apply(jsonutils.loads(line))
+                    except (ValueError, TypeError, IndexError):
+                        # NOTE: the last record may be incomplete after a
+                        # crash
+                        LOG.debug("Ignoring invalid record in cache index "
+                                  "%(path)s: %(line)r",
+                                  {'path': self._path, 'line': line})
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                LOG.warn(_("Unable to read cache index %(path)s, rebuilding "
+                           "it: %(exc)s"), {'path': self._path, 'exc': exc})
+
+        names = set(name for name in os.listdir(self.master_dir)
+                    if not name.startswith(INDEX_FILE_NAME))
+        for name in list(self._entries):
+            if name not in names:
+                self._apply(['del', name])
+        for name in names - set(self._entries):
+            try:
+                stat = os.stat(os.path.join(self.master_dir, name))
+            except OSError:
+                continue
+            if os.path.isdir(os.path.join(self.master_dir, name)):
+                # NOTE: temporary download directory
+                continue
+            # NOTE(dtantsur): Detect most recently accessed files,
+            # seeing atime can be disabled by the mount option
+            # Also include ctime as it changes when image is linked to
+            last_used = max(stat.st_mtime, stat.st_atime, stat.st_ctime)
+            self._apply(['add', name, stat.st_size, last_used])
+        self._compact()
+
+    def _apply(self, record):
+        op, name = record[0], record[1]
+        entry = self._entries.get(name)
+        if op == 'add':
+            if entry is not None:
+                self.total_size -= entry[0]
+            hits = int(record[4]) if len(record) > 4 else 0
+            entry = self._entries[name] = [int(record[2]), record[3], hits,
+                                           None]
+            self.total_size += entry[0]
+        elif op == 'use':
+            if entry is None:
+                return
+            entry[1] = record[2]
+            entry[2] += 1
+        elif op == 'del':
+            if entry is not None:
+                self.total_size -= entry[0]
+                self._policy.evicted(entry[3])
+                del self._entries[name]
+            return
+        else:
+            raise ValueError(op)
+        self._push(name, entry)
+
+    def _push(self, name, entry):
+        entry[3] = self._policy.priority(*entry[:3])
+        heapq.heappush(self._age_heap, (entry[1], name))
+        heapq.heappush(self._heap, (entry[3], name))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._rebuild_heaps()
+
+    def _rebuild_heaps(self):
+        self._age_heap = [(item[1], item_name) for item_name, item
+                          in self._entries.items()]
+        heapq.heapify(self._age_heap)
+        self._heap = [(item[3], item_name) for item_name, item
+                      in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _record(self, record):
+        self._apply(record)
+        self._records += 1
+        if self._records > 2 * len(self._entries) + 64:
+            self._compact()
+            return
+        try:
+            with open(self._path, 'a') as journal:
+                journal.write(jsonutils.dumps(record) + '\n')
+        except IOError as exc:
+            LOG.warn(_("Unable to update cache index %(path)s: %(exc)s"),
+                     {'path': self._path, 'exc': exc})
+
+    def _compact(self):
+        tmp_path = '%s.tmp' % self._path
+        # NOTE: oldest first, so that priorities depending on the order
+        # of uses are restored when loading
+        entries = sorted(self._entries.items(), key=lambda item: item[1][1])
+        try:
+            with open(tmp_path, 'w') as journal:
+                for name, (size, last_used, hits, priority) in entries:
+                    journal.write(jsonutils.dumps(['add', name, size,
+                                                   last_used, hits]) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.rename(tmp_path, self._path)
+        except EnvironmentError as exc:
+            LOG.warn(_("Unable to write cache index %(path)s: %(exc)s"),
+                     {'path': self._path, 'exc': exc})
+        self._records = len(self._entries)
+
+    def set_policy(self, policy_name):
+        """Change the eviction policy.
+
+        :param policy_name: name of the eviction policy, one of the keys of
+                            EVICTION_POLICIES.
+        """
+        with self._lock:
+            if policy_name == self.policy_name:
+                return
+            self.policy_name = policy_name
+            self._policy = EVICTION_POLICIES[policy_name]()
+            for name, entry in sorted(self._entries.items(),
+                                      key=lambda item: item[1][1]):
+                entry[3] = self._policy.priority(*entry[:3])
+            self._rebuild_heaps()
+
+    def add(self, name):
+        """Record a new master image.
+
+        :param name: file name of the master image.
+        """
+        size = os.path.getsize(os.path.join(self.master_dir, name))
+        with self._lock:
+            self._record(['add', name, size, time.time()])
+
+    def touch(self, name):
+        """Record a use of a master image.
+
+        :param name: file name of the master image.
+        """
+        with self._lock:
+            known = name in self._entries
+            if known:
+                self._record(['use', name, time.time()])
+        if not known:
+            try:
+                self.add(name)
+            except OSError:
+                pass
+
+    def remove(self, name):
+        """Forget a master image.
+
+        :param name: file name of the master image.
+        """
+        with self._lock:
+            if name in self._entries:
+                self._record(['del', name])
+
+    def _pop(self, heap, field):
+        with self._lock:
+            while heap:
+                value, name = heapq.heappop(heap)
+                entry = self._entries.get(name)
+                if entry is not None and entry[field] == value:
+                    return name, entry[0], entry[1]
+        return None
+
+    def pop_oldest(self):
+        """Take the least recently used master image out of the age heap.
+
+        The image stays in the index, it must be either removed or given
+        back to the heap with requeue().
+
+        :returns: tuple (name, size, last used time), or None if the heap
+                  is empty.
+        """
+        return self._pop(self._age_heap, 1)
+
+    def pop_victim(self):
+        """Take the next master image to evict out of the policy heap.
+
+        The image stays in the index, it must be either removed or given
+        back to the heap with requeue().
+
+        :returns: tuple (name, size, last used time), or None if the heap
+                  is empty.
+        """
+        return self._pop(self._heap, 3)
+
+    def requeue(self, names, oldest=False):
+        """Give master images taken out of a heap back to it.
+
+        :param names: file names of the master images.
+        :param oldest: whether the images were taken with pop_oldest()
+                       rather than pop_victim().
+        """
+        heap, field = (self._age_heap, 1) if oldest else (self._heap, 3)
+        with self._lock:
+            for name in names:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    heapq.heappush(heap, (entry[field], name))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def _get_index(master_dir, policy_name='lru'):
+    """Get the index of a cache directory, loading it if required."""
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(master_dir)
+        if index is None:
+            index = _INDEXES[master_dir] = _CacheIndex(master_dir,
+                                                       policy_name)
+    index.set_policy(policy_name)
+    return index
+
 
 class ImageCache(object):
     """Class handling access to cache for master images."""
 
+    # NOTE: priority of the downloads of this cache in the download queue
+    download_priority = PRIORITY_INSTANCE
+
     def __init__(self, master_dir, cache_size, cache_ttl,
-                 image_service=None):
+                 image_service=None, eviction_policy='lru', peer_name=None):
         """Constructor.
 
         :param master_dir: cache directory to work on
         :param cache_size: desired maximum cache size in bytes
         :param cache_ttl: cache entity TTL in seconds
         :param image_service: Glance image service to use, None for default
+        :param eviction_policy: name of the policy choosing which images
+                                to evict when the cache is too large, one
+                                of the keys of EVICTION_POLICIES
+        :param peer_name: name under which the master images of this cache
+                          are shared with other conductors, the same on all
+                          conductors, or None not to share them
+        :raises: InvalidParameterValue if the eviction policy is unknown
         """
+        if eviction_policy not in EVICTION_POLICIES:
+            raise exception.InvalidParameterValue(_(
+                "Unknown image cache eviction policy %(policy)s, expected "
+                "one of %(policies)s") %
+                {'policy': eviction_policy,
+                 'policies': ', '.join(sorted(EVICTION_POLICIES))})
         self.master_dir = master_dir
         self._cache_size = cache_size
         self._cache_ttl = cache_ttl
         self._image_service = image_service
+        self._eviction_policy = eviction_policy
+        self._peer_name = peer_name
         if master_dir is not None:
             fileutils.ensure_tree(master_dir)
+            if peer_name is not None:
+                image_peer.register_cache(peer_name, master_dir)
+
+    def _index(self):
+        """Get the index of the master images of this cache."""
+        return _get_index(self.master_dir, self._eviction_policy)
 
     def fetch_image(self, uuid, dest_path, ctx=None):
         """Fetch image with given uuid to the destination path.
 
         Does nothing if destination path exists.
-        Only creates a link if master image for this UUID is already in cache.
+        Only creates a link if master image with the same contents as this
+        UUID is already in cache.
         Otherwise downloads an image and also stores it in cache.
 
         :param uuid: image UUID or href to fetch
         :param dest_path: destination file path
         :param ctx: context
         """
-        img_download_lock_name = 'download-image'
         if self.master_dir is None:
             #NOTE(ghe): We don't share images between instances/hosts
-            if not CONF.parallel_image_downloads:
-                with lockutils.lock(img_download_lock_name, 'ironic-'):
-                    images.fetch_to_raw(ctx, uuid, dest_path,
-                                        self._image_service)
-            else:
-                images.fetch_to_raw(ctx, uuid, dest_path,
-                                    self._image_service)
+            _SCHEDULER.run(None, self.download_priority,
+                           images.fetch_to_raw, ctx, uuid, dest_path,
+                           self._image_service)
             return
 
         #TODO(ghe): have hard links and counts the same behaviour in all fs
 
-        master_file_name = service_utils.parse_image_ref(uuid)[0]
-        master_path = os.path.join(self.master_dir, master_file_name)
-
-        if CONF.parallel_image_downloads:
-            img_download_lock_name = 'download-image:%s' % master_file_name
-
-        # TODO(dtantsur): lock expiration time
-        with lockutils.lock(img_download_lock_name, 'ironic-'):
-            if os.path.exists(dest_path):
-                LOG.debug("Destination %(dest)s already exists for "
-                            "image %(uuid)s" %
-                          {'uuid': uuid,
-                           'dest': dest_path})
-                return
+        if os.path.exists(dest_path):
+            LOG.debug("Destination %(dest)s already exists for "
+                        "image %(uuid)s" %
+                      {'uuid': uuid,
+                       'dest': dest_path})
+            return
 
+        digest = self._get_digest(uuid, ctx)
+        if digest is not None:
+            master_file_name = digest
+            master_path = os.path.join(self.master_dir, digest)
+        else:
+            # NOTE: the digest will only be known once the image has been
+            # downloaded and hashed
+            master_file_name = service_utils.parse_image_ref(uuid)[0]
+            master_path = None
+
+        if master_path is not None:
             try:
-                # NOTE(dtantsur): ensure we're not in the middle of clean up
+                # NOTE(dtantsur): ensure we're not in the middle of
+                # clean up
                 with lockutils.lock('master_image', 'ironic-'):
                     os.link(master_path, dest_path)
+                    self._index().touch(master_file_name)
             except OSError:
                 LOG.info(_("Master cache miss for image %(uuid)s, "
                            "starting download") %
@@ -117,41 +606,180 @@ class ImageCache(object):
                           {'uuid': uuid})
                 return
 
-            self._download_image(uuid, master_path, dest_path, ctx=ctx)
+        # TODO(dtantsur): lock expiration time
+        downloaded_path, owner = _SCHEDULER.run(
+            (self.master_dir, master_file_name), self.download_priority,
+            self._download_image, uuid, master_path, dest_path, ctx=ctx)
+        if not owner:
+            # NOTE: the image was downloaded for another caller, link its
+            # master image to our destination
+            try:
+                with lockutils.lock('master_image', 'ironic-'):
+                    os.link(downloaded_path, dest_path)
+                    self._index().touch(os.path.basename(downloaded_path))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    LOG.info(_("Master image %(master)s was removed before "
+                               "it could be used for image %(uuid)s, "
+                               "downloading it again") %
+                             {'master': downloaded_path, 'uuid': uuid})
+                    _SCHEDULER.run(None, self.download_priority,
+                                   self._download_image, uuid, master_path,
+                                   dest_path, ctx=ctx)
 
         # NOTE(dtantsur): we increased cache size - time to clean up
         self.clean_up()
+        LOG.debug("Deduplication statistics for master image cache "
+                  "%(dir)s: %(stats)s",
+                  {'dir': self.master_dir, 'stats': self.dedup_stats()})
+
+    def prefetch_image(self, uuid, ctx=None):
+        """Make sure the master image of an image is in the cache.
+
+        Downloads the image if its master image is not in the cache yet,
+        without linking it anywhere else.
+
+        :param uuid: image UUID or href to fetch
+        :param ctx: context
+        """
+        if self.master_dir is None:
+            return
+        tmp_dir = tempfile.mkdtemp(dir=self.master_dir)
+        try:
+            self.fetch_image(uuid, os.path.join(tmp_dir, 'prefetch'),
+                             ctx=ctx)
+        finally:
+            utils.rmtree_without_raise(tmp_dir)
+
+    def _get_digest(self, uuid, ctx=None):
+        """Get the digest of the contents of an image.
+
+        :param uuid: image UUID or href
+        :param ctx: context
+        :returns: MD5 digest of the image contents, as a hex string, or None
+                  if it is not known before downloading the image.
+        """
+        key = (self.master_dir, uuid)
+        _load_digests(self.master_dir)
+        with _DIGESTS_LOCK:
+            digest = _DIGESTS.get(key)
+        if digest is None:
+            digest = images.image_show(ctx, uuid,
+                                       self._image_service).get('checksum')
+            if digest:
+                _set_digest(self.master_dir, uuid, digest)
+        return digest or None
 
     def _download_image(self, uuid, master_path, dest_path, ctx=None):
         """Download image from Glance and store at a given path.
-        This method should be called with uuid-specific lock taken.
+        This method should be run by the download scheduler.
 
         :param uuid: image UUID or href to fetch
-        :param master_path: destination master path
+        :param master_path: destination master path, or None to name the
+                            master image after the digest of its contents
         :param dest_path: destination file path
         :param ctx: context
+        :returns: path of the master image
         """
         #TODO(ghe): timeout and retry for downloads
         #TODO(ghe): logging when image cannot be created
         tmp_dir = tempfile.mkdtemp(dir=self.master_dir)
         tmp_path = os.path.join(tmp_dir, uuid)
         try:
-            images.fetch_to_raw(ctx, uuid, tmp_path,
-                                self._image_service)
+            if master_path is None:
+                tmp_part = '%s.part' % tmp_path
+                images.fetch(ctx, uuid, tmp_part, self._image_service)
+                with open(tmp_part, 'rb') as image_file:
+                    # NOTE: hashing a whole image would block the other
+                    #       green threads.
+                    digest = tpool.execute(_hash_file, image_file)
+                _set_digest(self.master_dir, uuid, digest)
+                master_path = os.path.join(self.master_dir, digest)
+                images.image_to_raw(uuid, tmp_path, tmp_part)
+            elif not self._fetch_from_peers(master_path, tmp_path):
+                images.fetch_to_raw(ctx, uuid, tmp_path,
+                                    self._image_service)
             # NOTE(dtantsur): no need for global lock here - master_path
             # will have link count >1 at any moment, so won't be cleaned up
-            os.link(tmp_path, master_path)
+            index = self._index()
+            try:
+                os.link(tmp_path, master_path)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                # NOTE: another image with the same contents made it to
+                # the cache in the meantime, use its master image.
+                LOG.debug("Image %(uuid)s has the same contents as master "
+                          "image %(master)s",
+                          {'uuid': uuid, 'master': master_path})
+                with lockutils.lock('master_image', 'ironic-'):
+                    os.link(master_path, dest_path)
+                    index.touch(os.path.basename(master_path))
+                return master_path
+            index.add(os.path.basename(master_path))
             os.link(master_path, dest_path)
+            return master_path
         finally:
             utils.rmtree_without_raise(tmp_dir)
 
+    def _fetch_from_peers(self, master_path, tmp_path):
+        """Fetch a master image from another conductor, if enabled.
+
+        :param master_path: path of the master image in this cache
+        :param tmp_path: path to write the master image to
+        :returns: True if the master image was fetched from another
+                  conductor, False otherwise
+        """
+        if self._peer_name is None or not image_peer.enabled():
+            return False
+        return image_peer.fetch(self._peer_name,
+                                os.path.basename(master_path), tmp_path)
+
+    def dedup_stats(self):
+        """Get statistics about deduplication of images in this cache.
+
+        :returns: a dictionary with the number of known images whose master
+                  image is in the cache ('images'), the number of distinct
+                  master images they use ('unique_images'), their total
+                  size as seen by users ('logical_bytes') and on disk
+                  ('physical_bytes'), the disk space saved by sharing master
+                  images ('bytes_saved'), and the ratio of logical to
+                  physical size ('dedup_ratio').
+        """
+        _load_digests(self.master_dir)
+        with _DIGESTS_LOCK:
+            digests = [digest for (master_dir, uuid), digest
+                       in _DIGESTS.items() if master_dir == self.master_dir]
+        sizes = {}
+        logical = 0
+        count = 0
+        for digest in digests:
+            if digest not in sizes:
+                try:
+                    sizes[digest] = os.path.getsize(
+                        os.path.join(self.master_dir, digest))
+                except OSError:
+                    sizes[digest] = None
+            if sizes[digest] is not None:
+                logical += sizes[digest]
+                count += 1
+        physical = sum(size for size in sizes.values() if size is not None)
+        return {'images': count,
+                'unique_images': len([size for size in sizes.values()
+                                      if size is not None]),
+                'logical_bytes': logical,
+                'physical_bytes': physical,
+                'bytes_saved': logical - physical,
+                'dedup_ratio': float(logical) / physical if physical else 1.0}
+
     @lockutils.synchronized('master_image', 'ironic-')
     def clean_up(self, amount=None):
         """Clean up directory with images, keeping cache of the latest images.
 
         Files with link count >1 are never deleted.
         Protected by global lock, so that no one messes with master images
-        after we get listing and before we actually delete files.
+        after we pick them from the index and before we actually delete
+        files.
 
         :param amount: if present, amount of space to reclaim in bytes,
                        cleaning will stop, if this goal was reached,
@@ -164,18 +792,61 @@ class ImageCache(object):
                   {'dir': self.master_dir})
 
         amount_copy = amount
-        listing = _find_candidates_for_deletion(self.master_dir)
-        survived, amount = self._clean_up_too_old(listing, amount)
+        index = self._index()
+        amount = self._clean_up_too_old(index, amount)
         if amount is not None and amount <= 0:
             return
-        amount = self._clean_up_ensure_cache_size(survived, amount)
+        amount = self._clean_up_ensure_cache_size(index, amount)
         if amount is not None and amount > 0:
             LOG.warn(_("Cache clean up was unable to reclaim %(required)d MiB "
                        "of disk space, still %(left)d MiB required"),
                      {'required': amount_copy / 1024 / 1024,
                       'left': amount / 1024 / 1024})
 
-    def _clean_up_too_old(self, listing, amount):
+    def _delete_next(self, index, pop, skipped, threshold=None):
+        """Delete the next master image which is not in use.
+
+        :param index: index of the cache.
+        :param pop: index method taking the next master image out of the
+                    index heap, index.pop_oldest or index.pop_victim.
+        :param skipped: list to which the names of master images which
+                        were taken from the heap but not deleted are
+                        appended. The caller must give them back to the
+                        heap with index.requeue().
+        :param threshold: if not None, only delete a master image last used
+                          before this time.
+        :returns: size of the deleted master image, or None if no master
+                  image could be deleted.
+        """
+        while True:
+            entry = pop()
+            if entry is None:
+                return None
+            name, size, last_used = entry
+            if threshold is not None and last_used >= threshold:
+                skipped.append(name)
+                return None
+            file_name = os.path.join(self.master_dir, name)
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                index.remove(name)
+                continue
+            if stat.st_nlink > 1:
+                skipped.append(name)
+                continue
+            try:
+                os.unlink(file_name)
+            except EnvironmentError as exc:
+                LOG.warn(_("Unable to delete file %(name)s from "
+                           "master image cache: %(exc)s") %
+                         {'name': file_name, 'exc': exc})
+                skipped.append(name)
+                continue
+            index.remove(name)
+            return size
+
+    def _clean_up_too_old(self, index, amount):
         """Clean up stage 1: drop images that are older than TTL.
 
         This method removes files all files older than TTL seconds
@@ -183,88 +854,105 @@ class ImageCache(object):
         it starts removing files older than TTL seconds,
         oldest first, until the required 'amount' of space is reclaimed.
 
-        :param listing: list of tuples (file name, last used time)
+        :param index: index of the cache
         :param amount: if not None, amount of space to reclaim in bytes,
                        cleaning will stop, if this goal was reached,
                        even if it is possible to clean up more files
-        :returns: tuple (list of files left after clean up,
-                         amount still to reclaim)
+        :returns: amount still to reclaim
         """
         threshold = time.time() - self._cache_ttl
-        survived = []
-        for file_name, last_used, stat in listing:
-            if last_used < threshold:
-                try:
-                    os.unlink(file_name)
-                except EnvironmentError as exc:
-                    LOG.warn(_("Unable to delete file %(name)s from "
-                               "master image cache: %(exc)s") %
-                             {'name': file_name, 'exc': exc})
-                else:
-                    if amount is not None:
-                        amount -= stat.st_size
-                        if amount <= 0:
-                            amount = 0
-                            break
-            else:
-                survived.append((file_name, last_used, stat))
-        return survived, amount
+        skipped = []
+        try:
+            while True:
+                size = self._delete_next(index, index.pop_oldest, skipped,
+                                         threshold)
+                if size is None:
+                    break
+                if amount is not None:
+                    amount -= size
+                    if amount <= 0:
+                        amount = 0
+                        break
+        finally:
+            index.requeue(skipped, oldest=True)
+        return amount
 
-    def _clean_up_ensure_cache_size(self, listing, amount):
+    def _clean_up_ensure_cache_size(self, index, amount):
         """Clean up stage 2: try to ensure cache size < threshold.
-        Try to delete the oldest files until conditions is satisfied
-        or no more files are eligable for delition.
+        Try to delete the files chosen by the eviction policy until
+        conditions is satisfied or no more files are eligable for delition.
 
-        :param listing: list of tuples (file name, last used time)
+        :param index: index of the cache
         :param amount: amount of space to reclaim, if possible.
                        if amount is not None, it has higher priority than
                        cache size in settings
         :returns: amount of space still required after clean up
         """
-        # NOTE(dtantsur): Sort listing to delete the oldest files first
-        listing = sorted(listing,
-                         key=lambda entry: entry[1],
-                         reverse=True)
-        total_listing = (os.path.join(self.master_dir, f)
-                         for f in os.listdir(self.master_dir))
-        total_size = sum(os.path.getsize(f)
-                         for f in total_listing)
-        while listing and (total_size > self._cache_size or
-               (amount is not None and amount > 0)):
-            file_name, last_used, stat = listing.pop()
-            try:
-                os.unlink(file_name)
-            except EnvironmentError as exc:
-                LOG.warn(_("Unable to delete file %(name)s from "
-                           "master image cache: %(exc)s") %
-                         {'name': file_name, 'exc': exc})
-            else:
-                total_size -= stat.st_size
+        skipped = []
+        try:
+            while (index.total_size > self._cache_size or
+                   (amount is not None and amount > 0)):
+                size = self._delete_next(index, index.pop_victim, skipped)
+                if size is None:
+                    break
                 if amount is not None:
-                    amount -= stat.st_size
+                    amount -= size
+        finally:
+            index.requeue(skipped)
 
-        if total_size > self._cache_size:
+        if index.total_size > self._cache_size:
             LOG.info(_("After cleaning up cache dir %(dir)s "
                        "cache size %(actual)d is still larger than "
                        "threshold %(expected)d") %
-                     {'dir': self.master_dir, 'actual': total_size,
+                     {'dir': self.master_dir, 'actual': index.total_size,
                       'expected': self._cache_size})
         return max(amount, 0)
 
 
-def _find_candidates_for_deletion(master_dir):
-    """Find files eligible for deletion i.e. with link count ==1.
+def _load_digests(master_dir):
+    """Load the persisted digests of the images of a cache directory."""
+    with _DIGESTS_LOCK:
+        if master_dir in _DIGEST_DIRS:
+            return
+        _DIGEST_DIRS.add(master_dir)
+        path = os.path.join(master_dir, DIGESTS_FILE_NAME)
+        try:
+            with open(path) as digests_file:
+                digests = jsonutils.loads(digests_file.read())
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                LOG.warn(_("Unable to read image digests %(path)s: "
+                           "%(exc)s"), {'path': path, 'exc': exc})
+            return
+        except ValueError as exc:
+            LOG.warn(_("Ignoring invalid image digests %(path)s: %(exc)s"),
+                     {'path': path, 'exc': exc})
+            return
+        for uuid, digest in digests.items():
+            _DIGESTS.setdefault((master_dir, uuid), digest)
 
-    :param master_dir: directory to operate on
-    :returns: iterator yielding tuples (file name, last used time, stat)
-    """
-    for filename in os.listdir(master_dir):
-        filename = os.path.join(master_dir, filename)
-        stat = os.stat(filename)
-        if not os.path.isfile(filename) or stat.st_nlink > 1:
-            continue
-        # NOTE(dtantsur): Detect most recently accessed files,
-        # seeing atime can be disabled by the mount option
-        # Also include ctime as it changes when image is linked to
-        last_used_time = max(stat.st_mtime, stat.st_atime, stat.st_ctime)
-        yield filename, last_used_time, stat
+
+def _set_digest(master_dir, uuid, digest):
+    """Record and persist the digest of the contents of an image."""
+    _load_digests(master_dir)
+    with _DIGESTS_LOCK:
+        if _DIGESTS.get((master_dir, uuid)) == digest:
+            return
+        _DIGESTS[(master_dir, uuid)] = digest
+        digests = dict((image, image_digest)
+                       for (directory, image), image_digest
+                       in _DIGESTS.items() if directory == master_dir)
+        path = os.path.join(master_dir, DIGESTS_FILE_NAME)
+        try:
+            utils.write_to_file(path, jsonutils.dumps(digests))
+        except (IOError, OSError) as exc:
+            LOG.warn(_("Unable to save image digests %(path)s: %(exc)s"),
+                     {'path': path, 'exc': exc})
+
+
+def _hash_file(file_like_object):
+    """Compute the MD5 digest of a file, as Glance does for checksums."""
+    checksum = hashlib.md5()
+    for chunk in iter(lambda: file_like_object.read(1024 * 1024), b''):
+        checksum.update(chunk)
+    return checksum.hexdigest()
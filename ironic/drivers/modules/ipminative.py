@@ -19,14 +19,20 @@
 Ironic Native IPMI power manager.
 """
 
+import collections
+import threading
+import time
+
 from oslo.config import cfg
 
 from ironic.common import exception
 from ironic.common import states
 from ironic.conductor import task_manager
 from ironic.drivers import base
+from ironic.openstack.common import excutils
 from ironic.openstack.common import importutils
 from ironic.openstack.common import log as logging
+from ironic.openstack.common import loopingcall
 
 pyghmi = importutils.try_import('pyghmi')
 if pyghmi:
@@ -43,6 +49,21 @@ opts = [
                     'sent to a server. There is a risk with some hardware '
                     'that setting this too low may cause the BMC to crash. '
                     'Recommended setting is 5 seconds.'),
+    cfg.IntOpt('native_session_pool_size',
+               default=64,
+               help='Maximum number of idle IPMI sessions the native IPMI '
+                    'driver keeps open for reuse. 0 disables session '
+                    'reuse, so that every operation logs in to the BMC.'),
+    cfg.IntOpt('native_session_keepalive',
+               default=30,
+               help='Interval, in seconds, at which the native IPMI driver '
+                    'sends a keepalive command on its idle IPMI sessions '
+                    'so that the BMC does not close them. 0 disables '
+                    'keepalives.'),
+    cfg.IntOpt('native_session_max_idle',
+               default=300,
+               help='Idle IPMI sessions of the native IPMI driver which '
+                    'have not been used for this many seconds are closed.'),
     ]
 
 CONF = cfg.CONF
@@ -55,6 +76,10 @@ REQUIRED_PROPERTIES = {'ipmi_address': _("IP of the node's BMC. Required."),
                        'ipmi_username': _("IPMI username. Required.")}
 COMMON_PROPERTIES = REQUIRED_PROPERTIES
 
+# pyghmi Command methods which may safely be sent twice, and are hence
+# retried on a new session when a pooled session fails.
+_RETRIABLE_METHODS = frozenset(['get_power', 'set_bootdev'])
+
 
 def _parse_driver_info(node):
     """Gets the bmc access info for the given node.
@@ -81,6 +106,217 @@ def _parse_driver_info(node):
     return bmc_info
 
 
+def _session_key(driver_info):
+    return (driver_info['address'], driver_info['username'],
+            driver_info['password'])
+
+
+def _new_command(driver_info):
+    return ipmi_command.Command(bmc=driver_info['address'],
+                                userid=driver_info['username'],
+                                password=driver_info['password'])
+
+
+def _logout(ipmicmd):
+    try:
+        ipmicmd.ipmi_session.logout()
+    except Exception:
+        # NOTE: the BMC may have already closed the session.
+        pass
+
+
+def _check_session(ipmicmd):
+    """Check that a session is alive with a Get Device ID command.
+
+    :param ipmicmd: a pyghmi Command.
+    :returns: None if the BMC answered, the error otherwise.
+    """
+    try:
+        rsp = ipmicmd.raw_command(netfn=6, command=1)
+    except pyghmi_exception.IpmiException as e:
+        return e
+    # NOTE: pyghmi reports dead and timed out sessions in the response of
+    #       raw commands rather than by raising.
+    return (rsp or {}).get('error')
+
+
+class _SessionCache(object):
+    """Pool of idle, logged in IPMI sessions, keyed by BMC and credentials.
+
+    A session is taken out of the pool while it is used, so that it is never
+    used by two threads at the same time. At most
+    CONF.ipmi.native_session_pool_size idle sessions are kept, the least
+    recently used ones being closed first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = collections.OrderedDict()
+        self._keepalive_timer = None
+        self.logins = 0
+
+    def acquire(self, driver_info, reuse=True):
+        """Get a session to the BMC of a node.
+
+        :param driver_info: the bmc access info for a node.
+        :param reuse: whether a pooled session may be returned, otherwise
+                      a new session is always created.
+        :returns: a tuple (pyghmi Command, True if the session was taken
+                  from the pool, False if it was just created).
+        """
+        key = _session_key(driver_info)
+        expired = []
+        pooled = None
+        with self._lock:
+            sessions = self._idle.get(key, []) if reuse else []
+            while sessions and pooled is None:
+                ipmicmd, last_used = sessions.pop()
+                if time.time() - last_used > CONF.ipmi.native_session_max_idle:
+                    expired.append(ipmicmd)
+                else:
+                    pooled = ipmicmd
+            if reuse and not sessions:
+                self._idle.pop(key, None)
+        for ipmicmd in expired:
+            _logout(ipmicmd)
+        if pooled is not None:
+            return pooled, True
+
+        ipmicmd = _new_command(driver_info)
+        with self._lock:
+            self.logins += 1
+        return ipmicmd, False
+
+    def release(self, driver_info, ipmicmd):
+        """Return a session which is still usable to the pool.
+
+        :param driver_info: the bmc access info for a node.
+        :param ipmicmd: a pyghmi Command returned by acquire().
+        """
+        if CONF.ipmi.native_session_pool_size <= 0:
+            _logout(ipmicmd)
+            return
+
+        key = _session_key(driver_info)
+        evicted = []
+        with self._lock:
+            self._idle.setdefault(key, []).append((ipmicmd, time.time()))
+            # Most recently used BMC last.
+            self._idle[key] = self._idle.pop(key)
+            while self._size() > CONF.ipmi.native_session_pool_size:
+                oldest = next(iter(self._idle))
+                evicted.append(self._idle[oldest].pop(0)[0])
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+            self._start_keepalive()
+        for cmd in evicted:
+            _logout(cmd)
+
+    def _size(self):
+        return sum(len(sessions) for sessions in self._idle.values())
+
+    def _start_keepalive(self):
+        if (self._keepalive_timer is None and
+                CONF.ipmi.native_session_keepalive > 0):
+            self._keepalive_timer = loopingcall.FixedIntervalLoopingCall(
+                self.keepalive)
+            self._keepalive_timer.start(
+                interval=CONF.ipmi.native_session_keepalive,
+                initial_delay=CONF.ipmi.native_session_keepalive)
+
+    def keepalive(self):
+        """Keep idle sessions alive and close those idle for too long.
+
+        Sends a Get Device ID command on every idle session. Sessions which
+        fail to answer are dropped; they will be re-established on next use.
+        """
+        now = time.time()
+        with self._lock:
+            entries = [(key, entry) for key, sessions in self._idle.items()
+                       for entry in sessions]
+            self._idle.clear()
+
+        alive = []
+        for key, (ipmicmd, last_used) in entries:
+            if now - last_used > CONF.ipmi.native_session_max_idle:
+                _logout(ipmicmd)
+                continue
+            error = _check_session(ipmicmd)
+            if error is not None:
+                LOG.debug("Dropping IPMI session to %(bmc)s, keepalive "
+                          "failed: %(error)s", {'bmc': key[0], 'error': error})
+                _logout(ipmicmd)
+                continue
+            alive.append((key, (ipmicmd, last_used)))
+
+        with self._lock:
+            for key, entry in alive:
+                self._idle.setdefault(key, []).insert(0, entry)
+            if not self._idle and self._keepalive_timer is not None:
+                self._keepalive_timer.stop()
+                self._keepalive_timer = None
+
+    def clear(self):
+        """Close all idle sessions."""
+        with self._lock:
+            entries = [entry for sessions in self._idle.values()
+                       for entry in sessions]
+            self._idle.clear()
+            if self._keepalive_timer is not None:
+                self._keepalive_timer.stop()
+                self._keepalive_timer = None
+            self.logins = 0
+        for ipmicmd, last_used in entries:
+            _logout(ipmicmd)
+
+
+_SESSION_CACHE = _SessionCache()
+
+
+def _relogin(driver_info, ipmicmd, error):
+    LOG.debug("IPMI session to %(bmc)s failed, logging in again: "
+              "%(error)s", {'bmc': driver_info['address'], 'error': error})
+    _logout(ipmicmd)
+    return _SESSION_CACHE.acquire(driver_info, reuse=False)[0]
+
+
+def _ipmi_call(driver_info, method, *args):
+    """Run a pyghmi Command method on a pooled session to a node's BMC.
+
+    A pooled session may have been closed by the BMC. If it fails on one of
+    _RETRIABLE_METHODS, the call is retried once on a new session. Other
+    commands, such as power actions, are never sent twice: a pooled session
+    is checked with a Get Device ID command before they are sent, and
+    replaced by a new session if the check fails.
+
+    :param driver_info: the bmc access info for a node.
+    :param method: name of the pyghmi Command method to call.
+    :param args: arguments of the method.
+    :returns: what the method returns.
+    :raises: pyghmi IpmiException when the call fails.
+    """
+    ipmicmd, pooled = _SESSION_CACHE.acquire(driver_info)
+    try:
+        if pooled and method not in _RETRIABLE_METHODS:
+            error = _check_session(ipmicmd)
+            if error is not None:
+                ipmicmd = _relogin(driver_info, ipmicmd, error)
+            pooled = False
+        try:
+            ret = getattr(ipmicmd, method)(*args)
+        except pyghmi_exception.IpmiException as e:
+            if not pooled:
+                raise
+            ipmicmd = _relogin(driver_info, ipmicmd, e)
+            ret = getattr(ipmicmd, method)(*args)
+    except Exception:
+        # NOTE: the session is in an unknown state, it is not pooled again.
+        with excutils.save_and_reraise_exception():
+            _logout(ipmicmd)
+    _SESSION_CACHE.release(driver_info, ipmicmd)
+    return ret
+
+
 def _power_on(driver_info):
     """Turn the power on for this node.
 
@@ -94,11 +330,8 @@ def _power_on(driver_info):
     msg = _("IPMI power on failed for node %(node_id)s with the "
             "following error: %(error)s")
     try:
-        ipmicmd = ipmi_command.Command(bmc=driver_info['address'],
-                           userid=driver_info['username'],
-                           password=driver_info['password'])
         wait = CONF.ipmi.retry_timeout
-        ret = ipmicmd.set_power('on', wait)
+        ret = _ipmi_call(driver_info, 'set_power', 'on', wait)
     except pyghmi_exception.IpmiException as e:
         LOG.warning(msg % {'node_id': driver_info['uuid'], 'error': str(e)})
         raise exception.IPMIFailure(cmd=str(e))
@@ -124,11 +357,8 @@ def _power_off(driver_info):
     msg = _("IPMI power off failed for node %(node_id)s with the "
             "following error: %(error)s")
     try:
-        ipmicmd = ipmi_command.Command(bmc=driver_info['address'],
-                           userid=driver_info['username'],
-                           password=driver_info['password'])
         wait = CONF.ipmi.retry_timeout
-        ret = ipmicmd.set_power('off', wait)
+        ret = _ipmi_call(driver_info, 'set_power', 'off', wait)
     except pyghmi_exception.IpmiException as e:
         LOG.warning(msg % {'node_id': driver_info['uuid'], 'error': str(e)})
         raise exception.IPMIFailure(cmd=str(e))
@@ -156,11 +386,8 @@ def _reboot(driver_info):
     msg = _("IPMI power reboot failed for node %(node_id)s with the "
             "following error: %(error)s")
     try:
-        ipmicmd = ipmi_command.Command(bmc=driver_info['address'],
-                           userid=driver_info['username'],
-                           password=driver_info['password'])
         wait = CONF.ipmi.retry_timeout
-        ret = ipmicmd.set_power('boot', wait)
+        ret = _ipmi_call(driver_info, 'set_power', 'boot', wait)
     except pyghmi_exception.IpmiException as e:
         LOG.warning(msg % {'node_id': driver_info['uuid'], 'error': str(e)})
         raise exception.IPMIFailure(cmd=str(e))
@@ -183,10 +410,7 @@ def _power_status(driver_info):
     """
 
     try:
-        ipmicmd = ipmi_command.Command(bmc=driver_info['address'],
-                           userid=driver_info['username'],
-                           password=driver_info['password'])
-        ret = ipmicmd.get_power()
+        ret = _ipmi_call(driver_info, 'get_power')
     except pyghmi_exception.IpmiException as e:
         LOG.warning(_("IPMI get power state failed for node %(node_id)s "
                       "with the following error: %(error)s")
@@ -296,10 +520,7 @@ class VendorPassthru(base.VendorInterface):
                 "Invalid boot device %s specified.") % device)
         driver_info = _parse_driver_info(task.node)
         try:
-            ipmicmd = ipmi_command.Command(bmc=driver_info['address'],
-                               userid=driver_info['username'],
-                               password=driver_info['password'])
-            ipmicmd.set_bootdev(device)
+            _ipmi_call(driver_info, 'set_bootdev', device)
         except pyghmi_exception.IpmiException as e:
             LOG.warning(_("IPMI set boot device failed for node %(node_id)s "
                           "with the following error: %(error)s")
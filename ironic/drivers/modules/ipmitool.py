@@ -43,6 +43,7 @@ from ironic.common import exception
 from ironic.common import i18n
 from ironic.common import states
 from ironic.common import utils
+from ironic.conductor import power_timing
 from ironic.conductor import task_manager
 from ironic.drivers import base
 from ironic.drivers.modules import console_utils
@@ -195,7 +196,8 @@ def _parse_driver_info(node):
             'password': password,
             'port': port,
             'uuid': node.uuid,
-            'priv_level': priv_level
+            'priv_level': priv_level,
+            'model': power_timing.model_key(node)
            }
 
 
@@ -277,6 +279,11 @@ def _set_and_wait(target_state, driver_info):
     if a driver is concerned, the state should be checked prior to calling this
     method.
 
+    The first poll is delayed until the transition is expected to have
+    completed, based on the transition times previously observed for the
+    same hardware model (see ironic.conductor.power_timing); subsequent polls
+    back off exponentially.
+
     :param target_state: desired power state
     :param driver_info: the ipmitool parameters for accessing a node.
     :returns: one of ironic.common.states
@@ -288,11 +295,15 @@ def _set_and_wait(target_state, driver_info):
     elif target_state == states.POWER_OFF:
         state_name = "off"
 
+    transition_times = power_timing.get_transition_times()
+    model = driver_info.get('model')
+
     def _wait(mutable):
         try:
             # Only issue power change command once
             if mutable['iter'] < 0:
                 _exec_ipmitool(driver_info, "power %s" % state_name)
+                mutable['start'] = time.time()
             else:
                 mutable['power'] = _power_status(driver_info)
         except Exception:
@@ -303,9 +314,19 @@ def _set_and_wait(target_state, driver_info):
             mutable['iter'] += 1
 
         if mutable['power'] == target_state:
+            if mutable['start'] is not None and model is not None:
+                transition_times.record(model, target_state,
+                                        time.time() - mutable['start'])
             raise loopingcall.LoopingCallDone()
 
-        sleep_time = _sleep_time(mutable['iter'])
+        if mutable['iter'] == 0:
+            # Poll for the first time when the transition is expected
+            # to have completed on this model of hardware.
+            sleep_time = transition_times.first_poll_delay(
+                model, target_state, _sleep_time(0),
+                maximum=CONF.ipmi.retry_timeout)
+        else:
+            sleep_time = _sleep_time(mutable['iter'])
         if (sleep_time + mutable['total_time']) > CONF.ipmi.retry_timeout:
             # Stop if the next loop would exceed maximum retry_timeout
             LOG.error(_('IPMI power %(state)s timed out after '
@@ -319,8 +340,8 @@ def _set_and_wait(target_state, driver_info):
             return sleep_time
 
     # Use mutable objects so the looped method can change them.
-    # Start 'iter' from -1 so that the first two checks are one second apart.
-    status = {'power': None, 'iter': -1, 'total_time': 0}
+    # Start 'iter' from -1 so that the power command is issued first.
+    status = {'power': None, 'iter': -1, 'total_time': 0, 'start': None}
 
     timer = loopingcall.DynamicLoopingCall(_wait, status)
     timer.start().wait()
@@ -21,6 +21,7 @@ import os
 
 from oslo.config import cfg
 
+from ironic.common import deploy_trace
 from ironic.common import exception
 from ironic.common import image_service as service
 from ironic.common import images
@@ -82,6 +83,18 @@ pxe_opts = [
                default=60,
                help='Maximum TTL (in minutes) for old master images in '
                'cache.'),
+    cfg.StrOpt('tftp_image_cache_policy',
+               default='lru',
+               help='Policy choosing which master tftp images to evict '
+                    'when the cache is larger than image_cache_size: '
+                    '"lru" (least recently used first), "lfu" (least '
+                    'frequently used first) or "gds" (GreedyDual-Size, '
+                    'larger images first among those used as recently).'),
+    cfg.StrOpt('instance_image_cache_policy',
+               default='lru',
+               help='Policy choosing which master instance images to evict '
+                    'when the cache is larger than image_cache_size: '
+                    '"lru", "lfu" or "gds", see tftp_image_cache_policy.'),
     ]
 
 LOG = logging.getLogger(__name__)
@@ -251,24 +264,37 @@ def _get_token_file_path(node_uuid):
 
 
 class PXEImageCache(image_cache.ImageCache):
-    def __init__(self, master_dir, image_service=None):
+    def __init__(self, master_dir, image_service=None,
+                 eviction_policy='lru', peer_name=None):
         super(PXEImageCache, self).__init__(
             master_dir,
             # MiB -> B
             cache_size=CONF.pxe.image_cache_size * 1024 * 1024,
             # min -> sec
             cache_ttl=CONF.pxe.image_cache_ttl * 60,
-            image_service=image_service)
+            image_service=image_service,
+            eviction_policy=eviction_policy,
+            peer_name=peer_name)
 
 
 class TFTPImageCache(PXEImageCache):
+    # NOTE: kernels and ramdisks are small and needed to boot the node,
+    # download them before instance images
+    download_priority = image_cache.PRIORITY_BOOT
+
     def __init__(self, image_service=None):
-        super(TFTPImageCache, self).__init__(CONF.pxe.tftp_master_path)
+        super(TFTPImageCache, self).__init__(
+            CONF.pxe.tftp_master_path,
+            eviction_policy=CONF.pxe.tftp_image_cache_policy,
+            peer_name='pxe_tftp')
 
 
 class InstanceImageCache(PXEImageCache):
     def __init__(self, image_service=None):
-        super(InstanceImageCache, self).__init__(CONF.pxe.instance_master_path)
+        super(InstanceImageCache, self).__init__(
+            CONF.pxe.instance_master_path,
+            eviction_policy=CONF.pxe.instance_image_cache_policy,
+            peer_name='pxe_instance')
 
 
 def _free_disk_space_for(path):
@@ -365,6 +391,47 @@ def _cache_instance_image(ctx, node):
     return (uuid, image_path)
 
 
+def _prefetch_images(ctx, image_hrefs):
+    """Fetch images into the image caches, ahead of deployments.
+
+    Kernels and ramdisks (images in the 'aki' and 'ari' disk formats) are
+    fetched into the TFTP image cache, other images into the instance image
+    cache, along with the kernel and ramdisk they reference, if any.
+    Failing to fetch an image is logged and does not stop the others from
+    being fetched.
+
+    :param ctx: context
+    :param image_hrefs: list of image hrefs
+    """
+    tftp_images = []
+    instance_images = []
+    for image_href in image_hrefs:
+        try:
+            image_meta = images.image_show(ctx, image_href)
+        except exception.IronicException as e:
+            LOG.warning(_("Could not prefetch image %(image)s: %(err)s"),
+                        {'image': image_href, 'err': e})
+            continue
+        if image_meta.get('disk_format') in ('aki', 'ari'):
+            tftp_images.append(image_href)
+            continue
+        instance_images.append(image_href)
+        properties = image_meta.get('properties') or {}
+        for label in ('kernel_id', 'ramdisk_id'):
+            if label in properties:
+                tftp_images.append(str(properties[label]).split('/')[-1])
+
+    for cache, hrefs in ((TFTPImageCache(), tftp_images),
+                         (InstanceImageCache(), instance_images)):
+        for image_href in hrefs:
+            try:
+                _cleanup_caches_if_required(ctx, cache, [(image_href, None)])
+                cache.prefetch_image(image_href, ctx=ctx)
+            except Exception as e:
+                LOG.warning(_("Could not prefetch image %(image)s: %(err)s"),
+                            {'image': image_href, 'err': e})
+
+
 def _get_tftp_image_info(node, ctx):
     """Generate the paths for tftp files for this instance
 
@@ -525,16 +592,24 @@ class PXEDeploy(base.DeployInterface):
         :param task: a TaskManager instance containing the node to act on.
         :returns: deploy state DEPLOYING.
         """
-        _cache_instance_image(task.context, task.node)
-        _check_image_size(task)
-
-        # TODO(yuriyz): more secure way needed for pass auth token
-        #               to deploy ramdisk
-        _create_token_file(task)
-        dhcp_opts = pxe_utils.dhcp_options_for_instance()
-        neutron.update_neutron(task, dhcp_opts)
-        manager_utils.node_set_boot_device(task, 'pxe', persistent=True)
-        manager_utils.node_power_action(task, states.REBOOT)
+        with deploy_trace.trace(task.node, 'deploy'):
+            with deploy_trace.step('instance_image'):
+                _cache_instance_image(task.context, task.node)
+            with deploy_trace.step('image_size_check'):
+                _check_image_size(task)
+
+            # TODO(yuriyz): more secure way needed for pass auth token
+            #               to deploy ramdisk
+            with deploy_trace.step('token_file'):
+                _create_token_file(task)
+            with deploy_trace.step('neutron_update'):
+                dhcp_opts = pxe_utils.dhcp_options_for_instance()
+                neutron.update_neutron(task, dhcp_opts)
+            with deploy_trace.step('set_boot_device'):
+                manager_utils.node_set_boot_device(task, 'pxe',
+                                                   persistent=True)
+            with deploy_trace.step('reboot'):
+                manager_utils.node_power_action(task, states.REBOOT)
 
         return states.DEPLOYWAIT
 
@@ -561,12 +636,15 @@ class PXEDeploy(base.DeployInterface):
         :param task: a TaskManager instance containing the node to act on.
         """
         # TODO(deva): optimize this if rerun on existing files
-        pxe_info = _get_tftp_image_info(task.node, task.context)
-        pxe_options = _build_pxe_config_options(task.node, pxe_info,
-                                                task.context)
-        pxe_utils.create_pxe_config(task, pxe_options,
-                                    CONF.pxe.pxe_config_template)
-        _cache_tftp_images(task.context, task.node, pxe_info)
+        with deploy_trace.trace(task.node, 'prepare', new_deploy=True):
+            with deploy_trace.step('pxe_config'):
+                pxe_info = _get_tftp_image_info(task.node, task.context)
+                pxe_options = _build_pxe_config_options(task.node, pxe_info,
+                                                        task.context)
+                pxe_utils.create_pxe_config(task, pxe_options,
+                                            CONF.pxe.pxe_config_template)
+            with deploy_trace.step('tftp_images'):
+                _cache_tftp_images(task.context, task.node, pxe_info)
 
     def clean_up(self, task):
         """Clean up the deployment environment for the task's node.
@@ -594,6 +672,14 @@ class PXEDeploy(base.DeployInterface):
         dhcp_opts = pxe_utils.dhcp_options_for_instance()
         neutron.update_neutron(task, dhcp_opts)
 
+    def cache_images(self, context, image_hrefs):
+        """Fetch images into this conductor's image caches ahead of time.
+
+        :param context: a context for this action.
+        :param image_hrefs: a list of image hrefs.
+        """
+        _prefetch_images(context, image_hrefs)
+
 
 class VendorPassthru(base.VendorInterface):
     """Interface to mix IPMI and PXE vendor-specific interfaces."""
@@ -643,6 +729,9 @@ class VendorPassthru(base.VendorInterface):
                 "Unsupported method (%s) passed to PXE driver.")
                 % method)
 
+    def is_bulk_io(self, method):
+        return method == 'pass_deploy_info'
+
     @task_manager.require_exclusive_lock
     def _continue_deploy(self, task, **kwargs):
         """Resume a deployment upon getting POST data from deploy ramdisk.
@@ -694,7 +783,8 @@ class VendorPassthru(base.VendorInterface):
                    '%(params)s') % {'node': node.uuid, 'params': params})
 
         try:
-            deploy_utils.deploy(**params)
+            with deploy_trace.trace(node, 'continue_deploy'):
+                handshake_latency = deploy_utils.deploy(**params)
         except Exception as e:
             LOG.error(_('PXE deploy failed for instance %(instance)s. '
                         'Error: %(error)s') % {'instance': node.instance_uuid,
@@ -702,6 +792,11 @@ class VendorPassthru(base.VendorInterface):
             _set_failed_state(_('PXE driver failed to continue deployment.'))
         else:
             LOG.info(_('Deployment to node %s done') % node.uuid)
+            if handshake_latency is not None:
+                LOG.info(_('Deploy ramdisk of node %(node)s acknowledged the '
+                           'end of the deployment after %(latency).2f '
+                           'seconds.'), {'node': node.uuid,
+                                         'latency': handshake_latency})
             node.provision_state = states.ACTIVE
             node.target_provision_state = states.NOSTATE
             node.save(task.context)
@@ -19,6 +19,9 @@ python-seamicroclient.
 Provides vendor passthru methods for SeaMicro specific functionality.
 """
 
+import threading
+import time
+
 from oslo.config import cfg
 
 from ironic.common import boot_devices
@@ -42,7 +45,16 @@ opts = [
                help='Maximum retries for SeaMicro operations'),
     cfg.IntOpt('action_timeout',
                default=10,
-               help='Seconds to wait for power action to be completed')
+               help='Seconds to wait for power action to be completed'),
+    cfg.IntOpt('server_list_ttl',
+               default=5,
+               help='Seconds for which the list of servers of a chassis, '
+                    'fetched in a single API call, is used to answer '
+                    'power state queries for all the nodes of that '
+                    'chassis. Power states may be that many seconds out '
+                    'of date, including the ones checked before power '
+                    'actions, so it should be kept short. 0 disables it, '
+                    'so that every power state query fetches its server.'),
 ]
 
 _LE = i18n._LE
@@ -76,8 +88,26 @@ COMMON_PROPERTIES = REQUIRED_PROPERTIES.copy()
 COMMON_PROPERTIES.update(OPTIONAL_PROPERTIES)
 
 
+# Clients, and snapshots of the servers of each chassis as a tuple
+# (time fetched, {server id: server}), keyed by _chassis_key().
+_CLIENTS = {}
+_SERVER_LISTS = {}
+# Number of times the servers of each chassis were forgotten, keyed by
+# _chassis_key(), so that a list fetched before is not stored afterwards.
+_GENERATIONS = {}
+_LOCK = threading.Lock()
+
+
+def _chassis_key(kwargs):
+    return (kwargs['api_endpoint'], kwargs['username'], kwargs['password'],
+            kwargs['api_version'])
+
+
 def _get_client(*args, **kwargs):
-    """Creates the python-seamicro_client
+    """Returns the python-seamicro_client for a chassis
+
+    Clients are cached per API endpoint and credentials, so that all the
+    nodes of a chassis share a single client and authentication.
 
     :param kwargs: A dict of keyword arguments to be passed to the method,
                    which should contain: 'username', 'password',
@@ -85,10 +115,71 @@ def _get_client(*args, **kwargs):
     :returns: SeaMicro API client.
     """
 
-    cl_kwargs = {'username': kwargs['username'],
-                 'password': kwargs['password'],
-                 'auth_url': kwargs['api_endpoint']}
-    return seamicro_client.Client(kwargs['api_version'], **cl_kwargs)
+    key = _chassis_key(kwargs)
+    with _LOCK:
+        client = _CLIENTS.get(key)
+    if client is None:
+        cl_kwargs = {'username': kwargs['username'],
+                     'password': kwargs['password'],
+                     'auth_url': kwargs['api_endpoint']}
+        client = seamicro_client.Client(kwargs['api_version'], **cl_kwargs)
+        with _LOCK:
+            client = _CLIENTS.setdefault(key, client)
+    return client
+
+
+def _forget_chassis(driver_info):
+    """Drop the cached client and server list of a chassis."""
+
+    key = _chassis_key(driver_info)
+    with _LOCK:
+        _CLIENTS.pop(key, None)
+        _SERVER_LISTS.pop(key, None)
+        _GENERATIONS[key] = _GENERATIONS.get(key, 0) + 1
+
+
+def _forget_server(driver_info):
+    """Drop a server from the cached server list of its chassis.
+
+    Called after a power action, so that the next power state query for the
+    server does not return the state it had before the action.
+    """
+
+    key = _chassis_key(driver_info)
+    with _LOCK:
+        _GENERATIONS[key] = _GENERATIONS.get(key, 0) + 1
+        server_list = _SERVER_LISTS.get(key)
+        if server_list and driver_info['server_id'] in server_list[1]:
+            servers = dict(server_list[1])
+            del servers[driver_info['server_id']]
+            _SERVER_LISTS[key] = (server_list[0], servers)
+
+
+def _get_server_list(driver_info):
+    """Get all the servers of a chassis.
+
+    The list is fetched with a single API call and reused for
+    CONF.seamicro.server_list_ttl seconds. A list fetched while servers of
+    the chassis were being forgotten is returned but not reused.
+
+    :param driver_info: SeaMicro driver info of any node of the chassis.
+    :returns: a dictionary mapping server IDs to servers.
+    """
+
+    key = _chassis_key(driver_info)
+    with _LOCK:
+        server_list = _SERVER_LISTS.get(key)
+        generation = _GENERATIONS.get(key, 0)
+    if (server_list is not None and
+            time.time() - server_list[0] <= CONF.seamicro.server_list_ttl):
+        return server_list[1]
+
+    s_client = _get_client(**driver_info)
+    servers = dict((server.id, server) for server in s_client.servers.list())
+    with _LOCK:
+        if _GENERATIONS.get(key, 0) == generation:
+            _SERVER_LISTS[key] = (time.time(), servers)
+    return servers
 
 
 def _parse_driver_info(node):
@@ -149,20 +240,61 @@ def _get_power_status(node):
     seamicro_info = _parse_driver_info(node)
     try:
         server = _get_server(seamicro_info)
-        if not hasattr(server, 'active') or server.active is None:
-            return states.ERROR
-        if not server.active:
-            return states.POWER_OFF
-        elif server.active:
-            return states.POWER_ON
+        return _server_power_state(server)
 
     except seamicro_client_exception.NotFound:
         raise exception.NodeNotFound(node=node.uuid)
     except seamicro_client_exception.ClientException as ex:
         LOG.error(_("SeaMicro client exception %(msg)s for node %(uuid)s"),
                   {'msg': ex.message, 'uuid': node.uuid})
+        if getattr(ex, 'code', None) == 401:
+            _forget_chassis(seamicro_info)
+        raise exception.ServiceUnavailable(message=ex.message)
+
+
+def _get_chassis_power_status(node):
+    """Get current power state of this node from its chassis' server list
+
+    Answers from the list of servers of the node's chassis (see
+    _get_server_list), falling back to _get_power_status if the list is
+    disabled or the node's server is not in it.
+
+    :param node: Ironic node one of :class:`ironic.db.models.Node`
+    :raises: InvalidParameterValue if required seamicro parameters are
+        missing.
+    :raises: ServiceUnavailable on an error from SeaMicro Client.
+    :returns: Power state of the given node
+    """
+
+    if CONF.seamicro.server_list_ttl <= 0:
+        return _get_power_status(node)
+
+    seamicro_info = _parse_driver_info(node)
+    try:
+        servers = _get_server_list(seamicro_info)
+    except seamicro_client_exception.ClientException as ex:
+        LOG.error(_("SeaMicro client exception %(msg)s while listing the "
+                    "servers of the chassis of node %(uuid)s"),
+                  {'msg': ex.message, 'uuid': node.uuid})
+        _forget_chassis(seamicro_info)
         raise exception.ServiceUnavailable(message=ex.message)
 
+    server = servers.get(seamicro_info['server_id'])
+    if server is None:
+        return _get_power_status(node)
+    return _server_power_state(server)
+
+
+def _server_power_state(server):
+    """Map the state of a SeaMicro server to an Ironic power state."""
+
+    if not hasattr(server, 'active') or server.active is None:
+        return states.ERROR
+    if not server.active:
+        return states.POWER_OFF
+    elif server.active:
+        return states.POWER_ON
+
 
 def _power_on(node, timeout=None):
     """Power ON this node
@@ -354,7 +486,7 @@ class Power(base.PowerInterface):
         :raises: ServiceUnavailable on an error from SeaMicro Client.
         :returns: power state. One of :class:`ironic.common.states`.
         """
-        return _get_power_status(task.node)
+        return _get_chassis_power_status(task.node)
 
     @task_manager.require_exclusive_lock
     def set_power_state(self, task, pstate):
@@ -370,13 +502,18 @@ class Power(base.PowerInterface):
         """
 
         if pstate == states.POWER_ON:
-            state = _power_on(task.node)
+            power_action = _power_on
         elif pstate == states.POWER_OFF:
-            state = _power_off(task.node)
+            power_action = _power_off
         else:
             raise exception.InvalidParameterValue(_(
                 "set_power_state called with invalid power state."))
 
+        try:
+            state = power_action(task.node)
+        finally:
+            _forget_server(_parse_driver_info(task.node))
+
         if state != pstate:
             raise exception.PowerStateFailure(pstate=pstate)
 
@@ -390,7 +527,10 @@ class Power(base.PowerInterface):
         :raises: PowerStateFailure if the final state of the node is not
             POWER_ON.
         """
-        state = _reboot(task.node)
+        try:
+            state = _reboot(task.node)
+        finally:
+            _forget_server(_parse_driver_info(task.node))
 
         if state != states.POWER_ON:
             raise exception.PowerStateFailure(pstate=states.POWER_ON)
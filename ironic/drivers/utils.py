@@ -82,6 +82,11 @@ class MixinVendorInterface(base.VendorInterface):
         route = self._map(**kwargs)
         return route.vendor_passthru(task, **kwargs)
 
+    def is_bulk_io(self, method):
+        """Call is_bulk_io on the appropriate interface only."""
+        route = self.mapping.get(method)
+        return route is not None and route.is_bulk_io(method)
+
     def driver_vendor_passthru(self, context, method, **kwargs):
         """Call driver_vendor_passthru on a mapped interface based on the
         specified method.
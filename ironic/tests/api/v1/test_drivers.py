@@ -103,3 +103,28 @@ class TestListDrivers(base.FunctionalTest):
         error = json.loads(response.json['error_message'])
         self.assertEqual('Missing argument: "method"',
                          error['faultstring'])
+
+    @mock.patch.object(rpcapi.ConductorAPI, 'warm_image_cache')
+    def test_driver_image_cache_ok(self, mocked_warm_image_cache):
+        self.register_fake_conductors()
+        response = self.post_json('/drivers/%s/image_cache' % self.d2,
+                                  ['image1', 'image2'])
+        self.assertEqual(202, response.status_int)
+        self.assertEqual(2, mocked_warm_image_cache.call_count)
+        topics = sorted(call[1]['topic']
+                        for call in mocked_warm_image_cache.call_args_list)
+        self.assertEqual(['ironic.conductor_manager.%s' % self.h1,
+                          'ironic.conductor_manager.%s' % self.h2], topics)
+        for call in mocked_warm_image_cache.call_args_list:
+            self.assertEqual((self.d2, ['image1', 'image2']), call[0][1:])
+
+    def test_driver_image_cache_driver_not_found(self):
+        response = self.post_json('/drivers/%s/image_cache' % self.d1,
+                                  ['image1'], expect_errors=True)
+        self.assertEqual(404, response.status_int)
+
+    def test_driver_image_cache_no_images(self):
+        self.register_fake_conductors()
+        response = self.post_json('/drivers/%s/image_cache' % self.d1,
+                                  [], expect_errors=True)
+        self.assertEqual(400, response.status_int)
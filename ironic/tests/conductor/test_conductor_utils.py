@@ -16,6 +16,7 @@ from ironic.common import driver_factory
 from ironic.common import exception
 from ironic.common import states
 from ironic.common import utils as cmn_utils
+from ironic.conductor import power_state_cache
 from ironic.conductor import task_manager
 from ironic.conductor import utils as conductor_utils
 from ironic.db import api as dbapi
@@ -65,6 +66,97 @@ class NodeSetBootDeviceTestCase(base.DbTestCase):
                                              persistent=False)
 
 
+class NodeGetPowerStateTestCase(base.DbTestCase):
+
+    def setUp(self):
+        super(NodeGetPowerStateTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        mgr_utils.mock_the_extension_manager()
+        self.driver = driver_factory.get_driver("fake")
+        self.cache = power_state_cache.get_cache()
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        self.config(power_state_cache_ttl=60, group='conductor')
+        self.node = obj_utils.create_test_node(self.context,
+                                               uuid=cmn_utils.generate_uuid(),
+                                               driver='fake')
+        self.task = task_manager.TaskManager(self.context, self.node.uuid)
+
+    def test_node_get_power_state_miss(self):
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            get_power_mock.return_value = states.POWER_ON
+
+            self.assertEqual(states.POWER_ON,
+                             conductor_utils.node_get_power_state(self.task))
+            get_power_mock.assert_called_once_with(self.task)
+            self.assertEqual(states.POWER_ON,
+                             self.cache.get(self.node.uuid))
+
+    def test_node_get_power_state_hit(self):
+        self.cache.set(self.node.uuid, states.POWER_OFF)
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            self.assertEqual(states.POWER_OFF,
+                             conductor_utils.node_get_power_state(self.task))
+            self.assertFalse(get_power_mock.called)
+
+    def test_node_get_power_state_max_age(self):
+        self.cache.set(self.node.uuid, states.POWER_OFF)
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            get_power_mock.return_value = states.POWER_ON
+
+            self.assertEqual(states.POWER_ON,
+                             conductor_utils.node_get_power_state(self.task,
+                                                                  max_age=0))
+            get_power_mock.assert_called_once_with(self.task)
+
+    def test_node_get_power_state_failure_invalidates(self):
+        self.cache.set(self.node.uuid, states.POWER_OFF)
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            get_power_mock.side_effect = exception.IPMIFailure(cmd='status')
+
+            self.assertRaises(exception.IPMIFailure,
+                              conductor_utils.node_get_power_state,
+                              self.task, max_age=0)
+            self.assertIsNone(self.cache.get(self.node.uuid))
+
+    def test_node_get_power_state_error_not_cached(self):
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            get_power_mock.return_value = states.ERROR
+
+            self.assertEqual(states.ERROR,
+                             conductor_utils.node_get_power_state(self.task))
+            self.assertIsNone(self.cache.get(self.node.uuid))
+
+    def test_node_power_action_writes_through(self):
+        with mock.patch.object(self.driver.power, 'get_power_state') \
+                as get_power_mock:
+            get_power_mock.return_value = states.POWER_OFF
+
+            conductor_utils.node_power_action(self.task, states.POWER_ON)
+            self.assertEqual(states.POWER_ON,
+                             self.cache.get(self.node.uuid))
+
+            # The power state is now answered from the cache
+            conductor_utils.node_power_action(self.task, states.POWER_ON)
+            get_power_mock.assert_called_once_with(self.task)
+
+    def test_node_power_action_failure_invalidates(self):
+        self.cache.set(self.node.uuid, states.POWER_OFF)
+        with mock.patch.object(self.driver.power, 'set_power_state') \
+                as set_power_mock:
+            set_power_mock.side_effect = exception.IronicException()
+
+            self.assertRaises(exception.IronicException,
+                              conductor_utils.node_power_action,
+                              self.task, states.POWER_ON)
+            self.assertIsNone(self.cache.get(self.node.uuid))
+
+
 class NodePowerActionTestCase(base.DbTestCase):
 
     def setUp(self):
@@ -0,0 +1,133 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the executor of the bulk data-plane work of the conductor."""
+
+import os
+import threading
+
+import mock
+
+from ironic.common import exception
+from ironic.common import utils
+from ironic.conductor import io_executor
+from ironic.openstack.common import processutils
+from ironic.tests import base
+
+
+class IOExecutorTestCase(base.TestCase):
+
+    def setUp(self):
+        super(IOExecutorTestCase, self).setUp()
+        self.release = threading.Event()
+        self.ran = []
+
+    def _task(self, name, block=False):
+        if block:
+            self.release.wait()
+        self.ran.append(name)
+        return name
+
+    def test_defaults(self):
+        self.config(deploy_io_workers=3, deploy_io_queue_size=5,
+                    group='conductor')
+        executor = io_executor.IOExecutor()
+        self.assertEqual(3, executor.size)
+        self.assertEqual(5, executor.max_queue)
+
+    def test_default_queue_size_bounded(self):
+        executor = io_executor.IOExecutor()
+        self.assertEqual(16, executor.max_queue)
+
+    def test_submit(self):
+        executor = io_executor.IOExecutor(size=2)
+        work = executor.submit(self._task, 'a')
+        self.assertEqual('a', work.wait())
+        self.assertEqual({'size': 2, 'running': 0, 'queued': 0},
+                         executor.stats())
+
+    def test_fifo_queue(self):
+        executor = io_executor.IOExecutor(size=1)
+        executor.submit(self._task, 'a', block=True)
+        for name in ('b', 'c', 'd'):
+            executor.submit(self._task, name)
+        self.assertEqual({'size': 1, 'running': 1, 'queued': 3},
+                         executor.stats())
+
+        self.release.set()
+        executor.waitall()
+        self.assertEqual(['a', 'b', 'c', 'd'], self.ran)
+        self.assertEqual({'size': 1, 'running': 0, 'queued': 0},
+                         executor.stats())
+
+    def test_queue_full(self):
+        executor = io_executor.IOExecutor(size=1, max_queue=1)
+        executor.submit(self._task, 'a', block=True)
+        executor.submit(self._task, 'b')
+        self.assertRaises(exception.NoFreeConductorWorker,
+                          executor.submit, self._task, 'c')
+
+        self.release.set()
+        executor.waitall()
+        self.assertEqual(['a', 'b'], self.ran)
+
+    def test_link_queued(self):
+        executor = io_executor.IOExecutor(size=1)
+        executor.submit(self._task, 'a', block=True)
+        work = executor.submit(self._task, 'b')
+        callback = mock.Mock()
+        work.link(callback, 'arg')
+        self.assertFalse(callback.called)
+
+        self.release.set()
+        self.assertEqual('b', work.wait())
+        executor.waitall()
+        callback.assert_called_once_with(mock.ANY, 'arg')
+        self.assertEqual('b', callback.call_args[0][0].wait())
+
+    def test_failure(self):
+        executor = io_executor.IOExecutor(size=1)
+        failing = executor.submit(mock.Mock(side_effect=RuntimeError()))
+        work = executor.submit(self._task, 'a')
+        self.assertRaises(RuntimeError, failing.wait)
+        self.assertEqual('a', work.wait())
+
+
+@mock.patch.object(utils, 'execute')
+class SetIOPriorityTestCase(base.TestCase):
+
+    def test_unset(self, execute_mock):
+        io_executor.set_io_priority()
+        self.assertFalse(execute_mock.called)
+
+    def test_idle(self, execute_mock):
+        self.config(io_priority='idle', group='conductor')
+        io_executor.set_io_priority()
+        execute_mock.assert_called_once_with('ionice', '-c', '3',
+                                             '-p', str(os.getpid()))
+
+    def test_best_effort(self, execute_mock):
+        io_executor.set_io_priority('best-effort:7')
+        execute_mock.assert_called_once_with('ionice', '-c', '2', '-n', '7',
+                                             '-p', str(os.getpid()))
+
+    def test_invalid(self, execute_mock):
+        for priority in ('low', 'best-effort', 'realtime:8', 'idle:1'):
+            io_executor.set_io_priority(priority)
+        self.assertFalse(execute_mock.called)
+
+    def test_failure(self, execute_mock):
+        execute_mock.side_effect = processutils.ProcessExecutionError()
+        io_executor.set_io_priority('idle')
+        self.assertTrue(execute_mock.called)
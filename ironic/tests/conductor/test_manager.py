@@ -25,6 +25,8 @@ from oslo import messaging
 
 from ironic.common import driver_factory
 from ironic.common import exception
+from ironic.common import image_peer
+from ironic.common import keystone
 from ironic.common import states
 from ironic.common import utils as ironic_utils
 from ironic.conductor import manager
@@ -479,6 +481,29 @@ class ManagerTestCase(tests_db_base.DbTestCase):
         # Verify reservation has been cleared.
         self.assertIsNone(node.reservation)
 
+    def test_vendor_passthru_bulk_io(self):
+        node = obj_utils.create_test_node(self.context, driver='fake')
+        info = {'bar': 'baz'}
+        self._start_service()
+
+        with mock.patch.object(self.driver.vendor, 'is_bulk_io') \
+                as bulk_io_mock:
+            bulk_io_mock.return_value = True
+            with mock.patch.object(self.service, '_spawn_io_worker',
+                                   wraps=self.service._spawn_io_worker) \
+                    as spawn_mock:
+                self.service.vendor_passthru(
+                    self.context, node.uuid, 'first_method', info)
+                self.service._io_executor.waitall()
+
+        bulk_io_mock.assert_called_once_with('first_method')
+        spawn_mock.assert_called_once_with(
+            self.driver.vendor.vendor_passthru, mock.ANY,
+            method='first_method', bar='baz')
+        node.refresh()
+        # Verify reservation has been cleared.
+        self.assertIsNone(node.reservation)
+
     def test_vendor_passthru_node_already_locked(self):
         fake_reservation = 'test_reserv'
         node = obj_utils.create_test_node(self.context, driver='fake',
@@ -625,6 +650,42 @@ class ManagerTestCase(tests_db_base.DbTestCase):
                           'test_method',
                           {})
 
+    @mock.patch.object(image_peer, 'ImagePeerServer')
+    def test_start_stop_image_peer_server(self, server_mock):
+        self.config(image_peer_port=8088, group='conductor')
+        self.config(image_peer_secret='secret', group='conductor')
+        self.service.init_host()
+        server_mock.return_value.start.assert_called_once_with()
+        self.service.del_host()
+        server_mock.return_value.stop.assert_called_once_with()
+
+    @mock.patch.object(image_peer, 'ImagePeerServer')
+    def test_image_peer_server_no_secret(self, server_mock):
+        self.config(image_peer_port=8088, group='conductor')
+        self.service.init_host()
+        self.assertFalse(server_mock.called)
+        self.service.del_host()
+
+    def test_warm_image_cache(self):
+        self.driver.deploy = deploy = mock.Mock()
+        self.service.init_host()
+        self.service.warm_image_cache(self.context, 'fake', ['image1'])
+        self.service._worker_pool.waitall()
+        deploy.cache_images.assert_called_once_with(mock.ANY, ['image1'])
+
+    def test_warm_image_cache_not_supported(self):
+        self.service.init_host()
+        self.service.warm_image_cache(self.context, 'fake', ['image1'])
+        self.service._worker_pool.waitall()
+
+    def test_warm_image_cache_driver_not_found(self):
+        self.service.init_host()
+        exc = self.assertRaises(messaging.ExpectedException,
+                                self.service.warm_image_cache,
+                                self.context, 'does_not_exist', ['image1'])
+        # Compare true exception hidden by @messaging.expected_exceptions
+        self.assertEqual(exception.DriverNotFound, exc.exc_info[0])
+
     def test_do_node_deploy_invalid_state(self):
         # test node['provision_state'] is not NOSTATE
         node = obj_utils.create_test_node(self.context, driver='fake',
@@ -701,15 +762,16 @@ class ManagerTestCase(tests_db_base.DbTestCase):
 
     def test_do_node_deploy_partial_ok(self):
         self._start_service()
-        thread = self.service._spawn_worker(lambda: None)
-        with mock.patch.object(self.service, '_spawn_worker') as mock_spawn:
+        thread = self.service._spawn_io_worker(lambda: None)
+        with mock.patch.object(self.service, '_spawn_io_worker') \
+                as mock_spawn:
             mock_spawn.return_value = thread
 
             node = obj_utils.create_test_node(self.context, driver='fake',
                                               provision_state=states.NOSTATE)
 
             self.service.do_node_deploy(self.context, node.uuid)
-            self.service._worker_pool.waitall()
+            self.service._io_executor.waitall()
             node.refresh()
             self.assertEqual(states.DEPLOYING, node.provision_state)
             self.assertEqual(states.DEPLOYDONE, node.target_provision_state)
@@ -723,7 +785,8 @@ class ManagerTestCase(tests_db_base.DbTestCase):
         node = obj_utils.create_test_node(self.context, driver='fake')
         self._start_service()
 
-        with mock.patch.object(self.service, '_spawn_worker') as mock_spawn:
+        with mock.patch.object(self.service, '_spawn_io_worker') \
+                as mock_spawn:
             mock_spawn.side_effect = exception.NoFreeConductorWorker()
 
             exc = self.assertRaises(messaging.rpc.ExpectedException,
@@ -731,7 +794,7 @@ class ManagerTestCase(tests_db_base.DbTestCase):
                                     self.context, node.uuid)
             # Compare true exception hidden by @messaging.expected_exceptions
             self.assertEqual(exception.NoFreeConductorWorker, exc.exc_info[0])
-            self.service._worker_pool.waitall()
+            self.service._io_executor.waitall()
             node.refresh()
             # This is a sync operation last_error should be None.
             self.assertIsNone(node.last_error)
@@ -1194,6 +1257,14 @@ class ManagerSpawnWorkerTestCase(tests_base.TestCase):
 
         self.assertFalse(worker_pool.spawn.called)
 
+    def test__spawn_io_worker(self):
+        self.service._io_executor = mock.Mock(spec_set=['submit'])
+
+        self.service._spawn_io_worker('fake', 1, 2, foo='bar')
+
+        self.service._io_executor.submit.assert_called_once_with(
+                'fake', 1, 2, foo='bar')
+
 
 @mock.patch.object(conductor_utils, 'node_power_action')
 class ManagerDoSyncPowerStateTestCase(tests_base.TestCase):
@@ -1858,3 +1929,137 @@ class ManagerCheckDeployTimeoutsTestCase(_CommonMixIn, tests_base.TestCase):
                                      self.task)
         self.assertEqual([spawn_after_call] * 2,
                          self.task.spawn_after.call_args_list)
+
+
+class ManagerLogStatusTestCase(tests_base.TestCase):
+    def setUp(self):
+        super(ManagerLogStatusTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.service = manager.ConductorManager('hostname', 'test-topic')
+        self.service._io_executor = mock.Mock(spec_set=['stats'])
+        self.service._io_executor.stats.return_value = {
+            'size': 8, 'running': 8, 'queued': 3}
+
+    @mock.patch.object(manager.LOG, 'info')
+    def test_log_status(self, log_mock):
+        stats = self.service._io_executor.stats.return_value
+
+        self.service._log_status(self.context)
+
+        log_mock.assert_called_once_with(mock.ANY, stats)
+
+    @mock.patch.object(manager.power_state_cache, 'get_cache')
+    @mock.patch.object(manager.LOG, 'info')
+    def test_log_status_power_state_cache(self, log_mock, cache_mock):
+        self.config(power_state_cache_ttl=10, group='conductor')
+        stats = {'hits': 5, 'misses': 2, 'size': 2}
+        cache_mock.return_value.stats.return_value = stats
+
+        self.service._log_status(self.context)
+
+        self.assertIn(mock.call(mock.ANY, stats), log_mock.call_args_list)
+
+    @mock.patch.object(manager.power_state_cache, 'get_cache')
+    @mock.patch.object(manager.LOG, 'info')
+    def test_log_status_power_state_cache_disabled(self, log_mock,
+                                                   cache_mock):
+        self.service._log_status(self.context)
+
+        self.assertFalse(cache_mock.called)
+
+    @mock.patch.object(manager.power_timing, 'get_transition_times')
+    @mock.patch.object(manager.LOG, 'info')
+    def test_log_status_power_timing(self, log_mock, times_mock):
+        summary = {'count': 10, 'p50': 4.0, 'p90': 9.5, 'p99': 12.0}
+        times_mock.return_value.stats.return_value = {
+            'fake:': {states.POWER_ON: summary}}
+
+        self.service._log_status(self.context)
+
+        self.assertIn(mock.call(mock.ANY,
+                                dict(summary, model='fake:',
+                                     state=states.POWER_ON)),
+                      log_mock.call_args_list)
+
+
+@mock.patch.object(dbapi.IMPL, 'get_nodeinfo_list')
+class ManagerPrefetchImagesTestCase(tests_base.TestCase):
+    def setUp(self):
+        super(ManagerPrefetchImagesTestCase, self).setUp()
+        self.config(image_prefetch_count=2, group='conductor')
+        self.config(image_prefetch_nodes=10, group='conductor')
+        self.context = context.get_admin_context()
+        self.service = manager.ConductorManager('hostname', 'test-topic')
+        self.service.dbapi = dbapi.get_instance()
+        self.service.drivers = ['fake', 'other']
+        self.config(auth_strategy='noauth', group='glance')
+
+    def test_disabled(self, get_nodeinfo_mock):
+        self.config(image_prefetch_count=0, group='conductor')
+        self.service._prefetch_images(self.context)
+        self.assertFalse(get_nodeinfo_mock.called)
+
+    @mock.patch.object(manager.ConductorManager, 'warm_image_cache')
+    def test_prefetch_most_used(self, warm_mock, get_nodeinfo_mock):
+        get_nodeinfo_mock.return_value = [
+            ('fake', {'image_source': 'image1'}),
+            ('fake', {'image_source': 'image2'}),
+            ('fake', {'image_source': 'image2'}),
+            ('fake', {'image_source': 'image3'}),
+            ('fake', {'image_source': 'image3'}),
+            ('fake', {'image_source': 'image3'}),
+            ('fake', {}),
+            ('other', {'image_source': 'image1'}),
+            ('unknown', {'image_source': 'image1'}),
+        ]
+
+        self.service._prefetch_images(self.context)
+
+        get_nodeinfo_mock.assert_called_once_with(
+            columns=['driver', 'instance_info'],
+            filters={'provision_state': states.ACTIVE},
+            limit=10, sort_key='provision_updated_at', sort_dir='desc')
+        self.assertEqual(
+            sorted([mock.call(self.context, 'fake', ['image3', 'image2']),
+                    mock.call(self.context, 'other', ['image1'])]),
+            sorted(warm_mock.call_args_list))
+
+    @mock.patch.object(manager.ConductorManager, 'warm_image_cache')
+    def test_no_free_worker(self, warm_mock, get_nodeinfo_mock):
+        get_nodeinfo_mock.return_value = [
+            ('fake', {'image_source': 'image1'}),
+            ('other', {'image_source': 'image1'}),
+        ]
+        warm_mock.side_effect = exception.NoFreeConductorWorker()
+
+        self.service._prefetch_images(self.context)
+
+        self.assertEqual(1, warm_mock.call_count)
+
+    @mock.patch.object(keystone, 'get_admin_auth_token')
+    @mock.patch.object(manager.ConductorManager, 'warm_image_cache')
+    def test_prefetch_admin_token(self, warm_mock, token_mock,
+                                  get_nodeinfo_mock):
+        self.config(auth_strategy='keystone', group='glance')
+        token_mock.return_value = 'admin-token'
+        get_nodeinfo_mock.return_value = [('fake', {'image_source': 'i1'})]
+
+        self.service._prefetch_images(self.context)
+
+        token_mock.assert_called_once_with()
+        warm_mock.assert_called_once_with(mock.ANY, 'fake', ['i1'])
+        ctx = warm_mock.call_args[0][0]
+        self.assertEqual('admin-token', ctx.auth_token)
+        self.assertTrue(ctx.is_admin)
+
+    @mock.patch.object(keystone, 'get_admin_auth_token')
+    @mock.patch.object(manager.ConductorManager, 'warm_image_cache')
+    def test_prefetch_no_admin_token(self, warm_mock, token_mock,
+                                     get_nodeinfo_mock):
+        self.config(auth_strategy='keystone', group='glance')
+        token_mock.side_effect = exception.CatalogUnauthorized()
+
+        self.service._prefetch_images(self.context)
+
+        self.assertFalse(get_nodeinfo_mock.called)
+        self.assertFalse(warm_mock.called)
@@ -0,0 +1,88 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the conductor power state cache."""
+
+import mock
+
+from ironic.common import states
+from ironic.conductor import power_state_cache
+from ironic.tests import base
+
+
+@mock.patch('time.time')
+class PowerStateCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(PowerStateCacheTestCase, self).setUp()
+        self.cache = power_state_cache.PowerStateCache()
+        self.config(power_state_cache_ttl=10, group='conductor')
+
+    def test_get_empty(self, mock_time):
+        mock_time.return_value = 100
+        self.assertIsNone(self.cache.get('node'))
+        self.assertEqual({'hits': 0, 'misses': 1, 'size': 0},
+                         self.cache.stats())
+
+    def test_get_fresh(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_ON)
+        mock_time.return_value = 110
+        self.assertEqual(states.POWER_ON, self.cache.get('node'))
+        self.assertEqual({'hits': 1, 'misses': 0, 'size': 1},
+                         self.cache.stats())
+
+    def test_get_expired(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_ON)
+        mock_time.return_value = 111
+        self.assertIsNone(self.cache.get('node'))
+        self.assertEqual({'hits': 0, 'misses': 1, 'size': 1},
+                         self.cache.stats())
+
+    def test_get_max_age(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_OFF)
+        mock_time.return_value = 105
+        self.assertIsNone(self.cache.get('node', max_age=4))
+        self.assertIsNone(self.cache.get('node', max_age=0))
+        self.assertEqual(states.POWER_OFF,
+                         self.cache.get('node', max_age=30))
+
+    def test_get_disabled(self, mock_time):
+        self.config(power_state_cache_ttl=0, group='conductor')
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_OFF)
+        self.assertIsNone(self.cache.get('node'))
+
+    def test_invalidate(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_ON)
+        self.cache.set('other-node', states.POWER_ON)
+        self.cache.invalidate('node')
+        self.cache.invalidate('unknown-node')
+        self.assertIsNone(self.cache.get('node'))
+        self.assertEqual(states.POWER_ON, self.cache.get('other-node'))
+
+    def test_clear(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('node', states.POWER_ON)
+        self.cache.get('node')
+        self.cache.clear()
+        self.assertEqual({'hits': 0, 'misses': 0, 'size': 0},
+                         self.cache.stats())
+
+    def test_get_cache(self, mock_time):
+        self.assertIs(power_state_cache.get_cache(),
+                      power_state_cache.get_cache())
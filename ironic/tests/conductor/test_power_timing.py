@@ -0,0 +1,119 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the conductor power state transition times."""
+
+from ironic.common import states
+from ironic.conductor import power_timing
+from ironic.tests import base
+from ironic.tests.objects import utils as obj_utils
+
+
+class ModelKeyTestCase(base.TestCase):
+
+    def test_model_key(self):
+        node = obj_utils.get_test_node(None, driver='fake',
+                                       properties={'cpus': 2,
+                                                   'cpu_arch': 'x86_64'})
+        self.assertEqual('fake:cpu_arch=x86_64,cpus=2',
+                         power_timing.model_key(node))
+
+    def test_model_key_no_properties(self):
+        node = obj_utils.get_test_node(None, driver='fake', properties=None)
+        self.assertEqual('fake:', power_timing.model_key(node))
+
+
+class TransitionTimesTestCase(base.TestCase):
+
+    def setUp(self):
+        super(TransitionTimesTestCase, self).setUp()
+        self.times = power_timing.TransitionTimes()
+        self.config(power_timing_min_samples=3, group='conductor')
+
+    def _record(self, durations, model='model', state=states.POWER_ON):
+        for duration in durations:
+            self.times.record(model, state, duration)
+
+    def test_percentile_not_enough_samples(self):
+        self._record([10, 20])
+        self.assertIsNone(self.times.percentile('model', states.POWER_ON, 50))
+
+    def test_percentile(self):
+        self._record([40, 10, 30, 20])
+        self.assertEqual(10, self.times.percentile('model',
+                                                   states.POWER_ON, 0))
+        self.assertEqual(20, self.times.percentile('model',
+                                                   states.POWER_ON, 50))
+        self.assertEqual(40, self.times.percentile('model',
+                                                   states.POWER_ON, 99))
+
+    def test_percentile_per_target_state(self):
+        self._record([10, 10, 10])
+        self.assertIsNone(self.times.percentile('model', states.POWER_OFF,
+                                                50))
+
+    def test_samples_window(self):
+        self.config(power_timing_samples=3, group='conductor')
+        self._record([100, 1, 2, 3])
+        self.assertEqual(3, self.times.percentile('model',
+                                                  states.POWER_ON, 100))
+
+    def test_first_poll_delay_default(self):
+        self.assertEqual(1, self.times.first_poll_delay(
+            'model', states.POWER_ON, 1))
+
+    def test_first_poll_delay_learned(self):
+        self.config(power_timing_percentile=50, group='conductor')
+        self._record([12, 8, 10])
+        self.assertEqual(5, self.times.first_poll_delay(
+            'model', states.POWER_ON, 1))
+
+    def test_first_poll_delay_comes_down(self):
+        # Transitions observed at the first poll are recorded as taking the
+        # first poll delay, the learned delay must still converge to the
+        # actual transition time.
+        self._record([40, 40, 40])
+        for i in range(50):
+            delay = self.times.first_poll_delay('model', states.POWER_ON, 1)
+            self.times.record('model', states.POWER_ON, max(delay, 4))
+        self.assertTrue(self.times.first_poll_delay(
+            'model', states.POWER_ON, 1) <= 4)
+
+    def test_first_poll_delay_maximum(self):
+        self._record([12, 8, 10])
+        self.assertEqual(3, self.times.first_poll_delay(
+            'model', states.POWER_ON, 1, maximum=3))
+
+    def test_first_poll_delay_disabled(self):
+        self.config(adaptive_power_polling=False, group='conductor')
+        self._record([12, 8, 10])
+        self.assertEqual(1, self.times.first_poll_delay(
+            'model', states.POWER_ON, 1))
+
+    def test_stats(self):
+        self._record(range(1, 101))
+        self._record([5], state=states.POWER_OFF)
+        expected = {'model': {
+            states.POWER_ON: {'count': 100, 'p50': 50, 'p90': 90, 'p99': 99},
+            states.POWER_OFF: {'count': 1, 'p50': 5, 'p90': 5, 'p99': 5}}}
+        self.assertEqual(expected, self.times.stats())
+
+    def test_clear(self):
+        self._record([10, 10, 10])
+        self.times.clear()
+        self.assertEqual({}, self.times.stats())
+
+    def test_get_transition_times(self):
+        self.assertIs(power_timing.get_transition_times(),
+                      power_timing.get_transition_times())
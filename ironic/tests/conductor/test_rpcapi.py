@@ -100,6 +100,16 @@ class RPCAPITestCase(base.DbTestCase):
                           rpcapi.get_topic_for_driver,
                           'fake-driver')
 
+    def test_get_topics_for_driver(self):
+        for host in ('fake-host1', 'fake-host2'):
+            self.dbapi.register_conductor({
+                'hostname': host,
+                'drivers': ['fake-driver'],
+            })
+        rpcapi = conductor_rpcapi.ConductorAPI(topic='fake-topic')
+        self.assertEqual(['fake-topic.fake-host1', 'fake-topic.fake-host2'],
+                         sorted(rpcapi.get_topics_for_driver('fake-driver')))
+
     def _test_rpcapi(self, method, rpc_method, **kwargs):
         ctxt = context.get_admin_context()
         rpcapi = conductor_rpcapi.ConductorAPI(topic='fake-topic')
@@ -170,6 +180,13 @@ class RPCAPITestCase(base.DbTestCase):
                           driver_method='test-driver-method',
                           info={'test_key': 'test_value'})
 
+    def test_warm_image_cache(self):
+        self._test_rpcapi('warm_image_cache',
+                          'cast',
+                          version='1.16',
+                          driver_name='test-driver-name',
+                          image_hrefs=['image1', 'image2'])
+
     def test_do_node_deploy(self):
         self._test_rpcapi('do_node_deploy',
                           'call',
@@ -39,6 +39,8 @@ class IloCommonMethodsTestCase(base.TestCase):
 
     def setUp(self):
         super(IloCommonMethodsTestCase, self).setUp()
+        ilo_common.clear_ilo_caches()
+        self.addCleanup(ilo_common.clear_ilo_caches)
         self.dbapi = dbapi.get_instance()
         self.context = context.get_admin_context()
 
@@ -140,6 +142,7 @@ class IloCommonMethodsTestCase(base.TestCase):
         self.assertEqual(license, ilo_common.ADVANCED_LICENSE)
 
         ilo_mock_object.get_all_licenses.return_value = ilo_standard_license
+        ilo_common.invalidate_ilo_license(node)
         license = ilo_common.get_ilo_license(node)
         self.assertEqual(license, ilo_common.STANDARD_LICENSE)
 
@@ -154,3 +157,108 @@ class IloCommonMethodsTestCase(base.TestCase):
         self.assertRaises(exception.IloOperationError,
                           ilo_common.get_ilo_license,
                           node)
+
+    @mock.patch('time.time')
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_license_fail_invalidates(self, ilo_client_mock,
+                                              time_mock):
+        self.config(license_cache_ttl=100, group='ilo')
+        node = obj_utils.create_test_node(self.context,
+                                          driver='ilo',
+                                          driver_info=INFO_DICT)
+        ilo_client_mock.IloError = Exception
+        ilo_mock_object = ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_all_licenses.return_value = {
+            'LICENSE_TYPE': 'iLO 3 Advanced'}
+        time_mock.return_value = 1000
+        ilo_common.get_ilo_license(node)
+
+        # Once the cached license expired, the iLO fails.
+        time_mock.return_value = 1101
+        ilo_mock_object.get_all_licenses.side_effect = Exception()
+        self.assertRaises(exception.IloOperationError,
+                          ilo_common.get_ilo_license, node)
+        self.assertEqual({}, ilo_common._LICENSES)
+        ilo_common.get_ilo_object(node)
+        self.assertEqual(2, ilo_client_mock.IloClient.call_count)
+
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_object_cached(self, ilo_client_mock):
+        node = obj_utils.create_test_node(self.context,
+                                          driver='ilo',
+                                          driver_info=INFO_DICT)
+        first = ilo_common.get_ilo_object(node)
+        second = ilo_common.get_ilo_object(node)
+        self.assertIs(first, second)
+        self.assertEqual(1, ilo_client_mock.IloClient.call_count)
+
+        ilo_common.invalidate_ilo_object(node)
+        ilo_common.get_ilo_object(node)
+        self.assertEqual(2, ilo_client_mock.IloClient.call_count)
+
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_object_lru(self, ilo_client_mock):
+        self.config(client_cache_size=2, group='ilo')
+        ilo_client_mock.IloClient.side_effect = lambda *args: mock.Mock()
+        nodes = []
+        for address in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            info = dict(INFO_DICT, ilo_address=address)
+            nodes.append(obj_utils.get_test_node(self.context, driver='ilo',
+                                                 driver_info=info))
+        first = ilo_common.get_ilo_object(nodes[0])
+        ilo_common.get_ilo_object(nodes[1])
+        # Use the first one again, so that the second one is evicted
+        self.assertIs(first, ilo_common.get_ilo_object(nodes[0]))
+        ilo_common.get_ilo_object(nodes[2])
+        self.assertEqual(3, ilo_client_mock.IloClient.call_count)
+
+        self.assertIs(first, ilo_common.get_ilo_object(nodes[0]))
+        ilo_common.get_ilo_object(nodes[1])
+        self.assertEqual(4, ilo_client_mock.IloClient.call_count)
+
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_object_cache_disabled(self, ilo_client_mock):
+        self.config(client_cache_size=0, group='ilo')
+        node = obj_utils.create_test_node(self.context,
+                                          driver='ilo',
+                                          driver_info=INFO_DICT)
+        ilo_common.get_ilo_object(node)
+        ilo_common.get_ilo_object(node)
+        self.assertEqual(2, ilo_client_mock.IloClient.call_count)
+
+    @mock.patch('time.time')
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_license_cached(self, ilo_client_mock, time_mock):
+        self.config(license_cache_ttl=100, group='ilo')
+        node = obj_utils.create_test_node(self.context,
+                                          driver='ilo',
+                                          driver_info=INFO_DICT)
+        ilo_mock_object = ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_all_licenses.return_value = {
+            'LICENSE_TYPE': 'iLO 3 Advanced'}
+
+        time_mock.return_value = 1000
+        for i in range(3):
+            self.assertEqual(ilo_common.ADVANCED_LICENSE,
+                             ilo_common.get_ilo_license(node))
+        ilo_mock_object.get_all_licenses.assert_called_once_with()
+
+        ilo_mock_object.get_all_licenses.return_value = {
+            'LICENSE_TYPE': 'iLO 3 Essentials'}
+        time_mock.return_value = 1101
+        self.assertEqual(ilo_common.ESSENTIALS_LICENSE,
+                         ilo_common.get_ilo_license(node))
+        self.assertEqual(2, ilo_mock_object.get_all_licenses.call_count)
+
+    @mock.patch.object(ilo_common, 'ilo_client')
+    def test_get_ilo_license_cache_disabled(self, ilo_client_mock):
+        self.config(license_cache_ttl=0, group='ilo')
+        node = obj_utils.create_test_node(self.context,
+                                          driver='ilo',
+                                          driver_info=INFO_DICT)
+        ilo_mock_object = ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_all_licenses.return_value = {
+            'LICENSE_TYPE': 'iLO 3'}
+        ilo_common.get_ilo_license(node)
+        ilo_common.get_ilo_license(node)
+        self.assertEqual(2, ilo_mock_object.get_all_licenses.call_count)
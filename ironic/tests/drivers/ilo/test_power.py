@@ -20,6 +20,7 @@ from oslo.config import cfg
 
 from ironic.common import exception
 from ironic.common import states
+from ironic.conductor import power_timing
 from ironic.conductor import task_manager
 from ironic.db import api as dbapi
 from ironic.drivers.modules.ilo import common as ilo_common
@@ -43,6 +44,8 @@ class IloPowerInternalMethodsTestCase(base.TestCase):
 
     def setUp(self):
         super(IloPowerInternalMethodsTestCase, self).setUp()
+        ilo_common.clear_ilo_caches()
+        self.addCleanup(ilo_common.clear_ilo_caches)
         driver_info = INFO_DICT
         mgr_utils.mock_the_extension_manager(driver="ilo")
         n = db_utils.get_test_node(
@@ -74,12 +77,15 @@ class IloPowerInternalMethodsTestCase(base.TestCase):
                                    common_ilo_client_mock):
         power_ilo_client_mock.IloError = Exception
         ilo_mock_object = common_ilo_client_mock.IloClient.return_value
-        ilo_mock_object.get_host_power_status.side_effect = [Exception()]
+        ilo_mock_object.get_host_power_status.side_effect = [Exception(), 'ON']
 
         self.assertRaises(exception.IloOperationError,
                          ilo_power._get_power_state,
                          self.node)
         ilo_mock_object.get_host_power_status.assert_called_once_with()
+        # A new IloClient is created on the next operation.
+        ilo_power._get_power_state(self.node)
+        self.assertEqual(2, common_ilo_client_mock.IloClient.call_count)
 
     def test__set_power_state_invalid_state(self, power_ilo_client_mock,
                                             common_ilo_client_mock):
@@ -100,6 +106,7 @@ class IloPowerInternalMethodsTestCase(base.TestCase):
                           self.node,
                           states.REBOOT)
         ilo_mock_object.reset_server.assert_called_once_with()
+        self.assertEqual({}, ilo_common._ILO_OBJECTS)
 
     def test__set_power_state_reboot_ok(self, power_ilo_client_mock,
                                         common_ilo_client_mock):
@@ -136,12 +143,86 @@ class IloPowerInternalMethodsTestCase(base.TestCase):
         ilo_mock_object.get_host_power_status.assert_called_with()
         ilo_mock_object.set_host_power.assert_called_once_with('ON')
 
+    @mock.patch.object(power_timing.TransitionTimes, 'record', autospec=True)
+    @mock.patch.object(power_timing.TransitionTimes, 'first_poll_delay',
+                       autospec=True)
+    @mock.patch('eventlet.greenthread.sleep')
+    def test__wait_for_state_change_adaptive(self, sleep_mock, delay_mock,
+                                             record_mock,
+                                             power_ilo_client_mock,
+                                             common_ilo_client_mock):
+        CONF.set_override('power_retry', 6, 'ilo')
+        CONF.set_override('power_wait', 2, 'ilo')
+        delay_mock.return_value = 5
+        ilo_mock_object = common_ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_host_power_status.side_effect = ['OFF', 'ON']
+
+        state = ilo_power._wait_for_state_change(self.node, states.POWER_ON)
+
+        self.assertEqual(states.POWER_ON, state)
+        model = power_timing.model_key(self.node)
+        delay_mock.assert_called_once_with(mock.ANY, model, states.POWER_ON,
+                                           0, maximum=12)
+        # The first poll is at the learned delay and is not deferred.
+        self.assertEqual(5, sleep_mock.call_args_list[0][0][0])
+        self.assertEqual(2, ilo_mock_object.get_host_power_status.call_count)
+        record_mock.assert_called_once_with(mock.ANY, model, states.POWER_ON,
+                                            mock.ANY)
+
+    @mock.patch.object(power_timing.TransitionTimes, 'record', autospec=True)
+    @mock.patch.object(power_timing.TransitionTimes, 'first_poll_delay',
+                       autospec=True)
+    @mock.patch('eventlet.greenthread.sleep')
+    def test__wait_for_state_change_adaptive_reboot(self, sleep_mock,
+                                                    delay_mock, record_mock,
+                                                    power_ilo_client_mock,
+                                                    common_ilo_client_mock):
+        CONF.set_override('power_retry', 6, 'ilo')
+        CONF.set_override('power_wait', 2, 'ilo')
+        delay_mock.return_value = 5
+        ilo_mock_object = common_ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_host_power_status.side_effect = ['ON', 'OFF',
+                                                             'ON']
+
+        state = ilo_power._wait_for_state_change(self.node, states.POWER_ON,
+                                                 reboot=True)
+
+        self.assertEqual(states.POWER_ON, state)
+        model = power_timing.model_key(self.node)
+        delay_mock.assert_called_once_with(mock.ANY, model, states.REBOOT,
+                                           0, maximum=12)
+        # The node is still on before rebooting, the first poll is deferred.
+        self.assertEqual(3, ilo_mock_object.get_host_power_status.call_count)
+        record_mock.assert_called_once_with(mock.ANY, model, states.REBOOT,
+                                            mock.ANY)
+
+    @mock.patch.object(power_timing.TransitionTimes, 'first_poll_delay',
+                       autospec=True)
+    @mock.patch('eventlet.greenthread.sleep')
+    def test__wait_for_state_change_adaptive_timeout(self, sleep_mock,
+                                                     delay_mock,
+                                                     power_ilo_client_mock,
+                                                     common_ilo_client_mock):
+        CONF.set_override('power_retry', 6, 'ilo')
+        CONF.set_override('power_wait', 2, 'ilo')
+        delay_mock.return_value = 5
+        ilo_mock_object = common_ilo_client_mock.IloClient.return_value
+        ilo_mock_object.get_host_power_status.return_value = 'OFF'
+
+        state = ilo_power._wait_for_state_change(self.node, states.POWER_ON)
+
+        self.assertEqual(states.ERROR, state)
+        # 2 of the 8 polls are skipped by the initial delay.
+        self.assertEqual(6, ilo_mock_object.get_host_power_status.call_count)
+
 
 class IloPowerTestCase(base.TestCase):
 
     def setUp(self):
         self.context = context.get_admin_context()
         super(IloPowerTestCase, self).setUp()
+        ilo_common.clear_ilo_caches()
+        self.addCleanup(ilo_common.clear_ilo_caches)
         driver_info = INFO_DICT
         mgr_utils.mock_the_extension_manager(driver="ilo")
         self.dbapi = dbapi.get_instance()
@@ -14,14 +14,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import fixtures
 import itertools
 import mock
 import os
+import socket
+import struct
 import tempfile
+import threading
+import time
 
 from ironic.common import disk_partitioner
 from ironic.common import exception
+from ironic.common import images
 from ironic.common import utils as common_utils
 from ironic.drivers.modules import deploy_utils as utils
 from ironic.openstack.common import processutils
@@ -95,7 +101,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
 
         name_list = ['get_dev', 'get_image_mb', 'discovery', 'login_iscsi',
                      'logout_iscsi', 'delete_iscsi', 'make_partitions',
-                     'is_block_device', 'dd', 'mkswap', 'block_uuid',
+                     'is_block_device', 'copy_image', 'mkswap', 'block_uuid',
                      'switch_pxe_config', 'notify', 'destroy_disk_metadata',
                      'has_partition_table']
         parent_mock = self._mock_calls(name_list)
@@ -106,6 +112,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
         parent_mock.make_partitions.return_value = {'root': root_part,
                                                     'swap': swap_part}
         parent_mock.has_partition_table.return_value = False
+        parent_mock.notify.return_value = 1.5
         calls_expected = [mock.call.get_dev(address, port, iqn, lun),
                           mock.call.get_image_mb(image_path),
                           mock.call.discovery(address, port),
@@ -118,8 +125,8 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                                                     commit=True),
                           mock.call.is_block_device(root_part),
                           mock.call.is_block_device(swap_part),
-                          mock.call.dd(image_path, root_part),
                           mock.call.mkswap(swap_part),
+                          mock.call.copy_image(image_path, root_part),
                           mock.call.block_uuid(root_part),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn),
@@ -127,11 +134,12 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                                                       root_uuid),
                           mock.call.notify(address, 10000)]
 
-        utils.deploy(address, port, iqn, lun, image_path, pxe_config_path,
-                     root_mb, swap_mb, ephemeral_mb, ephemeral_format,
-                     node_uuid)
+        latency = utils.deploy(address, port, iqn, lun, image_path,
+                               pxe_config_path, root_mb, swap_mb,
+                               ephemeral_mb, ephemeral_format, node_uuid)
 
         self.assertEqual(calls_expected, parent_mock.mock_calls)
+        self.assertEqual(1.5, latency)
 
     def test_deploy_without_swap(self):
         """Check loosely all functions are called with right args."""
@@ -153,7 +161,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
 
         name_list = ['get_dev', 'get_image_mb', 'discovery', 'login_iscsi',
                      'logout_iscsi', 'delete_iscsi', 'make_partitions',
-                     'is_block_device', 'dd', 'block_uuid',
+                     'is_block_device', 'copy_image', 'block_uuid',
                      'switch_pxe_config', 'notify', 'destroy_disk_metadata',
                      'has_partition_table']
         parent_mock = self._mock_calls(name_list)
@@ -174,7 +182,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                                                     ephemeral_mb,
                                                     commit=True),
                           mock.call.is_block_device(root_part),
-                          mock.call.dd(image_path, root_part),
+                          mock.call.copy_image(image_path, root_part),
                           mock.call.block_uuid(root_part),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn),
@@ -210,7 +218,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
 
         name_list = ['get_dev', 'get_image_mb', 'discovery', 'login_iscsi',
                      'logout_iscsi', 'delete_iscsi', 'make_partitions',
-                     'is_block_device', 'dd', 'mkswap', 'block_uuid',
+                     'is_block_device', 'copy_image', 'mkswap', 'block_uuid',
                      'switch_pxe_config', 'notify', 'mkfs_ephemeral',
                      'destroy_disk_metadata', 'has_partition_table']
         parent_mock = self._mock_calls(name_list)
@@ -235,10 +243,10 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                           mock.call.is_block_device(root_part),
                           mock.call.is_block_device(swap_part),
                           mock.call.is_block_device(ephemeral_part),
-                          mock.call.dd(image_path, root_part),
                           mock.call.mkswap(swap_part),
                           mock.call.mkfs_ephemeral(ephemeral_part,
                                                    ephemeral_format),
+                          mock.call.copy_image(image_path, root_part),
                           mock.call.block_uuid(root_part),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn),
@@ -274,7 +282,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
 
         name_list = ['get_dev', 'get_image_mb', 'discovery', 'login_iscsi',
                      'logout_iscsi', 'delete_iscsi', 'make_partitions',
-                     'is_block_device', 'dd', 'mkswap', 'block_uuid',
+                     'is_block_device', 'copy_image', 'mkswap', 'block_uuid',
                      'switch_pxe_config', 'notify', 'mkfs_ephemeral',
                      'get_dev_block_size', 'has_partition_table']
         parent_mock = self._mock_calls(name_list)
@@ -299,8 +307,8 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                           mock.call.is_block_device(root_part),
                           mock.call.is_block_device(swap_part),
                           mock.call.is_block_device(ephemeral_part),
-                          mock.call.dd(image_path, root_part),
                           mock.call.mkswap(swap_part),
+                          mock.call.copy_image(image_path, root_part),
                           mock.call.block_uuid(root_part),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn),
@@ -391,8 +399,8 @@ class PhysicalWorkTestCase(tests_base.TestCase):
         dev = '/dev/fake'
 
         name_list = ['get_dev', 'get_image_mb', 'discovery', 'login_iscsi',
-                     'logout_iscsi','delete_iscsi', 'is_block_device', 'dd',
-                     'notify', 'has_partition_table',
+                     'logout_iscsi', 'delete_iscsi', 'is_block_device',
+                     'copy_image', 'notify', 'has_partition_table',
                      'block_uuid', 'switch_pxe_config']
         parent_mock = self._mock_calls(name_list)
         parent_mock.get_dev.return_value = dev
@@ -405,7 +413,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                           mock.call.login_iscsi(address, port, iqn),
                           mock.call.has_partition_table(image_path),
                           mock.call.is_block_device(dev),
-                          mock.call.dd(image_path, dev),
+                          mock.call.copy_image(image_path, dev),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn),
                           mock.call.switch_pxe_config(pxe_config_path, None),
@@ -442,7 +450,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
             pass
 
         name_list = ['get_dev', 'discovery', 'login_iscsi', 'logout_iscsi',
-                     'delete_iscsi', 'is_block_device', 'dd',
+                     'delete_iscsi', 'is_block_device', 'copy_image',
                      'has_partition_table', 'get_image_mb']
         patch_list = [mock.patch.object(utils, name) for name in name_list]
         mock_list = [patcher.start() for patcher in patch_list]
@@ -456,7 +464,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
         parent_mock.get_dev.return_value = dev
         parent_mock.get_image_mb.return_value = 0
         parent_mock.is_block_device.return_value = True
-        parent_mock.dd.side_effect = TestException
+        parent_mock.copy_image.side_effect = TestException
         parent_mock.has_partition_table.return_value = True
         calls_expected = [mock.call.get_dev(address, port, iqn, lun),
                           mock.call.get_image_mb(image_path),
@@ -464,7 +472,7 @@ class PhysicalWorkTestCase(tests_base.TestCase):
                           mock.call.login_iscsi(address, port, iqn),
                           mock.call.has_partition_table(image_path),
                           mock.call.is_block_device(dev),
-                          mock.call.dd(image_path, dev),
+                          mock.call.copy_image(image_path, dev),
                           mock.call.logout_iscsi(address, port, iqn),
                           mock.call.delete_iscsi(address, port, iqn)]
 
@@ -492,6 +500,74 @@ class SwitchPxeConfigTestCase(tests_base.TestCase):
         self.assertEqual(_PXECONF_BOOT, pxeconf)
 
 
+class NotifyTestCase(tests_base.TestCase):
+    def setUp(self):
+        super(NotifyTestCase, self).setUp()
+        self.config(notify_retry_interval=0.01, group='deploy')
+        # NOTE: reserve a free port, left closed until the test listens on it
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.received = []
+
+    def _listen_late(self, delay):
+        ready = threading.Event()
+
+        def listen():
+            time.sleep(delay)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('127.0.0.1', self.port))
+            sock.listen(1)
+            ready.set()
+            try:
+                conn, addr = sock.accept()
+                self.received.append(conn.recv(16))
+                conn.close()
+            finally:
+                sock.close()
+
+        thread = threading.Thread(target=listen)
+        thread.start()
+        return thread, ready
+
+    def test_notify(self):
+        thread, ready = self._listen_late(0)
+        ready.wait()
+        latency = utils.notify('127.0.0.1', self.port, timeout=5)
+        thread.join()
+        self.assertEqual(['done'], self.received)
+        self.assertTrue(latency >= 0)
+
+    def test_notify_listener_starts_late(self):
+        thread, ready = self._listen_late(0.2)
+        with mock.patch.object(socket, 'create_connection',
+                               wraps=socket.create_connection) as connect:
+            latency = utils.notify('127.0.0.1', self.port, timeout=5)
+        thread.join()
+        self.assertEqual(['done'], self.received)
+        self.assertTrue(latency >= 0.2)
+        self.assertTrue(connect.call_count > 1)
+
+    def test_notify_backoff(self):
+        self.config(notify_max_retry_interval=0.04, group='deploy')
+        with mock.patch.object(socket, 'create_connection',
+                               side_effect=socket.error()):
+            with mock.patch.object(time, 'sleep') as sleep_mock:
+                with mock.patch.object(time, 'time') as time_mock:
+                    time_mock.side_effect = itertools.count()
+                    self.assertRaises(socket.error, utils.notify,
+                                      '127.0.0.1', self.port, timeout=8.5)
+        self.assertEqual([mock.call(0.01), mock.call(0.02),
+                          mock.call(0.04), mock.call(0.04)],
+                         sleep_mock.call_args_list)
+
+    def test_notify_timeout(self):
+        self.assertRaises(socket.error, utils.notify, '127.0.0.1',
+                          self.port, timeout=0.1)
+
+
 class OtherFunctionTestCase(tests_base.TestCase):
     def test_get_dev(self):
         expected = '/dev/disk/by-path/ip-1.2.3.4:5678-iscsi-iqn.fake-lun-9'
@@ -515,6 +591,12 @@ class OtherFunctionTestCase(tests_base.TestCase):
         size = mb + 1
         self.assertEqual(2, utils.get_image_mb('x'))
 
+    @mock.patch.object(images, 'sniff_image_info')
+    def test_get_image_mb_qcow2(self, sniff_mock):
+        sniff_mock.return_value.file_format = 'qcow2'
+        sniff_mock.return_value.virtual_size = 10 * 1024 * 1024 + 1
+        self.assertEqual(11, utils.get_image_mb('x'))
+
 
 @mock.patch.object(disk_partitioner.DiskPartitioner, 'commit', lambda _: None)
 class WorkOnDiskTestCase(tests_base.TestCase):
@@ -601,6 +683,65 @@ class WorkOnDiskTestCase(tests_base.TestCase):
                                              self.swap_mb, ephemeral_mb,
                                              commit=True)
 
+    @mock.patch.object(utils, 'block_uuid')
+    @mock.patch.object(utils, 'copy_image')
+    @mock.patch.object(utils, 'mkswap')
+    def test_format_during_copy(self, mock_mkswap, mock_copy, mock_uuid):
+        self.mock_ibd.return_value = True
+        formatting = threading.Event()
+        copied = threading.Event()
+        results = {}
+
+        def mkswap(part):
+            formatting.set()
+            copied.wait(5)
+            results['copied while formatting'] = copied.is_set()
+
+        def copy_image(src, dst):
+            results['formatting while copying'] = formatting.is_set()
+            copied.set()
+
+        mock_mkswap.side_effect = mkswap
+        mock_copy.side_effect = copy_image
+        mock_uuid.return_value = 'uuid'
+        self.assertEqual('uuid', utils.work_on_disk(
+            self.dev, self.root_mb, self.swap_mb, self.ephemeral_mb,
+            self.ephemeral_format, self.image_path, 'node'))
+        self.assertEqual({'copied while formatting': True,
+                          'formatting while copying': True}, results)
+
+    @mock.patch.object(utils, 'block_uuid')
+    @mock.patch.object(utils, 'copy_image')
+    @mock.patch.object(utils, 'mkswap')
+    def test_copy_failure(self, mock_mkswap, mock_copy, mock_uuid):
+        self.mock_ibd.return_value = True
+        mock_copy.side_effect = exception.InstanceDeployFailure('copy')
+        mock_mkswap.side_effect = processutils.ProcessExecutionError()
+        self.assertRaises(exception.InstanceDeployFailure,
+                          utils.work_on_disk, self.dev, self.root_mb,
+                          self.swap_mb, self.ephemeral_mb,
+                          self.ephemeral_format, self.image_path, 'node')
+        mock_mkswap.assert_called_once_with(self.swap_part)
+        self.assertFalse(mock_uuid.called)
+
+    @mock.patch.object(utils, 'block_uuid')
+    @mock.patch.object(utils, 'copy_image')
+    @mock.patch.object(utils, 'mkfs_ephemeral')
+    @mock.patch.object(utils, 'mkswap')
+    def test_format_failure(self, mock_mkswap, mock_mkfs, mock_copy,
+                            mock_uuid):
+        self.mock_ibd.return_value = True
+        self.mock_mp.return_value = {'ephemeral': '/dev/fake-part1',
+                                     'swap': '/dev/fake-part2',
+                                     'root': '/dev/fake-part3'}
+        mock_mkfs.side_effect = processutils.ProcessExecutionError()
+        self.assertRaises(processutils.ProcessExecutionError,
+                          utils.work_on_disk, self.dev, self.root_mb,
+                          self.swap_mb, 256, 'ext4', self.image_path, 'node')
+        mock_copy.assert_called_once_with(self.image_path, '/dev/fake-part3')
+        mock_mkswap.assert_called_once_with('/dev/fake-part2')
+        self.assertFalse(mock_uuid.called)
+
 
 @mock.patch.object(common_utils, 'execute')
 class MakePartitionsTestCase(tests_base.TestCase):
@@ -707,9 +848,381 @@ class GetDeviceBlockSizeTestCase(tests_base.TestCase):
         mock_exec.assert_has_calls(expected_call)
 
 
+class SparseCopyTestCase(tests_base.TestCase):
+
+    def setUp(self):
+        super(SparseCopyTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(tmp_dir, 'image')
+        self.dst = os.path.join(tmp_dir, 'disk')
+        with open(self.dst, 'wb') as f:
+            f.write(b'x' * 5 * 1024 * 1024)
+
+    def _make_image(self, size, data):
+        with open(self.src, 'wb') as f:
+            f.truncate(size)
+            for offset, chunk in data.items():
+                f.seek(offset)
+                f.write(chunk)
+
+    def _assert_copied(self):
+        with open(self.src, 'rb') as src:
+            with open(self.dst, 'rb') as dst:
+                self.assertTrue(src.read() == dst.read(),
+                                'image was not copied')
+
+    def test_sparse_image(self):
+        size = 4 * 1024 * 1024
+        self._make_image(size, {0: b'a' * 10, 2 * 1024 * 1024 + 100: b'b'})
+        written = utils.sparse_copy(self.src, self.dst,
+                                    buffer_size=1024 * 1024)
+        self._assert_copied()
+        self.assertTrue(0 < written < size)
+
+    def test_zero_blocks(self):
+        size = 2 * 1024 * 1024
+        with open(self.src, 'wb') as f:
+            f.write(b'\0' * size)
+            f.seek(utils.ZERO_BLOCK_SIZE * 3 + 1)
+            f.write(b'c')
+        written = utils.sparse_copy(self.src, self.dst)
+        self._assert_copied()
+        self.assertEqual(utils.ZERO_BLOCK_SIZE, written)
+
+    def test_unaligned_tail(self):
+        self._make_image(5000, {0: b'd' * 5000})
+        written = utils.sparse_copy(self.src, self.dst)
+        self._assert_copied()
+        self.assertEqual(5000, written)
+
+    @mock.patch.object(utils, '_COPY_THROTTLE')
+    def test_throttled(self, throttle_mock):
+        self._make_image(8192, {0: b'a' * 10, 4096: b'b' * 5000})
+        written = utils.sparse_copy(self.src, self.dst)
+        self._assert_copied()
+        self.assertEqual(written, sum(c[0][0] for c in
+                                      throttle_mock.consume.call_args_list))
+
+    def test_blocking_calls_in_native_threads(self):
+        self._make_image(8192, {0: b'a' * 10})
+        with mock.patch.object(utils.tpool, 'execute',
+                               side_effect=lambda func, *args: func(*args)
+                               ) as execute_mock:
+            utils.sparse_copy(self.src, self.dst)
+        self._assert_copied()
+        funcs = [c[0][0] for c in execute_mock.call_args_list]
+        self.assertIn(utils._write_all, funcs)
+        self.assertIn(os.fsync, funcs)
+        self.assertTrue(any(getattr(f, '__name__', None) == 'readinto'
+                            for f in funcs))
+
+    def test_empty_image(self):
+        self._make_image(0, {})
+        self.assertEqual(0, utils.sparse_copy(self.src, self.dst))
+        self._assert_copied()
+
+    @mock.patch.object(os, 'lseek')
+    def test_data_extents_unsupported(self, lseek_mock):
+        lseek_mock.side_effect = OSError(errno.EINVAL, 'Invalid argument')
+        self.assertEqual([(0, 100)], list(utils._data_extents(0, 100)))
+
+    @mock.patch('fcntl.ioctl')
+    def test_fill_hole_zero(self, ioctl_mock):
+        utils._fill_hole(3, 4096, 8192, 'zero', None)
+        ioctl_mock.assert_called_once_with(3, utils.BLKZEROOUT,
+                                           struct.pack('QQ', 4096, 8192))
+
+    @mock.patch('fcntl.ioctl')
+    def test_fill_hole_zero_unsupported(self, ioctl_mock):
+        ioctl_mock.side_effect = IOError(errno.ENOTTY, 'Not supported')
+        fd = os.open(self.dst, os.O_WRONLY)
+        try:
+            utils._fill_hole(fd, 4096, 8192, 'zero', b'\0' * 4096)
+        finally:
+            os.close(fd)
+        with open(self.dst, 'rb') as f:
+            data = f.read(4 * 4096)
+        self.assertEqual(b'x' * 4096 + b'\0' * 8192 + b'x' * 4096, data)
+
+    @mock.patch('fcntl.ioctl')
+    def test_fill_hole_discard_unsupported(self, ioctl_mock):
+        ioctl_mock.side_effect = [IOError(errno.EOPNOTSUPP, 'Not supported'),
+                                  None]
+        utils._fill_hole(3, 4096, 8192, 'discard', None)
+        self.assertEqual([mock.call(3, utils.BLKDISCARD,
+                                    struct.pack('QQ', 4096, 8192)),
+                          mock.call(3, utils.BLKZEROOUT,
+                                    struct.pack('QQ', 4096, 8192))],
+                         ioctl_mock.call_args_list)
+
+    @mock.patch('fcntl.ioctl')
+    def test_fill_hole_skip(self, ioctl_mock):
+        utils._fill_hole(3, 4096, 8192, 'skip', None)
+        self.assertFalse(ioctl_mock.called)
+
+    def test_default_holes_zeroed(self):
+        self.assertEqual('zero', utils.CONF.deploy.sparse_copy_holes)
+
+    def _open_block_device(self, holes, discard_zeroes, discard_error=None):
+        def ioctl(fd, request, arg):
+            if request == utils.BLKDISCARDZEROES:
+                return struct.pack('I', discard_zeroes)
+            if discard_error is not None:
+                raise discard_error
+
+        target = utils._CopyTarget(self.dst)
+        with mock.patch.object(utils.stat, 'S_ISBLK', return_value=True):
+            with mock.patch('fcntl.ioctl', side_effect=ioctl) as ioctl_mock:
+                target.open(8192, holes)
+        self.addCleanup(target.close)
+        return target, ioctl_mock
+
+    def test_open_skip_discards_device(self):
+        target, ioctl_mock = self._open_block_device('skip', 1)
+        self.assertEqual('skip', target.holes)
+        ioctl_mock.assert_called_with(target.fd, utils.BLKDISCARD,
+                                      struct.pack('QQ', 0, 8192))
+
+    def test_open_skip_discard_not_zeroing(self):
+        target, ioctl_mock = self._open_block_device('skip', 0)
+        self.assertEqual('zero', target.holes)
+        self.assertEqual(1, ioctl_mock.call_count)
+
+    def test_open_skip_discard_failure(self):
+        target, ioctl_mock = self._open_block_device(
+            'skip', 1, IOError(errno.EOPNOTSUPP, 'Not supported'))
+        self.assertEqual('zero', target.holes)
+
+    def test_open_discard_not_zeroing(self):
+        target, ioctl_mock = self._open_block_device('discard', 0)
+        self.assertEqual('zero', target.holes)
+
+    def test_open_zero(self):
+        target, ioctl_mock = self._open_block_device('zero', 1)
+        self.assertEqual('zero', target.holes)
+        self.assertFalse(ioctl_mock.called)
+
+    @mock.patch.object(utils, '_set_direct')
+    @mock.patch('fcntl.fcntl')
+    def test_write_at_unaligned_restores_direct(self, fcntl_mock,
+                                                set_direct_mock):
+        fcntl_mock.return_value = os.O_WRONLY | utils.O_DIRECT
+        fd = os.open(self.dst, os.O_WRONLY)
+        try:
+            utils._write_at(fd, 0, b'd' * 5000, 0, 5000)
+        finally:
+            os.close(fd)
+        self.assertEqual([mock.call(fd, False), mock.call(fd, True)],
+                         set_direct_mock.call_args_list)
+
+    @mock.patch.object(utils, '_set_direct')
+    def test_write_at_aligned_keeps_direct(self, set_direct_mock):
+        fd = os.open(self.dst, os.O_WRONLY)
+        try:
+            utils._write_at(fd, 0, b'd' * 4096, 0, 4096)
+        finally:
+            os.close(fd)
+        self.assertFalse(set_direct_mock.called)
+
+
+class FanOutCopyTestCase(tests_base.TestCase):
+
+    def setUp(self):
+        super(FanOutCopyTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'image')
+        with open(self.src, 'wb') as f:
+            f.truncate(3 * 1024 * 1024)
+            f.write(b'a' * 1000)
+            f.seek(2 * 1024 * 1024)
+            f.write(b'b' * 1000)
+        self.config(fanout_window=5, group='deploy')
+        utils._FANOUT_SESSIONS.clear()
+        self.addCleanup(utils._FANOUT_SESSIONS.clear)
+
+    def _assert_copied(self, dst):
+        with open(self.src, 'rb') as src:
+            with open(dst, 'rb') as f:
+                self.assertTrue(src.read() == f.read(),
+                                'image was not copied to %s' % dst)
+
+    def _fanout(self, dsts):
+        """Run fanout_copy() for each target, in parallel."""
+        results = {}
+
+        def wait_for_targets(seconds):
+            # NOTE: called by the first deploy instead of sleeping for the
+            # fanout window, until all deploys joined its session
+            while sum(len(session.targets) for session
+                      in utils._FANOUT_SESSIONS.values()) < len(dsts):
+                time.sleep(0.01)
+
+        def copy(dst):
+            try:
+                results[dst] = utils.fanout_copy(self.src, dst)
+            except Exception as e:
+                results[dst] = e
+
+        time_sleep = time.sleep
+        with mock.patch.object(utils.time, 'sleep') as sleep_mock:
+            sleep_mock.side_effect = lambda s: (
+                wait_for_targets(s) if s == 5 else time_sleep(s))
+            threads = [threading.Thread(target=copy, args=(dst,))
+                       for dst in dsts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_fanout_copy(self):
+        dsts = [os.path.join(self.tmp_dir, 'disk%d' % i) for i in range(3)]
+        with mock.patch.object(utils, '_copy_to_targets',
+                               side_effect=utils._copy_to_targets) as copy:
+            results = self._fanout(dsts)
+        self.assertEqual(1, copy.call_count)
+        for dst in dsts:
+            self._assert_copied(dst)
+            self.assertEqual(2 * utils.COPY_ALIGNMENT, results[dst])
+        self.assertEqual({}, utils._FANOUT_SESSIONS)
+
+    def test_fanout_copy_target_failure(self):
+        bad_dst = os.path.join(self.tmp_dir, 'missing', 'disk')
+        dsts = [os.path.join(self.tmp_dir, 'disk0'), bad_dst,
+                os.path.join(self.tmp_dir, 'disk2')]
+        results = self._fanout(dsts)
+        self.assertIsInstance(results[bad_dst], OSError)
+        self._assert_copied(dsts[0])
+        self._assert_copied(dsts[2])
+
+    def test_copy_to_targets_write_failure(self):
+        targets = [utils._CopyTarget(os.path.join(self.tmp_dir, 'disk%d' % i))
+                   for i in range(2)]
+        write_at = utils._write_at
+
+        def fail_first_target(fd, *args):
+            if fd == targets[0].fd:
+                raise IOError(errno.EIO, 'I/O error')
+            write_at(fd, *args)
+
+        with mock.patch.object(utils, '_write_at',
+                               side_effect=fail_first_target):
+            utils._copy_to_targets(self.src, targets, 'skip', 1024 * 1024)
+        self.assertEqual(errno.EIO, targets[0].error.errno)
+        self.assertEqual(0, targets[0].written)
+        self.assertIsNone(targets[1].error)
+        self._assert_copied(targets[1].path)
+
+
+@mock.patch.object(utils, 'dd')
+@mock.patch.object(utils, 'sparse_copy')
+class CopyImageTestCase(tests_base.TestCase):
+
+    def setUp(self):
+        super(CopyImageTestCase, self).setUp()
+        self.image_info = images.QemuImgInfo()
+        self.image_info.file_format = 'raw'
+        for patcher in (mock.patch.object(images, 'image_info',
+                                          return_value=self.image_info),
+                        mock.patch.object(os.path, 'getsize',
+                                          return_value=1024)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_copy_image(self, sparse_copy_mock, dd_mock):
+        sparse_copy_mock.return_value = 512
+        self.assertEqual(512, utils.copy_image('image', 'dev'))
+        sparse_copy_mock.assert_called_once_with('image', 'dev')
+        self.assertFalse(dd_mock.called)
+
+    @mock.patch.object(utils, 'fanout_copy')
+    def test_copy_image_fanout(self, fanout_copy_mock, sparse_copy_mock,
+                               dd_mock):
+        self.config(fanout_window=5, group='deploy')
+        utils.copy_image('image', 'dev')
+        fanout_copy_mock.assert_called_once_with('image', 'dev')
+        self.assertFalse(sparse_copy_mock.called)
+        self.assertFalse(dd_mock.called)
+
+    def test_copy_image_disabled(self, sparse_copy_mock, dd_mock):
+        self.config(sparse_copy=False, group='deploy')
+        self.assertEqual(1024, utils.copy_image('image', 'dev'))
+        self.assertFalse(sparse_copy_mock.called)
+        dd_mock.assert_called_once_with('image', 'dev')
+
+    def test_copy_image_no_access(self, sparse_copy_mock, dd_mock):
+        sparse_copy_mock.side_effect = OSError(errno.EACCES, 'Denied')
+        utils.copy_image('image', 'dev')
+        dd_mock.assert_called_once_with('image', 'dev')
+
+    def test_copy_image_failure(self, sparse_copy_mock, dd_mock):
+        sparse_copy_mock.side_effect = IOError(errno.EIO, 'I/O error')
+        self.assertRaises(exception.InstanceDeployFailure,
+                          utils.copy_image, 'image', 'dev')
+        self.assertFalse(dd_mock.called)
+
+    @mock.patch.object(common_utils, 'execute')
+    def test_copy_image_convert(self, execute_mock, sparse_copy_mock,
+                                dd_mock):
+        self.image_info.file_format = 'qcow2'
+        utils.copy_image('image', 'dev')
+        execute_mock.assert_called_once_with('qemu-img', 'convert', '-t',
+                                             'none', '-O', 'raw', 'image',
+                                             'dev', run_as_root=True,
+                                             check_exit_code=[0])
+        self.assertFalse(sparse_copy_mock.called)
+        self.assertFalse(dd_mock.called)
+
+
+@mock.patch.object(disk_partitioner, 'get_partition_table')
+class HasPartitionTableTestCase(tests_base.TestCase):
+
+    def setUp(self):
+        super(HasPartitionTableTestCase, self).setUp()
+        self.info = images.QemuImgInfo()
+        self.info.file_format = 'qcow2'
+        self.info.virtual_size = 4 * 1024 * 1024
+
+    def test_raw_image(self, get_table_mock):
+        self.info.file_format = 'raw'
+        get_table_mock.return_value = 'msdos'
+        with mock.patch.object(images, 'sniff_image_info',
+                               return_value=self.info):
+            self.assertTrue(utils.has_partition_table('image'))
+        get_table_mock.assert_called_once_with('image')
+
+    def test_qcow2_image(self, get_table_mock):
+        def check_head(path):
+            self.assertEqual(self.info.virtual_size, os.path.getsize(path))
+            with open(path, 'rb') as f:
+                self.assertEqual(b'head', f.read(4))
+            return 'loop'
+
+        get_table_mock.side_effect = check_head
+        with mock.patch.object(images, 'sniff_image_info',
+                               return_value=self.info):
+            with mock.patch.object(images, 'read_image_head',
+                                   return_value=b'head') as read_mock:
+                self.assertFalse(utils.has_partition_table('image'))
+        read_mock.assert_called_once_with('image',
+                                          utils.PARTITION_TABLE_SIZE)
+        self.assertTrue(get_table_mock.called)
+        self.assertNotEqual('image', get_table_mock.call_args[0][0])
+        self.assertFalse(os.path.exists(get_table_mock.call_args[0][0]))
+
+    def test_unsupported_image(self, get_table_mock):
+        get_table_mock.return_value = 'gpt'
+        with mock.patch.object(images, 'sniff_image_info',
+                               return_value=self.info):
+            with mock.patch.object(images, 'read_image_head',
+                                   return_value=None):
+                self.assertTrue(utils.has_partition_table('image'))
+        get_table_mock.assert_called_once_with('image')
+
+
 @mock.patch.object(utils, 'is_block_device', lambda d: True)
 @mock.patch.object(utils, 'block_uuid', lambda p: 'uuid')
-@mock.patch.object(utils, 'dd', lambda *_: None)
+@mock.patch.object(utils, 'copy_image', lambda *_: None)
 @mock.patch.object(common_utils, 'mkfs', lambda *_: None)
 # NOTE(dtantsur): destroy_disk_metadata resets file size, disabling it
 @mock.patch.object(utils, 'destroy_disk_metadata', lambda *_: None)
@@ -16,9 +16,11 @@
 
 """Tests for ImageCache class and helper functions."""
 
+import eventlet
 import mock
 import os
 import tempfile
+import threading
 import time
 
 from ironic.common import exception
@@ -42,7 +44,18 @@ class TestImageCacheFetch(base.TestCase):
         self.dest_dir = tempfile.mkdtemp()
         self.dest_path = os.path.join(self.dest_dir, 'dest')
         self.uuid = 'uuid'
-        self.master_path = os.path.join(self.master_dir, self.uuid)
+        self.digest = 'c9e1e4fbb2b0ba0f6da6c9c2ab2b7e34'
+        self.master_path = os.path.join(self.master_dir, self.digest)
+        image_cache._DIGESTS.clear()
+        self.addCleanup(image_cache._DIGESTS.clear)
+        image_cache._DIGEST_DIRS.clear()
+        self.addCleanup(image_cache._DIGEST_DIRS.clear)
+        image_cache._INDEXES.clear()
+        self.addCleanup(image_cache._INDEXES.clear)
+        show_patcher = mock.patch.object(images, 'image_show')
+        self.mock_show = show_patcher.start()
+        self.mock_show.return_value = {'checksum': self.digest}
+        self.addCleanup(show_patcher.stop)
 
     @mock.patch.object(image_cache.ImageCache, 'clean_up')
     @mock.patch.object(image_cache.ImageCache, '_download_image')
@@ -88,6 +101,153 @@ class TestImageCacheFetch(base.TestCase):
             self.uuid, self.master_path, self.dest_path, ctx=None)
         self.assertTrue(mock_clean_up.called)
 
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_prefetch_image(self, mock_download, mock_clean_up,
+                            mock_fetch_to_raw):
+        self.cache.prefetch_image(self.uuid)
+        mock_download.assert_called_once_with(
+            self.uuid, self.master_path, mock.ANY, ctx=None)
+        dest_path = mock_download.call_args[0][2]
+        self.assertEqual(self.master_dir,
+                         os.path.dirname(os.path.dirname(dest_path)))
+        self.assertFalse(os.path.exists(os.path.dirname(dest_path)))
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_prefetch_image_master_exists(self, mock_download, mock_clean_up,
+                                          mock_fetch_to_raw):
+        touch(self.master_path)
+        self.cache.prefetch_image(self.uuid)
+        self.assertFalse(mock_download.called)
+        self.assertEqual([self.digest], [name for name
+                                         in os.listdir(self.master_dir)
+                                         if not name.startswith('.')])
+        self.assertEqual(1, os.stat(self.master_path).st_nlink)
+
+    def test_prefetch_image_no_master_dir(self, mock_fetch_to_raw):
+        self.cache.master_dir = None
+        self.cache.prefetch_image(self.uuid)
+        self.assertFalse(mock_fetch_to_raw.called)
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_fetch_image_no_checksum(self, mock_download, mock_clean_up,
+                                     mock_fetch_to_raw):
+        self.mock_show.return_value = {'checksum': None}
+        self.cache.fetch_image(self.uuid, self.dest_path)
+        mock_download.assert_called_once_with(
+            self.uuid, None, self.dest_path, ctx=None)
+        self.assertTrue(mock_clean_up.called)
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_fetch_image_same_contents(self, mock_download, mock_clean_up,
+                                       mock_fetch_to_raw):
+        # Another image with the same checksum is already cached
+        touch(self.master_path)
+        self.cache.fetch_image('other-uuid', self.dest_path)
+        self.assertFalse(mock_download.called)
+        self.assertEqual(os.stat(self.dest_path).st_ino,
+                         os.stat(self.master_path).st_ino)
+        self.mock_show.assert_called_once_with(None, 'other-uuid', None)
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_fetch_image_digest_indexed(self, mock_download, mock_clean_up,
+                                        mock_fetch_to_raw):
+        touch(self.master_path)
+        self.cache.fetch_image(self.uuid, self.dest_path)
+        os.unlink(self.dest_path)
+        self.cache.fetch_image(self.uuid, self.dest_path)
+        self.mock_show.assert_called_once_with(None, self.uuid, None)
+
+    @mock.patch.object(images, 'image_to_raw')
+    @mock.patch.object(images, 'fetch')
+    def test__download_image_no_checksum(self, mock_fetch, mock_to_raw,
+                                         mock_fetch_to_raw):
+        def _fake_fetch(ctx, uuid, tmp_part, *args):
+            with open(tmp_part, 'w') as fp:
+                fp.write("TEST")
+
+        def _fake_to_raw(uuid, tmp_path, tmp_part):
+            os.rename(tmp_part, tmp_path)
+
+        mock_fetch.side_effect = _fake_fetch
+        mock_to_raw.side_effect = _fake_to_raw
+        with mock.patch.object(image_cache.tpool, 'execute',
+                               wraps=image_cache.tpool.execute) as execute:
+            self.cache._download_image(self.uuid, None, self.dest_path)
+        execute.assert_called_once_with(image_cache._hash_file, mock.ANY)
+
+        # md5("TEST")
+        master_path = os.path.join(self.master_dir,
+                                   '033bd94b1168d7e4f0d644c3c95e35bf')
+        self.assertEqual(os.stat(self.dest_path).st_ino,
+                         os.stat(master_path).st_ino)
+        self.assertEqual('033bd94b1168d7e4f0d644c3c95e35bf',
+                         self.cache._get_digest(self.uuid))
+        self.assertFalse(self.mock_show.called)
+        self.assertFalse(mock_fetch_to_raw.called)
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    def test_fetch_image_no_checksum_after_restart(self, mock_download,
+                                                   mock_clean_up,
+                                                   mock_fetch_to_raw):
+        self.mock_show.return_value = {'checksum': None}
+        touch(self.master_path)
+        image_cache._set_digest(self.master_dir, self.uuid, self.digest)
+        # The conductor restarts
+        image_cache._DIGESTS.clear()
+        image_cache._DIGEST_DIRS.clear()
+
+        self.cache.fetch_image(self.uuid, self.dest_path)
+        self.assertFalse(mock_download.called)
+        self.assertFalse(self.mock_show.called)
+        self.assertEqual(os.stat(self.dest_path).st_ino,
+                         os.stat(self.master_path).st_ino)
+
+    def test__load_digests_invalid(self, mock_fetch_to_raw):
+        with open(os.path.join(self.master_dir,
+                               image_cache.DIGESTS_FILE_NAME), 'w') as fp:
+            fp.write('{"uuid": ')
+        self.assertEqual(self.digest, self.cache._get_digest(self.uuid))
+        self.mock_show.assert_called_once_with(None, self.uuid, None)
+
+    def test__download_image_same_contents_cached(self, mock_fetch_to_raw):
+        def _fake_fetch_to_raw(ctx, uuid, tmp_path, *args):
+            with open(tmp_path, 'w') as fp:
+                fp.write("TEST")
+
+        mock_fetch_to_raw.side_effect = _fake_fetch_to_raw
+        with open(self.master_path, 'w') as fp:
+            fp.write("TEST")
+        self.cache._download_image(self.uuid, self.master_path,
+                                   self.dest_path)
+        self.assertEqual(os.stat(self.dest_path).st_ino,
+                         os.stat(self.master_path).st_ino)
+        self.assertEqual([self.digest],
+                         [name for name in os.listdir(self.master_dir)
+                          if not name.startswith(image_cache.INDEX_FILE_NAME)])
+
+    def test_dedup_stats(self, mock_fetch_to_raw):
+        for digest in ('a', 'b'):
+            with open(os.path.join(self.master_dir, digest), 'w') as fp:
+                fp.write("TEST")
+        image_cache._set_digest(self.master_dir, 'uuid1', 'a')
+        image_cache._set_digest(self.master_dir, 'uuid2', 'a')
+        image_cache._set_digest(self.master_dir, 'uuid3', 'a')
+        image_cache._set_digest(self.master_dir, 'uuid4', 'b')
+        # Evicted master image and other cache are not accounted
+        image_cache._set_digest(self.master_dir, 'uuid5', 'c')
+        image_cache._set_digest('other', 'uuid6', 'a')
+
+        self.assertEqual({'images': 4, 'unique_images': 2,
+                          'logical_bytes': 16, 'physical_bytes': 8,
+                          'bytes_saved': 8, 'dedup_ratio': 2.0},
+                         self.cache.dedup_stats())
+
     def test__download_image(self, mock_fetch_to_raw):
         def _fake_fetch_to_raw(ctx, uuid, tmp_path, *args):
             self.assertEqual(self.uuid, uuid)
@@ -104,6 +264,288 @@ class TestImageCacheFetch(base.TestCase):
                          os.stat(self.master_path).st_ino)
         with open(self.dest_path) as fp:
             self.assertEqual("TEST", fp.read())
+        index = image_cache._get_index(self.master_dir)
+        self.assertEqual(4, index.total_size)
+        self.assertEqual((self.digest, 4), index.pop_oldest()[:2])
+
+    @mock.patch.object(image_cache.ImageCache, 'clean_up')
+    @mock.patch.object(image_cache.ImageCache, '_download_image')
+    @mock.patch.object(image_cache._SCHEDULER, 'run')
+    def test_fetch_image_download_in_progress(self, mock_run, mock_download,
+                                              mock_clean_up,
+                                              mock_fetch_to_raw):
+        def _fake_run(key, priority, func, *args, **kwargs):
+            # The download was done for another caller
+            touch(self.master_path)
+            return self.master_path, False
+
+        mock_run.side_effect = _fake_run
+        self.cache.fetch_image(self.uuid, self.dest_path)
+        mock_run.assert_called_once_with(
+            (self.master_dir, self.digest), image_cache.PRIORITY_INSTANCE,
+            mock_download, self.uuid, self.master_path, self.dest_path,
+            ctx=None)
+        self.assertEqual(os.stat(self.dest_path).st_ino,
+                         os.stat(self.master_path).st_ino)
+
+
+class TestDownloadScheduler(base.TestCase):
+
+    def setUp(self):
+        super(TestDownloadScheduler, self).setUp()
+        self.scheduler = image_cache._DownloadScheduler()
+        self.config(parallel_image_downloads=True)
+        self.results = []
+
+    def _start(self, key, priority, func, *args):
+        def _run():
+            try:
+                self.results.append(self.scheduler.run(key, priority,
+                                                       func, *args))
+            except Exception as exc:
+                self.results.append(exc)
+
+        thread = threading.Thread(target=_run)
+        thread.start()
+        self.addCleanup(thread.join)
+        return thread
+
+    def _wait_queued(self, count):
+        while len(self.scheduler._queue) != count:
+            time.sleep(0)
+
+    def test_run(self):
+        self.assertEqual((42, True),
+                         self.scheduler.run('key', 0, lambda: 42))
+        self.assertEqual({}, self.scheduler._downloads)
+
+    def test_single_flight(self):
+        release = threading.Event()
+        calls = []
+
+        def _download():
+            calls.append(None)
+            release.wait()
+            return 'master'
+
+        threads = [self._start('key', 0, _download) for i in range(3)]
+        while not calls:
+            time.sleep(0)
+        time.sleep(0)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([('master', True), ('master', False),
+                          ('master', False)], sorted(self.results,
+                                                     reverse=True))
+
+    def test_no_key_not_shared(self):
+        calls = []
+        self.scheduler.run(None, 0, calls.append, 1)
+        self.scheduler.run(None, 0, calls.append, 2)
+        self.assertEqual([1, 2], calls)
+
+    def test_exception_propagated(self):
+        release = threading.Event()
+        calls = []
+
+        def _download():
+            calls.append(None)
+            release.wait()
+            raise exception.ImageUnacceptable(image_id='href',
+                                              reason='boom')
+
+        threads = [self._start('key', 0, _download) for i in range(2)]
+        while not calls:
+            time.sleep(0)
+        time.sleep(0)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, len(self.results))
+        for result in self.results:
+            self.assertIsInstance(result, exception.ImageUnacceptable)
+        self.assertEqual({}, self.scheduler._downloads)
+
+    def test_max_parallel_downloads(self):
+        self.config(max_parallel_image_downloads=2)
+        release = threading.Event()
+        running = []
+        max_running = []
+
+        def _download():
+            running.append(None)
+            max_running.append(len(running))
+            release.wait()
+            running.pop()
+
+        threads = [self._start(key, 0, _download) for key in range(4)]
+        self._wait_queued(2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, max(max_running))
+        self.assertEqual(4, len(max_running))
+
+    def test_serial_downloads(self):
+        self.config(parallel_image_downloads=False,
+                    max_parallel_image_downloads=2)
+        self.assertEqual(1, self.scheduler._max_running())
+
+    def test_priority(self):
+        self.config(max_parallel_image_downloads=1)
+        release = threading.Event()
+        order = []
+
+        def _download(name):
+            order.append(name)
+            if name == 'first':
+                release.wait()
+
+        self._start('first', image_cache.PRIORITY_INSTANCE,
+                    _download, 'first')
+        while not order:
+            time.sleep(0)
+        self._start('instance', image_cache.PRIORITY_INSTANCE,
+                    _download, 'instance')
+        self._wait_queued(1)
+        self._start('kernel', image_cache.PRIORITY_BOOT, _download, 'kernel')
+        self._wait_queued(2)
+        release.set()
+        while len(order) < 3:
+            time.sleep(0)
+        self.assertEqual(['first', 'kernel', 'instance'], order)
+
+    def test_dead_waiter_dropped(self):
+        self.config(max_parallel_image_downloads=1)
+        release = threading.Event()
+        order = []
+
+        def _download(name):
+            order.append(name)
+            if name == 'first':
+                release.wait()
+            return name
+
+        self._start('first', 0, _download, 'first')
+        while not order:
+            time.sleep(0)
+        # The caller of the next download in line dies while it waits
+        dead = eventlet.spawn(self.scheduler.run, 'dead', 0, _download,
+                              'dead')
+        self._wait_queued(1)
+        # Another caller waits for the same download
+        self._start('dead', 0, _download, 'dead')
+        self._start('last', 0, _download, 'last')
+        self._wait_queued(2)
+        dead.kill()
+
+        release.set()
+        while len(self.results) < 3:
+            time.sleep(0)
+        # The other caller started the download over, after the queued one
+        self.assertEqual(['first', 'last', 'dead'], order)
+        self.assertIn(('dead', True), self.results)
+        self.assertEqual([], self.scheduler._queue)
+        self.assertEqual({}, self.scheduler._downloads)
+
+
+class TestCacheIndex(base.TestCase):
+
+    def setUp(self):
+        super(TestCacheIndex, self).setUp()
+        self.master_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.master_dir,
+                                       image_cache.INDEX_FILE_NAME)
+
+    def _create(self, name, contents='123'):
+        with open(os.path.join(self.master_dir, name), 'w') as fp:
+            fp.write(contents)
+
+    def _pop_all(self, index):
+        names = []
+        while True:
+            entry = index.pop_oldest()
+            if entry is None:
+                return names
+            names.append(entry[0])
+
+    def test_load_scans_directory(self):
+        self._create('a')
+        self._create('b', '12345')
+        os.mkdir(os.path.join(self.master_dir, 'tmpdir'))
+        index = image_cache._CacheIndex(self.master_dir)
+        self.assertEqual(2, len(index))
+        self.assertEqual(8, index.total_size)
+        self.assertTrue(os.path.exists(self.index_path))
+
+    @mock.patch.object(time, 'time')
+    def test_persisted(self, mock_time):
+        mock_time.return_value = 1000
+        index = image_cache._CacheIndex(self.master_dir)
+        for name in ('a', 'b', 'c'):
+            self._create(name)
+            index.add(name)
+        mock_time.return_value = 2000
+        index.touch('a')
+        os.unlink(os.path.join(self.master_dir, 'c'))
+        index.remove('c')
+
+        with mock.patch.object(os, 'stat') as mock_stat:
+            index = image_cache._CacheIndex(self.master_dir)
+            self.assertFalse(mock_stat.called)
+        self.assertEqual(6, index.total_size)
+        self.assertEqual(('b', 3, 1000), index.pop_oldest())
+        self.assertEqual(('a', 3, 2000), index.pop_oldest())
+        self.assertIsNone(index.pop_oldest())
+
+    def test_load_reconciles(self):
+        index = image_cache._CacheIndex(self.master_dir)
+        self._create('a')
+        index.add('a')
+        # Changes not recorded because of a crash
+        os.unlink(os.path.join(self.master_dir, 'a'))
+        self._create('b')
+        with open(self.index_path, 'a') as fp:
+            fp.write('["add", "c", 1')
+
+        index = image_cache._CacheIndex(self.master_dir)
+        self.assertEqual(['b'], self._pop_all(index))
+        self.assertEqual(3, index.total_size)
+
+    def test_journal_compacted(self):
+        self._create('a')
+        index = image_cache._CacheIndex(self.master_dir)
+        for i in range(200):
+            index.touch('a')
+        with open(self.index_path) as fp:
+            self.assertTrue(len(fp.readlines()) < 100)
+        self.assertEqual(['a'], self._pop_all(image_cache._CacheIndex(
+            self.master_dir)))
+
+    def test_touch_unknown(self):
+        index = image_cache._CacheIndex(self.master_dir)
+        self._create('a')
+        index.touch('a')
+        index.touch('missing')
+        self.assertEqual(['a'], self._pop_all(index))
+
+    @mock.patch.object(time, 'time')
+    def test_pop_oldest_requeue(self, mock_time):
+        index = image_cache._CacheIndex(self.master_dir)
+        for i, name in enumerate(('a', 'b', 'c')):
+            mock_time.return_value = i
+            self._create(name)
+            index.add(name)
+        mock_time.return_value = 10
+        index.touch('a')
+        self.assertEqual('b', index.pop_oldest()[0])
+        index.requeue(['b'], oldest=True)
+        self.assertEqual(['b', 'c', 'a'], self._pop_all(index))
+        index.requeue(['a', 'b', 'c'], oldest=True)
+        self.assertEqual(['b', 'c', 'a'], self._pop_all(index))
 
 
 class TestImageCacheCleanUp(base.TestCase):
@@ -114,6 +556,8 @@ class TestImageCacheCleanUp(base.TestCase):
         self.cache = image_cache.ImageCache(self.master_dir,
                                             cache_size=10,
                                             cache_ttl=600)
+        image_cache._INDEXES.clear()
+        self.addCleanup(image_cache._INDEXES.clear)
 
     @mock.patch.object(image_cache.ImageCache, '_clean_up_ensure_cache_size')
     def test_clean_up_old_deleted(self, mock_clean_size):
@@ -128,14 +572,15 @@ class TestImageCacheCleanUp(base.TestCase):
         with mock.patch.object(time, 'time', lambda: new_current_time):
             self.cache.clean_up()
 
-        mock_clean_size.assert_called_once_with(mock.ANY, None)
-        survived = mock_clean_size.call_args[0][0]
-        self.assertEqual(1, len(survived))
-        self.assertEqual(files[0], survived[0][0])
+        index = image_cache._get_index(self.master_dir)
+        mock_clean_size.assert_called_once_with(index, None)
+        self.assertEqual(1, len(index))
+        self.assertTrue(os.path.exists(files[0]))
+        self.assertFalse(os.path.exists(files[1]))
+        name, size, last_used = index.pop_oldest()
+        self.assertEqual('0', name)
         # NOTE(dtantsur): do not compare milliseconds
-        self.assertEqual(int(new_current_time - 100), int(survived[0][1]))
-        self.assertEqual(int(new_current_time - 100),
-                         int(survived[0][2].st_mtime))
+        self.assertEqual(int(new_current_time - 100), int(last_used))
 
     @mock.patch.object(image_cache.ImageCache, '_clean_up_ensure_cache_size')
     def test_clean_up_old_with_amount(self, mock_clean_size):
@@ -167,11 +612,13 @@ class TestImageCacheCleanUp(base.TestCase):
 
         for filename in files:
             self.assertTrue(os.path.exists(filename))
-        mock_clean_size.assert_called_once_with([], None)
+        index = image_cache._get_index(self.master_dir)
+        mock_clean_size.assert_called_once_with(index, None)
+        self.assertEqual(4, len(index))
 
     @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
     def test_clean_up_ensure_cache_size(self, mock_clean_ttl):
-        mock_clean_ttl.side_effect = lambda *xx: xx
+        mock_clean_ttl.side_effect = lambda index, amount: amount
         # NOTE(dtantsur): Cache size in test is 10 bytes, we create 6 files
         # with 3 bytes each and expect 3 to be deleted
         files = [os.path.join(self.master_dir, str(i))
@@ -197,7 +644,7 @@ class TestImageCacheCleanUp(base.TestCase):
 
     @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
     def test_clean_up_ensure_cache_size_with_amount(self, mock_clean_ttl):
-        mock_clean_ttl.side_effect = lambda *xx: xx
+        mock_clean_ttl.side_effect = lambda index, amount: amount
         # NOTE(dtantsur): Cache size in test is 10 bytes, we create 6 files
         # with 3 bytes each and set amount to be 15, 5 files are to be deleted
         files = [os.path.join(self.master_dir, str(i))
@@ -222,7 +669,7 @@ class TestImageCacheCleanUp(base.TestCase):
     @mock.patch.object(image_cache.LOG, 'info')
     @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
     def test_clean_up_cache_still_large(self, mock_clean_ttl, mock_log):
-        mock_clean_ttl.side_effect = lambda *xx: xx
+        mock_clean_ttl.side_effect = lambda index, amount: amount
         # NOTE(dtantsur): Cache size in test is 10 bytes, we create 2 files
         # than cannot be deleted and expected this to be logged
         files = [os.path.join(self.master_dir, str(i))
@@ -265,12 +712,96 @@ class TestImageCacheCleanUp(base.TestCase):
                           'uuid', 'fake', 'fake')
         self.assertTrue(mock_rmtree.called)
 
+    def test_clean_up_uses_index(self):
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(self.master_dir, name), 'w') as fp:
+                fp.write('123456')
+        self.cache.clean_up()
+        self.assertEqual(['c'], [
+            name for name in os.listdir(self.master_dir)
+            if not name.startswith(image_cache.INDEX_FILE_NAME)])
+
+        with open(os.path.join(self.master_dir, 'd'), 'w') as fp:
+            fp.write('123456')
+        image_cache._get_index(self.master_dir).add('d')
+        with mock.patch.object(os, 'listdir') as mock_listdir:
+            self.cache.clean_up()
+            self.assertFalse(mock_listdir.called)
+        self.assertFalse(os.path.exists(os.path.join(self.master_dir, 'c')))
+        self.assertTrue(os.path.exists(os.path.join(self.master_dir, 'd')))
+
+    def _create_cache(self, policy, sizes):
+        cache = image_cache.ImageCache(self.master_dir, cache_size=10,
+                                       cache_ttl=600, eviction_policy=policy)
+        for i, (name, size) in enumerate(sizes):
+            with open(os.path.join(self.master_dir, name), 'w') as fp:
+                fp.write('X' * size)
+            with mock.patch.object(time, 'time', lambda: i):
+                cache._index().add(name)
+        return cache
+
+    def _cached(self):
+        return sorted(name for name in os.listdir(self.master_dir)
+                      if not name.startswith(image_cache.INDEX_FILE_NAME))
+
+    @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
+    def test_clean_up_lfu(self, mock_clean_ttl):
+        mock_clean_ttl.side_effect = lambda index, amount: amount
+        cache = self._create_cache('lfu', [('a', 4), ('b', 4), ('c', 4)])
+        index = cache._index()
+        index.touch('a')
+        index.touch('a')
+        index.touch('b')
+        index.touch('c')
+        index.touch('c')
+        cache.clean_up()
+        self.assertEqual(['a', 'c'], self._cached())
+
+    @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
+    def test_clean_up_lru(self, mock_clean_ttl):
+        mock_clean_ttl.side_effect = lambda index, amount: amount
+        cache = self._create_cache('lru', [('a', 4), ('b', 4), ('c', 4)])
+        with mock.patch.object(time, 'time', lambda: 100):
+            cache._index().touch('a')
+        cache.clean_up()
+        self.assertEqual(['a', 'c'], self._cached())
+
+    @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
+    def test_clean_up_gds(self, mock_clean_ttl):
+        mock_clean_ttl.side_effect = lambda index, amount: amount
+        # The large image is evicted even though it was used last
+        cache = self._create_cache('gds', [('a', 2), ('b', 3), ('c', 6)])
+        cache.clean_up()
+        self.assertEqual(['a', 'b'], self._cached())
+
+    def test_gds_policy_ages(self):
+        policy = image_cache.GreedyDualSizePolicy()
+        small = policy.priority(1, 0, 0)
+        self.assertTrue(policy.priority(4, 0, 0) < small)
+        # After the small image is evicted, images used from now on are
+        # kept before those which were not used for a while
+        policy.evicted(small)
+        self.assertTrue(policy.priority(4, 0, 0) > small)
+
+    def test_unknown_policy(self):
+        self.assertRaises(exception.InvalidParameterValue,
+                          image_cache.ImageCache, self.master_dir, 10, 600,
+                          eviction_policy='fifo')
+
+    def test_policy_switched(self):
+        cache = self._create_cache('lru', [('a', 4), ('b', 8)])
+        self.assertEqual('a', cache._index().pop_victim()[0])
+        cache = image_cache.ImageCache(self.master_dir, 10, 600,
+                                       eviction_policy='gds')
+        self.assertEqual('gds', cache._index().policy_name)
+        self.assertEqual('b', cache._index().pop_victim()[0])
+
     @mock.patch.object(image_cache.LOG, 'warn')
     @mock.patch.object(image_cache.ImageCache, '_clean_up_too_old')
     @mock.patch.object(image_cache.ImageCache, '_clean_up_ensure_cache_size')
     def test_clean_up_amount_not_satisfied(self, mock_clean_size,
                                            mock_clean_ttl, mock_log):
-        mock_clean_ttl.side_effect = lambda *xx: xx
-        mock_clean_size.side_effect = lambda listing, amount: amount
+        mock_clean_ttl.side_effect = lambda index, amount: amount
+        mock_clean_size.side_effect = lambda index, amount: amount
         self.cache.clean_up(amount=15)
         self.assertTrue(mock_log.called)
@@ -52,6 +52,8 @@ class IPMINativePrivateMethodTestCase(base.TestCase):
                                                driver_info=INFO_DICT)
         self.dbapi = db_api.get_instance()
         self.info = ipminative._parse_driver_info(self.node)
+        ipminative._SESSION_CACHE.clear()
+        self.addCleanup(ipminative._SESSION_CACHE.clear)
 
     def test__parse_driver_info(self):
         # make sure we get back the expected things
@@ -127,6 +129,188 @@ class IPMINativePrivateMethodTestCase(base.TestCase):
         self.assertEqual(states.POWER_ON, state)
 
 
+class FakeBMCCommand(object):
+    """Simulated BMC session, counting logins and commands."""
+
+    logins = 0
+
+    def __init__(self, bmc, userid, password):
+        FakeBMCCommand.logins += 1
+        self.bmc = bmc
+        self.ipmi_session = mock.Mock()
+        self.fail = False
+        self.power_commands = []
+
+    def get_power(self):
+        if self.fail:
+            raise ipminative.pyghmi_exception.IpmiException('session expired')
+        return {'powerstate': 'on'}
+
+    def set_power(self, powerstate, wait):
+        if self.fail:
+            raise ipminative.pyghmi_exception.IpmiException('session expired')
+        self.power_commands.append(powerstate)
+        return {'powerstate': 'on'}
+
+    def raw_command(self, netfn, command):
+        # NOTE: pyghmi returns the errors of raw commands.
+        if self.fail:
+            return {'error': 'timeout'}
+        return {'netfn': netfn + 1, 'command': command, 'code': 0,
+                'data': [0x20, 0x01]}
+
+
+@mock.patch('pyghmi.ipmi.command.Command', new=FakeBMCCommand)
+class IPMINativeSessionCacheTestCase(base.TestCase):
+    """Test cases for the ipminative session cache."""
+
+    def setUp(self):
+        super(IPMINativeSessionCacheTestCase, self).setUp()
+        self.config(native_session_keepalive=0, group='ipmi')
+        self.info = {'address': '1.2.3.4', 'username': 'admin',
+                     'password': 'fake', 'uuid': 'fake-uuid'}
+        FakeBMCCommand.logins = 0
+        self.cache = ipminative._SESSION_CACHE
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+
+    def test_power_status_reuses_session(self):
+        for i in range(10):
+            self.assertEqual(states.POWER_ON,
+                             ipminative._power_status(self.info))
+        self.assertEqual(1, FakeBMCCommand.logins)
+        self.assertEqual(1, self.cache.logins)
+
+    def test_session_per_credentials(self):
+        ipminative._power_status(self.info)
+        other = dict(self.info, password='other')
+        ipminative._power_status(other)
+        ipminative._power_status(self.info)
+        ipminative._power_status(other)
+        self.assertEqual(2, FakeBMCCommand.logins)
+
+    def test_concurrent_users_get_own_session(self):
+        first, pooled = self.cache.acquire(self.info)
+        self.assertFalse(pooled)
+        second, pooled = self.cache.acquire(self.info)
+        self.assertFalse(pooled)
+        self.assertIsNot(first, second)
+        self.cache.release(self.info, first)
+        self.assertEqual((first, True), self.cache.acquire(self.info))
+
+    def test_relogin_on_expired_session(self):
+        ipmicmd, pooled = self.cache.acquire(self.info)
+        ipmicmd.fail = True
+        self.cache.release(self.info, ipmicmd)
+
+        self.assertEqual(states.POWER_ON,
+                         ipminative._power_status(self.info))
+        self.assertEqual(2, FakeBMCCommand.logins)
+        ipmicmd.ipmi_session.logout.assert_called_once_with()
+
+    def test_power_action_checks_pooled_session(self):
+        ipmicmd, pooled = self.cache.acquire(self.info)
+        ipmicmd.fail = True
+        self.cache.release(self.info, ipmicmd)
+
+        self.assertEqual(states.POWER_ON, ipminative._reboot(self.info))
+        self.assertEqual([], ipmicmd.power_commands)
+        ipmicmd.ipmi_session.logout.assert_called_once_with()
+        new_cmd, pooled = self.cache.acquire(self.info)
+        self.assertTrue(pooled)
+        self.assertEqual(['boot'], new_cmd.power_commands)
+
+    def test_power_action_not_retried(self):
+        ipminative._power_status(self.info)
+        with mock.patch.object(FakeBMCCommand, 'set_power') as set_power:
+            set_power.side_effect = (
+                ipminative.pyghmi_exception.IpmiException('timeout'))
+            self.assertRaises(exception.IPMIFailure,
+                              ipminative._reboot, self.info)
+            self.assertEqual(1, set_power.call_count)
+        self.assertEqual(1, FakeBMCCommand.logins)
+        self.assertFalse(self.cache.acquire(self.info)[1])
+
+    def test_unexpected_error_discards_session(self):
+        ipmicmd, pooled = self.cache.acquire(self.info)
+        self.cache.release(self.info, ipmicmd)
+
+        class IpmiException(Exception):
+            pass
+
+        # NOTE: IpmiException is Exception itself when pyghmi is mocked.
+        with mock.patch.object(ipminative.pyghmi_exception, 'IpmiException',
+                               IpmiException):
+            with mock.patch.object(FakeBMCCommand, 'get_power') as get_power:
+                get_power.side_effect = ValueError()
+                self.assertRaises(ValueError, ipminative._power_status,
+                                  self.info)
+        ipmicmd.ipmi_session.logout.assert_called_once_with()
+        self.assertFalse(self.cache.acquire(self.info)[1])
+
+    def test_new_session_failure_not_retried(self):
+        with mock.patch.object(FakeBMCCommand, 'get_power') as get_power:
+            get_power.side_effect = (
+                ipminative.pyghmi_exception.IpmiException('boom'))
+            self.assertRaises(exception.IPMIFailure,
+                              ipminative._power_status, self.info)
+        self.assertEqual(1, FakeBMCCommand.logins)
+
+    def test_pool_size_bounded(self):
+        self.config(native_session_pool_size=1, group='ipmi')
+        first, pooled = self.cache.acquire(self.info)
+        other = dict(self.info, address='5.6.7.8')
+        second, pooled = self.cache.acquire(other)
+        self.cache.release(self.info, first)
+        self.cache.release(other, second)
+
+        first.ipmi_session.logout.assert_called_once_with()
+        self.assertFalse(second.ipmi_session.logout.called)
+        self.assertEqual((second, True), self.cache.acquire(other))
+
+    def test_pool_disabled(self):
+        self.config(native_session_pool_size=0, group='ipmi')
+        ipminative._power_status(self.info)
+        ipminative._power_status(self.info)
+        self.assertEqual(2, FakeBMCCommand.logins)
+
+    @mock.patch('time.time')
+    def test_idle_session_expires(self, mock_time):
+        self.config(native_session_max_idle=100, group='ipmi')
+        mock_time.return_value = 1000
+        ipmicmd, pooled = self.cache.acquire(self.info)
+        self.cache.release(self.info, ipmicmd)
+
+        mock_time.return_value = 1101
+        new_cmd, pooled = self.cache.acquire(self.info)
+        self.assertFalse(pooled)
+        self.assertIsNot(ipmicmd, new_cmd)
+        ipmicmd.ipmi_session.logout.assert_called_once_with()
+
+    @mock.patch('time.time')
+    def test_keepalive(self, mock_time):
+        self.config(native_session_max_idle=100, group='ipmi')
+        mock_time.return_value = 1000
+        alive, pooled = self.cache.acquire(self.info)
+        dead, pooled = self.cache.acquire(dict(self.info, address='dead'))
+        idle, pooled = self.cache.acquire(dict(self.info, address='idle'))
+        dead.fail = True
+        self.cache.release(dict(self.info, address='idle'), idle)
+        mock_time.return_value = 1050
+        self.cache.release(self.info, alive)
+        self.cache.release(dict(self.info, address='dead'), dead)
+
+        mock_time.return_value = 1101
+        self.cache.keepalive()
+
+        self.assertEqual((alive, True), self.cache.acquire(self.info))
+        for address in ('dead', 'idle'):
+            self.assertFalse(self.cache.acquire(
+                dict(self.info, address=address))[1])
+        idle.ipmi_session.logout.assert_called_once_with()
+        dead.ipmi_session.logout.assert_called_once_with()
+
+
 class IPMINativeDriverTestCase(db_base.DbTestCase):
     """Test cases for ipminative.NativeIPMIPower class functions.
     """
@@ -142,6 +326,8 @@ class IPMINativeDriverTestCase(db_base.DbTestCase):
                                                driver_info=INFO_DICT)
         self.dbapi = db_api.get_instance()
         self.info = ipminative._parse_driver_info(self.node)
+        ipminative._SESSION_CACHE.clear()
+        self.addCleanup(ipminative._SESSION_CACHE.clear)
 
     def test_get_properties(self):
         expected = ipminative.COMMON_PROPERTIES
@@ -32,6 +32,7 @@ from ironic.common import driver_factory
 from ironic.common import exception
 from ironic.common import states
 from ironic.common import utils
+from ironic.conductor import power_timing
 from ironic.conductor import task_manager
 from ironic.db import api as db_api
 from ironic.drivers.modules import console_utils
@@ -469,6 +470,29 @@ class IPMIToolPrivateMethodTestCase(base.TestCase):
         self.assertEqual(mock_exec.call_args_list, expected)
         self.assertEqual(states.ERROR, state)
 
+    @mock.patch.object(power_timing.TransitionTimes, 'record', autospec=True)
+    @mock.patch.object(power_timing.TransitionTimes, 'first_poll_delay',
+                       autospec=True)
+    @mock.patch.object(ipmi, '_exec_ipmitool', autospec=True)
+    @mock.patch('eventlet.greenthread.sleep')
+    def test__power_on_adaptive_polling(self, sleep_mock, mock_exec,
+                                        mock_delay, mock_record, mock_sleep):
+        self.config(retry_timeout=60, group='ipmi')
+        mock_delay.return_value = 20
+        mock_exec.side_effect = iter([[None, None],
+                                      ["Chassis Power is off\n", None],
+                                      ["Chassis Power is on\n", None]])
+
+        state = ipmi._power_on(self.info)
+
+        self.assertEqual(states.POWER_ON, state)
+        mock_delay.assert_called_once_with(mock.ANY, self.info['model'],
+                                           states.POWER_ON, 1, maximum=60)
+        self.assertEqual([mock.call(20), mock.call(1)],
+                         sleep_mock.call_args_list)
+        mock_record.assert_called_once_with(mock.ANY, self.info['model'],
+                                            states.POWER_ON, mock.ANY)
+
 
 class IPMIToolDriverTestCase(db_base.DbTestCase):
 
@@ -27,6 +27,7 @@ from oslo.config import cfg
 from ironic.common import exception
 from ironic.common.glance_service import base_image_service
 from ironic.common import image_service
+from ironic.common import images
 from ironic.common import keystone
 from ironic.common import neutron
 from ironic.common import pxe_utils
@@ -492,6 +493,59 @@ class PXEPrivateFetchImagesTestCase(db_base.DbTestCase):
         self.assertEqual(3, mock_stat.call_count)
 
 
+@mock.patch.object(pxe, 'TFTPImageCache')
+@mock.patch.object(pxe, 'InstanceImageCache')
+@mock.patch.object(pxe, '_cleanup_caches_if_required')
+@mock.patch.object(images, 'image_show')
+class PXEPrivatePrefetchImagesTestCase(base.TestCase):
+
+    def test_prefetch_images(self, mock_show, mock_cleanup,
+                             mock_instance_cache, mock_tftp_cache):
+        images_meta = {
+            'instance': {'disk_format': 'qcow2',
+                         'properties': {'kernel_id': 'glance://kernel',
+                                        'ramdisk_id': 'ramdisk'}},
+            'whole-disk': {'disk_format': 'raw', 'properties': {}},
+            'deploy-kernel': {'disk_format': 'aki', 'properties': {}},
+        }
+        mock_show.side_effect = lambda ctx, href: images_meta[href]
+
+        pxe._prefetch_images('ctx', ['instance', 'whole-disk',
+                                     'deploy-kernel'])
+
+        tftp_cache = mock_tftp_cache.return_value
+        instance_cache = mock_instance_cache.return_value
+        self.assertEqual([mock.call('kernel', ctx='ctx'),
+                          mock.call('ramdisk', ctx='ctx'),
+                          mock.call('deploy-kernel', ctx='ctx')],
+                         tftp_cache.prefetch_image.call_args_list)
+        self.assertEqual([mock.call('instance', ctx='ctx'),
+                          mock.call('whole-disk', ctx='ctx')],
+                         instance_cache.prefetch_image.call_args_list)
+        mock_cleanup.assert_any_call('ctx', tftp_cache, [('kernel', None)])
+        mock_cleanup.assert_any_call('ctx', instance_cache,
+                                     [('instance', None)])
+
+    def test_prefetch_images_errors(self, mock_show, mock_cleanup,
+                                    mock_instance_cache, mock_tftp_cache):
+        mock_show.side_effect = iter([
+            exception.ImageNotFound(image_id='missing'),
+            {'disk_format': 'raw'},
+            {'disk_format': 'raw'}])
+        instance_cache = mock_instance_cache.return_value
+        instance_cache.prefetch_image.side_effect = iter([
+            exception.ImageDownloadFailed(image_href='image1',
+                                          reason='error'),
+            None])
+
+        pxe._prefetch_images('ctx', ['missing', 'image1', 'image2'])
+
+        self.assertEqual([mock.call('image1', ctx='ctx'),
+                          mock.call('image2', ctx='ctx')],
+                         instance_cache.prefetch_image.call_args_list)
+        self.assertFalse(mock_tftp_cache.return_value.prefetch_image.called)
+
+
 class PXEDriverTestCase(db_base.DbTestCase):
 
     def setUp(self):
@@ -686,6 +740,12 @@ class PXEDriverTestCase(db_base.DbTestCase):
                               address='123456', iqn='aaa-bbb',
                               key='fake-12345')
 
+    def test_vendor_passthru_is_bulk_io(self):
+        with task_manager.acquire(self.context, self.node.uuid,
+                                  shared=True) as task:
+            self.assertTrue(task.driver.vendor.is_bulk_io('pass_deploy_info'))
+            self.assertFalse(task.driver.vendor.is_bulk_io('other_method'))
+
     @mock.patch.object(pxe, '_get_tftp_image_info')
     @mock.patch.object(pxe, '_cache_tftp_images')
     @mock.patch.object(pxe, '_build_pxe_config_options')
@@ -739,6 +799,14 @@ class PXEDriverTestCase(db_base.DbTestCase):
             token = open(t_path, 'r').read()
             self.assertEqual(self.context.auth_token, token)
 
+            self.assertNotIn('deploy_trace', task.node.instance_info)
+            trace = task.node.driver_info['ironic_deploy_trace']['deploy']
+            self.assertEqual('success', trace['outcome'])
+            self.assertEqual(['instance_image', 'image_size_check',
+                              'token_file', 'neutron_update',
+                              'set_boot_device', 'reboot'],
+                             [step['name'] for step in trace['steps']])
+
     @mock.patch.object(deploy_utils, 'get_image_mb')
     @mock.patch.object(pxe, '_get_image_file_path')
     @mock.patch.object(pxe, '_cache_instance_image')
@@ -775,6 +843,11 @@ class PXEDriverTestCase(db_base.DbTestCase):
             update_neutron_mock.assert_called_once_with(
                 task, dhcp_opts)
 
+    @mock.patch.object(pxe, '_prefetch_images')
+    def test_cache_images(self, prefetch_mock):
+        pxe.PXEDeploy().cache_images(self.context, ['image'])
+        prefetch_mock.assert_called_once_with(self.context, ['image'])
+
     @mock.patch.object(pxe, 'InstanceImageCache')
     def test_continue_deploy_good(self, mock_image_cache):
         token_path = self._create_token_file()
@@ -800,6 +873,29 @@ class PXEDriverTestCase(db_base.DbTestCase):
         self.assertFalse(os.path.exists(token_path))
         mock_image_cache.assert_called_once_with()
         mock_image_cache.return_value.clean_up.assert_called_once_with()
+        self.assertEqual('success',
+                         self.node.driver_info['ironic_deploy_trace']
+                         ['continue_deploy']['outcome'])
+
+    @mock.patch.object(pxe, 'LOG')
+    @mock.patch.object(deploy_utils, 'deploy')
+    @mock.patch.object(pxe, 'InstanceImageCache')
+    def test_continue_deploy_handshake_latency(self, mock_image_cache,
+                                               deploy_mock, log_mock):
+        self._create_token_file()
+        self.node.power_state = states.POWER_ON
+        self.node.provision_state = states.DEPLOYWAIT
+        self.node.save()
+        deploy_mock.return_value = 2.5
+
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            task.driver.vendor.vendor_passthru(
+                    task, method='pass_deploy_info', address='123456',
+                    iqn='aaa-bbb', key='fake-56789')
+        self.node.refresh(self.context)
+        self.assertEqual(states.ACTIVE, self.node.provision_state)
+        log_mock.info.assert_any_call(mock.ANY, {'node': self.node.uuid,
+                                                 'latency': 2.5})
 
     @mock.patch.object(pxe, 'InstanceImageCache')
     def test_continue_deploy_disk_image_good(self, mock_image_cache):
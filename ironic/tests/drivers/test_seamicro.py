@@ -258,6 +258,137 @@ class SeaMicroPrivateMethodsTestCase(base.TestCase):
         get_pools_patcher.stop()
 
 
+class SeaMicroChassisCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SeaMicroChassisCacheTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.node = obj_utils.get_test_node(self.context,
+                                            driver='fake_seamicro',
+                                            driver_info=INFO_DICT)
+        self.info = seamicro._parse_driver_info(self.node)
+        self.config(server_list_ttl=30, group='seamicro')
+        self._clear()
+        self.addCleanup(self._clear)
+
+    def _clear(self):
+        seamicro._CLIENTS.clear()
+        seamicro._SERVER_LISTS.clear()
+        seamicro._GENERATIONS.clear()
+
+    def _server(self, id, active):
+        server = Fake_Server(active=active)
+        server.id = id
+        return server
+
+    @mock.patch.object(seamicro.seamicro_client, 'Client')
+    def test__get_client_cached(self, mock_client):
+        first = seamicro._get_client(**self.info)
+        second = seamicro._get_client(**self.info)
+        self.assertIs(first, second)
+        mock_client.assert_called_once_with(
+            self.info['api_version'], username=self.info['username'],
+            password=self.info['password'],
+            auth_url=self.info['api_endpoint'])
+
+    @mock.patch.object(seamicro.seamicro_client, 'Client')
+    def test__get_client_per_credentials(self, mock_client):
+        seamicro._get_client(**self.info)
+        seamicro._get_client(**dict(self.info, password='other'))
+        self.assertEqual(2, mock_client.call_count)
+
+    @mock.patch('time.time')
+    @mock.patch.object(seamicro, '_get_client')
+    def test__get_chassis_power_status(self, mock_client, mock_time):
+        mock_time.return_value = 100
+        servers = mock_client.return_value.servers
+        servers.list.return_value = [
+            self._server(self.info['server_id'], True),
+            self._server('other', False)]
+
+        for i in range(3):
+            self.assertEqual(states.POWER_ON,
+                             seamicro._get_chassis_power_status(self.node))
+        servers.list.assert_called_once_with()
+        self.assertFalse(servers.get.called)
+
+        # The list is refreshed once its TTL expired
+        mock_time.return_value = 131
+        servers.list.return_value = [
+            self._server(self.info['server_id'], False)]
+        self.assertEqual(states.POWER_OFF,
+                         seamicro._get_chassis_power_status(self.node))
+        self.assertEqual(2, servers.list.call_count)
+
+    @mock.patch.object(seamicro, '_get_power_status')
+    @mock.patch.object(seamicro, '_get_client')
+    def test__get_chassis_power_status_not_listed(self, mock_client,
+                                                  mock_status):
+        mock_client.return_value.servers.list.return_value = []
+        mock_status.return_value = states.POWER_OFF
+        self.assertEqual(states.POWER_OFF,
+                         seamicro._get_chassis_power_status(self.node))
+        mock_status.assert_called_once_with(self.node)
+
+    @mock.patch.object(seamicro, '_get_power_status')
+    @mock.patch.object(seamicro, '_get_client')
+    def test__get_chassis_power_status_disabled(self, mock_client,
+                                                mock_status):
+        self.config(server_list_ttl=0, group='seamicro')
+        mock_status.return_value = states.POWER_ON
+        self.assertEqual(states.POWER_ON,
+                         seamicro._get_chassis_power_status(self.node))
+        self.assertFalse(mock_client.called)
+
+    @mock.patch.object(seamicro, '_get_client')
+    def test__get_chassis_power_status_fail(self, mock_client):
+        seamicro._CLIENTS[seamicro._chassis_key(self.info)] = 'client'
+        mock_client.return_value.servers.list.side_effect = (
+            seamicro_client_exception.ClientException(500))
+        self.assertRaises(exception.ServiceUnavailable,
+                          seamicro._get_chassis_power_status, self.node)
+        self.assertEqual({}, seamicro._CLIENTS)
+
+    @mock.patch.object(seamicro, '_get_power_status')
+    @mock.patch.object(seamicro, '_get_client')
+    def test__forget_server(self, mock_client, mock_status):
+        servers = mock_client.return_value.servers
+        servers.list.return_value = [
+            self._server(self.info['server_id'], True),
+            self._server('other', False)]
+        seamicro._get_server_list(self.info)
+
+        seamicro._forget_server(self.info)
+        mock_status.return_value = states.POWER_OFF
+        self.assertEqual(states.POWER_OFF,
+                         seamicro._get_chassis_power_status(self.node))
+        mock_status.assert_called_once_with(self.node)
+        self.assertEqual(['other'],
+                         list(seamicro._get_server_list(self.info)))
+        servers.list.assert_called_once_with()
+
+    @mock.patch.object(seamicro, '_get_client')
+    def test__forget_server_while_listing(self, mock_client):
+        servers = mock_client.return_value.servers
+
+        def list_servers():
+            # A power action completes while the list is being fetched.
+            seamicro._forget_server(self.info)
+            return [self._server(self.info['server_id'], True)]
+
+        servers.list.side_effect = list_servers
+        self.assertIn(self.info['server_id'],
+                      seamicro._get_server_list(self.info))
+        self.assertEqual({}, seamicro._SERVER_LISTS)
+
+        servers.list.side_effect = None
+        servers.list.return_value = [
+            self._server(self.info['server_id'], False)]
+        self.assertEqual(states.POWER_OFF,
+                         seamicro._get_chassis_power_status(self.node))
+        self.assertEqual(2, servers.list.call_count)
+
+
 class SeaMicroPowerDriverTestCase(db_base.DbTestCase):
 
     def setUp(self):
@@ -333,6 +464,32 @@ class SeaMicroPowerDriverTestCase(db_base.DbTestCase):
 
             mock_power_on.assert_called_once_with(task.node)
 
+    @mock.patch.object(seamicro, '_forget_server')
+    @mock.patch.object(seamicro, '_power_on')
+    def test_set_power_state_forgets_server(self, mock_power_on,
+                                            mock_forget):
+        info = seamicro._parse_driver_info(self.node)
+
+        mock_power_on.side_effect = exception.ServiceUnavailable()
+
+        with task_manager.acquire(self.context, info['uuid'],
+                                  shared=False) as task:
+            self.assertRaises(exception.ServiceUnavailable,
+                              task.driver.power.set_power_state,
+                              task, states.POWER_ON)
+
+        mock_forget.assert_called_once_with(info)
+
+    @mock.patch.object(seamicro, '_get_chassis_power_status')
+    def test_get_power_state(self, mock_status):
+        mock_status.return_value = states.POWER_ON
+
+        with task_manager.acquire(self.context, self.node.uuid,
+                                  shared=True) as task:
+            self.assertEqual(states.POWER_ON,
+                             task.driver.power.get_power_state(task))
+            mock_status.assert_called_once_with(task.node)
+
     @mock.patch.object(seamicro, '_power_on')
     def test_set_power_state_on_fail(self, mock_power_on):
         info = seamicro._parse_driver_info(self.node)
@@ -77,6 +77,14 @@ class UtilsTestCase(base.TestCase):
                                             method='second_method',
                                             param1='fake1', param2='fake2')
 
+    @mock.patch.object(fake.FakeVendorB, 'is_bulk_io')
+    def test_vendor_interface_is_bulk_io(self, mock_fakeb_bulk_io):
+        mock_fakeb_bulk_io.return_value = True
+        self.assertFalse(self.driver.vendor.is_bulk_io('first_method'))
+        self.assertTrue(self.driver.vendor.is_bulk_io('second_method'))
+        self.assertFalse(self.driver.vendor.is_bulk_io('fake_method'))
+        mock_fakeb_bulk_io.assert_called_once_with('second_method')
+
     def test_driver_passthru_mixin_success(self):
         vendor_a = fake.FakeVendorA()
         vendor_a.driver_vendor_passthru = mock.Mock()
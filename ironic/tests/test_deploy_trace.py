@@ -0,0 +1,114 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the timing of the steps of deployments."""
+
+import threading
+
+import mock
+
+from ironic.common import deploy_trace
+from ironic.common import rpc
+from ironic.tests import base
+
+
+class FakeNode(object):
+
+    def __init__(self):
+        self.uuid = '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'
+        self.instance_info = {'image_source': 'image'}
+        self.driver_info = {'pxe_deploy_kernel': 'kernel'}
+
+
+class DeployTraceTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DeployTraceTestCase, self).setUp()
+        self.node = FakeNode()
+
+    def test_trace(self):
+        with deploy_trace.trace(self.node, 'deploy') as trace:
+            with deploy_trace.step('copy_image') as record:
+                record['bytes'] = 1024
+            self.assertIs(trace, deploy_trace.current())
+        self.assertIsNone(deploy_trace.current())
+
+        summary = self.node.driver_info['ironic_deploy_trace']['deploy']
+        self.assertEqual('success', summary['outcome'])
+        self.assertEqual(self.node.uuid, summary['node_uuid'])
+        self.assertEqual('deploy', summary['phase'])
+        self.assertIsNotNone(summary['duration'])
+        self.assertEqual(1, len(summary['steps']))
+        step = summary['steps'][0]
+        self.assertEqual('copy_image', step['name'])
+        self.assertEqual('success', step['outcome'])
+        self.assertEqual(1024, step['bytes'])
+        self.assertIn('duration', step)
+        self.assertEqual({'image_source': 'image'}, self.node.instance_info)
+        self.assertEqual('kernel', self.node.driver_info['pxe_deploy_kernel'])
+
+    def test_trace_failure(self):
+        def fail():
+            with deploy_trace.trace(self.node, 'deploy'):
+                with deploy_trace.step('iscsi_login'):
+                    raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        summary = self.node.driver_info['ironic_deploy_trace']['deploy']
+        self.assertEqual('failure', summary['outcome'])
+        self.assertEqual('failure', summary['steps'][0]['outcome'])
+        self.assertEqual('ValueError', summary['steps'][0]['error'])
+
+    def test_step_without_trace(self):
+        with deploy_trace.step('copy_image') as record:
+            record['bytes'] = 1024
+
+    def test_new_deploy(self):
+        with deploy_trace.trace(self.node, 'prepare', new_deploy=True):
+            pass
+        with deploy_trace.trace(self.node, 'deploy'):
+            pass
+        self.assertEqual(['deploy', 'prepare'],
+                         sorted(self.node.driver_info['ironic_deploy_trace']))
+        with deploy_trace.trace(self.node, 'prepare', new_deploy=True):
+            pass
+        self.assertEqual(['prepare'],
+                         list(self.node.driver_info['ironic_deploy_trace']))
+
+    def test_step_in_other_thread(self):
+        with deploy_trace.trace(self.node, 'deploy') as trace:
+            def mkswap():
+                with deploy_trace.step('mkswap', trace=trace):
+                    pass
+
+            thread = threading.Thread(target=mkswap)
+            thread.start()
+            thread.join()
+        steps = self.node.driver_info['ironic_deploy_trace']['deploy']['steps']
+        self.assertEqual(['mkswap'], [step['name'] for step in steps])
+
+    @mock.patch.object(rpc, 'get_notifier')
+    def test_notification(self, notifier_mock):
+        self.config(send_deploy_trace_notifications=True, group='conductor')
+        with deploy_trace.trace(self.node, 'deploy'):
+            pass
+        notifier_mock.return_value.info.assert_called_once_with(
+            {}, deploy_trace.EVENT_TYPE,
+            self.node.driver_info['ironic_deploy_trace']['deploy'])
+
+    @mock.patch.object(rpc, 'get_notifier')
+    def test_no_notification(self, notifier_mock):
+        with deploy_trace.trace(self.node, 'deploy'):
+            pass
+        self.assertFalse(notifier_mock.called)
@@ -16,12 +16,20 @@
 
 import datetime
 import filecmp
+import hashlib
 import os
 import tempfile
+import threading
+import time
+
+import mock
+import six.moves.BaseHTTPServer as BaseHTTPServer
 import testtools
 
+from ironic.common import context as ironic_context
 from ironic.common import exception
 from ironic.common.glance_service import base_image_service
+from ironic.common.glance_service import metadata_cache
 from ironic.common.glance_service import service_utils
 from ironic.common import image_service as service
 from ironic.openstack.common import context
@@ -91,6 +99,9 @@ class TestGlanceImageService(base.TestCase):
 
     def setUp(self):
         super(TestGlanceImageService, self).setUp()
+        cache = metadata_cache.get_cache()
+        cache.clear()
+        self.addCleanup(cache.clear)
         client = stubs.StubGlanceClient()
         self.context = context.RequestContext(auth_token=True)
         self.context.user_id = 'fake'
@@ -612,6 +623,425 @@ class TestGlanceImageService(base.TestCase):
         self.assertEqual(('https://123.123.123.123:9292', (), params),
                          wrapped_func(self.service, **params))
 
+    def test_show_cached(self):
+        fixture = self._make_fixture(name='image1', is_public=True)
+        image_id = self.service.create(fixture)['id']
+        with mock.patch.object(self.service.client.images, 'get',
+                               wraps=self.service.client.get) as get_mock:
+            self.assertEqual(self.service.show(image_id),
+                             self.service.show(image_id))
+            get_mock.assert_called_once_with(image_id)
+
+    def test_show_cache_disabled(self):
+        self.config(glance_metadata_cache_ttl=0, group='glance')
+        fixture = self._make_fixture(name='image1', is_public=True)
+        image_id = self.service.create(fixture)['id']
+        with mock.patch.object(self.service.client.images, 'get',
+                               wraps=self.service.client.get) as get_mock:
+            self.service.show(image_id)
+            self.service.show(image_id)
+            self.assertEqual(2, get_mock.call_count)
+
+    def test_show_not_found_cached(self):
+        with mock.patch.object(self.service.client.images, 'get',
+                               wraps=self.service.client.get) as get_mock:
+            self.assertRaises(exception.ImageNotFound, self.service.show,
+                              'missing')
+            self.assertRaises(exception.ImageNotFound, self.service.show,
+                              'missing')
+            get_mock.assert_called_once_with('missing')
+
+    def _service_for(self, **kwargs):
+        # NOTE: a context as the conductor gets it from an RPC request
+        ctx = ironic_context.RequestContext.from_dict(
+            ironic_context.RequestContext(**kwargs).to_dict())
+        return service.Service(self.service.client, 1, ctx)
+
+    def test_show_cached_per_token(self):
+        fixture = self._make_fixture(name='image1', is_public=True)
+        image_id = self.service.create(fixture)['id']
+        self._service_for(auth_token='token1', tenant='proj1').show(image_id)
+        other = self._service_for(auth_token='token2', tenant='proj1')
+        with mock.patch.object(self.service.client.images, 'get',
+                               wraps=self.service.client.get) as get_mock:
+            other.show(image_id)
+            other.show(image_id)
+            get_mock.assert_called_once_with(image_id)
+
+    def test_show_not_found_cached_per_token(self):
+        self.assertRaises(exception.ImageNotFound,
+                          self._service_for(auth_token='token1',
+                                            tenant='proj1').show,
+                          'missing')
+        with mock.patch.object(self.service.client.images, 'get',
+                               wraps=self.service.client.get) as get_mock:
+            self.assertRaises(exception.ImageNotFound,
+                              self._service_for(auth_token='token2',
+                                                tenant='proj2').show,
+                              'missing')
+            get_mock.assert_called_once_with('missing')
+
+    def test_update_invalidates_cache(self):
+        fixture = self._make_fixture(name='test image')
+        image_id = self.service.create(fixture)['id']
+        self.service.show(image_id)
+        fixture['name'] = 'new image name'
+        self.service.update(image_id, fixture)
+        self.assertEqual('new image name',
+                         self.service.show(image_id)['name'])
+
+    @mock.patch.object(base_image_service.client, 'Client')
+    def test_check_image_service_client_pool(self, client_mock):
+        base_image_service.clear_clients()
+        self.addCleanup(base_image_service.clear_clients)
+        self.config(auth_strategy='keystone', group='glance')
+        params = {'image_href': 'http://123.123.123.123:9292/image_uuid'}
+        wrapped_func = base_image_service.check_image_service(
+            lambda service, **kwargs: service.client)
+
+        clients = []
+        for auth_token in ('token1', 'token1', 'token2'):
+            self.context.auth_token = auth_token
+            clients.append(wrapped_func(service.Service(None, 1,
+                                                        self.context),
+                                        **params))
+        self.assertIs(clients[0], clients[1])
+        self.assertEqual(2, client_mock.call_count)
+
+    @mock.patch.object(base_image_service.client, 'Client')
+    def test_check_image_service_client_pool_size(self, client_mock):
+        base_image_service.clear_clients()
+        self.addCleanup(base_image_service.clear_clients)
+        self.config(glance_client_pool_size=1, group='glance')
+        self.config(auth_strategy='keystone', group='glance')
+        params = {'image_href': 'http://123.123.123.123:9292/image_uuid'}
+        wrapped_func = base_image_service.check_image_service(
+            lambda service, **kwargs: service.client)
+
+        for auth_token in ('token1', 'token2', 'token1'):
+            self.context.auth_token = auth_token
+            wrapped_func(service.Service(None, 1, self.context), **params)
+        self.assertEqual(3, client_mock.call_count)
+
+
+class TestImageMetadataCache(base.TestCase):
+
+    def setUp(self):
+        super(TestImageMetadataCache, self).setUp()
+        self.cache = metadata_cache.ImageMetadataCache()
+        self.config(glance_metadata_cache_ttl=10, group='glance')
+        self.config(glance_metadata_negative_cache_ttl=2, group='glance')
+
+    @mock.patch.object(time, 'time')
+    def test_get_expired(self, time_mock):
+        time_mock.return_value = 100
+        self.cache.set('image', 'record')
+        self.assertEqual('record', self.cache.get('image'))
+        time_mock.return_value = 110
+        self.assertIsNone(self.cache.get('image'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1},
+                         self.cache.stats())
+
+    @mock.patch.object(time, 'time')
+    def test_get_not_found_expired(self, time_mock):
+        time_mock.return_value = 100
+        self.cache.set('image', metadata_cache.NOT_FOUND)
+        self.assertIs(metadata_cache.NOT_FOUND, self.cache.get('image'))
+        time_mock.return_value = 102
+        self.assertIsNone(self.cache.get('image'))
+
+    def test_set_disabled(self):
+        self.config(glance_metadata_negative_cache_ttl=0, group='glance')
+        self.cache.set('image', metadata_cache.NOT_FOUND)
+        self.assertIsNone(self.cache.get('image'))
+
+    def test_scopes(self):
+        self.cache.set('image', 'record1', scope='project1')
+        self.cache.set('image', 'record2', scope='project2')
+        self.assertEqual('record1', self.cache.get('image', 'project1'))
+        self.assertIsNone(self.cache.get('image'))
+
+    def test_invalidate(self):
+        self.cache.set('image', 'record1', scope='project1')
+        self.cache.set('image', 'record2', scope='project2')
+        self.cache.invalidate('image')
+        self.assertIsNone(self.cache.get('image', 'project1'))
+        self.assertIsNone(self.cache.get('image', 'project2'))
+
+    @mock.patch.object(time, 'time')
+    def test_set_purges_expired(self, time_mock):
+        time_mock.return_value = 100
+        self.cache.set('image1', 'record')
+        time_mock.return_value = 110
+        self.cache.set('image2', 'record')
+        self.assertEqual(1, self.cache.stats()['size'])
+
+    def test_get_cache(self):
+        self.assertIs(metadata_cache.get_cache(), metadata_cache.get_cache())
+
+
+class FlakyHTTPServer(object):
+    """Local HTTP server which closes connections partway through.
+
+    Serves the same data at any path, supports range requests unless told
+    otherwise and closes the first 'drops' connections after sending half
+    of the requested data.
+    """
+
+    def __init__(self, data, drops=0, support_range=True):
+        self.data = data
+        self.drops = drops
+        self.support_range = support_range
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                start = 0
+                range_header = self.headers.get('range')
+                if range_header and server.support_range:
+                    start = int(range_header.split('=')[1].split('-')[0])
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                                     (start, len(server.data) - 1,
+                                      len(server.data)))
+                else:
+                    self.send_response(200)
+                body = server.data[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if server.drops > 0:
+                    server.drops -= 1
+                    body = body[:len(body) // 2]
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.01})
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class DownloadServerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DownloadServerTestCase, self).setUp()
+        cache = metadata_cache.get_cache()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.data = os.urandom(256 * 1024)
+        self.checksum = hashlib.md5(self.data).hexdigest()
+        self.context = context.RequestContext(auth_token='token')
+        self.output = tempfile.TemporaryFile()
+        self.addCleanup(self.output.close)
+        self.config(auth_strategy='keystone', group='glance')
+        self.config(glance_download_resumes=3, group='glance')
+        sleep_patcher = mock.patch.object(time, 'sleep')
+        sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def _start_server(self, **kwargs):
+        server = FlakyHTTPServer(self.data, **kwargs)
+        self.addCleanup(server.stop)
+        return server
+
+    def _read_output(self):
+        self.output.seek(0)
+        return self.output.read()
+
+    def _glance_client(self, server, interrupt_after=None):
+        test = self
+
+        class MyGlanceStubClient(stubs.StubGlanceClient):
+            """A client whose data stream breaks, served by server."""
+            endpoint = server.url
+
+            def get(self, image_id):
+                return type('Image', (object,),
+                            {'checksum': test.checksum,
+                             'size': len(test.data),
+                             'direct_url': server.url + '/direct'})
+
+            def data(self, image_id):
+                yield test.data[:interrupt_after]
+                if interrupt_after is not None:
+                    raise IOError('Connection reset by peer')
+
+        return MyGlanceStubClient()
+
+
+class TestResumableDownload(DownloadServerTestCase):
+
+    def test_resume_glance_api(self):
+        server = self._start_server(drops=1)
+        client = self._glance_client(server, interrupt_after=1000)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(2, len(server.requests))
+        path, headers = server.requests[0]
+        self.assertEqual('/v1/images/image', path)
+        self.assertEqual('bytes=1000-', headers['range'])
+        self.assertEqual('token', headers['x-auth-token'])
+        offset = 1000 + (len(self.data) - 1000) // 2
+        self.assertEqual('bytes=%d-' % offset,
+                         server.requests[1][1]['range'])
+
+    def test_no_interruption(self):
+        server = self._start_server()
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual([], server.requests)
+
+    def test_resume_direct_url(self):
+        self.config(allowed_direct_url_schemes=['http'], group='glance')
+        server = self._start_server(drops=2)
+        client = self._glance_client(server)
+        image_service = service.Service(client, 2, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(['/direct'] * 3,
+                         [path for path, headers in server.requests])
+        self.assertNotIn('range', server.requests[0][1])
+        self.assertNotIn('x-auth-token', server.requests[0][1])
+
+    def test_resume_range_not_supported(self):
+        server = self._start_server(drops=1, support_range=False)
+        client = self._glance_client(server, interrupt_after=1000)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(2, len(server.requests))
+
+    def test_too_many_interruptions(self):
+        self.config(glance_download_resumes=2, group='glance')
+        server = self._start_server(drops=5)
+        client = self._glance_client(server, interrupt_after=1000)
+        image_service = service.Service(client, 1, self.context)
+        self.assertRaises(exception.ImageDownloadFailed,
+                          image_service.download, 'image', self.output)
+        self.assertEqual(2, len(server.requests))
+
+    def test_checksum_mismatch(self):
+        server = self._start_server()
+        client = self._glance_client(server, interrupt_after=1000)
+        self.checksum = 'wrong'
+        image_service = service.Service(client, 1, self.context)
+        self.assertRaises(exception.ImageDownloadFailed,
+                          image_service.download, 'image', self.output)
+
+
+class TestParallelDownload(DownloadServerTestCase):
+
+    def setUp(self):
+        super(TestParallelDownload, self).setUp()
+        # 4 parts, the last one is smaller
+        self.data = os.urandom(3 * 1024 * 1024 + 1000)
+        self.checksum = hashlib.md5(self.data).hexdigest()
+        self.config(glance_download_concurrency=3,
+                    glance_download_part_size=1, group='glance')
+        self.path = os.path.join(tempfile.mkdtemp(), 'image')
+        self.output = open(self.path, 'wb')
+        self.addCleanup(self.output.close)
+
+    def _read_output(self):
+        self.output.close()
+        with open(self.path, 'rb') as image_file:
+            return image_file.read()
+
+    def _ranges(self, server):
+        return sorted(headers['range'] for path, headers in server.requests)
+
+    def test_parallel(self):
+        server = self._start_server()
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        with mock.patch.object(base_image_service.tpool, 'execute',
+                               wraps=base_image_service.tpool.execute
+                               ) as execute_mock:
+            image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(['bytes=0-1048575', 'bytes=1048576-2097151',
+                          'bytes=2097152-3145727', 'bytes=3145728-3146727'],
+                         self._ranges(server))
+        self.assertEqual('token', server.requests[0][1]['x-auth-token'])
+        execute_mock.assert_called_once_with(base_image_service._file_md5,
+                                             self.output.name)
+
+    def test_parallel_direct_url(self):
+        self.config(allowed_direct_url_schemes=['http'], group='glance')
+        server = self._start_server()
+        client = self._glance_client(server)
+        image_service = service.Service(client, 2, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(set(['/direct']),
+                         set(path for path, headers in server.requests))
+        self.assertEqual(4, len(server.requests))
+
+    def test_parallel_resume(self):
+        server = self._start_server(drops=3)
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(7, len(server.requests))
+
+    def test_parallel_range_not_supported(self):
+        server = self._start_server(support_range=False)
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual(1, len(server.requests))
+
+    def test_parallel_checksum_mismatch(self):
+        server = self._start_server()
+        client = self._glance_client(server)
+        self.checksum = 'wrong'
+        image_service = service.Service(client, 1, self.context)
+        self.assertRaises(exception.ImageDownloadFailed,
+                          image_service.download, 'image', self.output)
+
+    def test_small_image(self):
+        self.config(glance_download_part_size=4, group='glance')
+        server = self._start_server()
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual([], server.requests)
+
+    def test_disabled(self):
+        self.config(glance_download_concurrency=1, group='glance')
+        server = self._start_server()
+        client = self._glance_client(server)
+        image_service = service.Service(client, 1, self.context)
+        image_service.download('image', self.output)
+
+        self.assertEqual(self.data, self._read_output())
+        self.assertEqual([], server.requests)
+
 
 def _create_failing_glance_client(info):
     class MyGlanceStubClient(stubs.StubGlanceClient):
@@ -0,0 +1,221 @@
+# coding=utf-8
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the sharing of master images between conductors."""
+
+import hashlib
+import os
+import tempfile
+import time
+
+import mock
+import requests
+
+from ironic.common import image_peer
+from ironic.common import images
+from ironic.db import api as dbapi
+from ironic.drivers.modules import image_cache
+from ironic.tests.db import base as db_base
+
+
+class ImagePeerTestBase(db_base.DbTestCase):
+    """Runs several conductors' image endpoints on localhost."""
+
+    def setUp(self):
+        super(ImagePeerTestBase, self).setUp()
+        self.dbapi = dbapi.get_instance()
+        self.config(host='local-conductor')
+        self.config(image_peer_port=1, group='conductor')
+        self.config(image_peer_secret='secret', group='conductor')
+        self.config(image_peer_url='http://%(host)s', group='conductor')
+        self.dest_path = os.path.join(tempfile.mkdtemp(), 'master')
+
+    def _start_peer(self, images=None):
+        master_dir = tempfile.mkdtemp()
+        for name, data in (images or {}).items():
+            with open(os.path.join(master_dir, name), 'wb') as f:
+                f.write(data)
+        server = image_peer.ImagePeerServer(
+            host='127.0.0.1', port=0, caches={'cache': master_dir})
+        server.start()
+        self.addCleanup(server.stop)
+        self.dbapi.register_conductor({'hostname': '127.0.0.1:%d'
+                                                   % server.port,
+                                       'drivers': ['fake']})
+        return server
+
+
+class ImagePeerTestCase(ImagePeerTestBase):
+
+    def test_get_peer_urls(self):
+        self.dbapi.register_conductor({'hostname': 'local-conductor',
+                                       'drivers': ['fake']})
+        self.dbapi.register_conductor({'hostname': 'other-conductor',
+                                       'drivers': ['fake']})
+        self.config(image_peer_port=8088, group='conductor')
+        self.config(image_peer_url='http://%(host)s:%(port)s',
+                    group='conductor')
+        self.assertEqual(['http://other-conductor:8088'],
+                         image_peer.get_peer_urls())
+
+    def test_fetch(self):
+        self._start_peer()
+        self._start_peer({'digest': b'image data'})
+        self.assertTrue(image_peer.fetch('cache', 'digest', self.dest_path))
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(b'image data', f.read())
+
+    def test_fetch_not_found(self):
+        self._start_peer({'other': b'image data'})
+        self.assertFalse(image_peer.fetch('cache', 'digest', self.dest_path))
+        self.assertFalse(image_peer.fetch('other-cache', 'other',
+                                          self.dest_path))
+        self.assertFalse(os.path.exists(self.dest_path))
+
+    def test_enabled(self):
+        self.assertTrue(image_peer.enabled())
+        self.config(image_peer_secret=None, group='conductor')
+        self.assertFalse(image_peer.enabled())
+
+    def test_unsigned_request_refused(self):
+        server = self._start_peer({'digest': b'image data'})
+        url = 'http://127.0.0.1:%d/cache/digest' % server.port
+        self.assertEqual(403, requests.get(url).status_code)
+        self.config(image_peer_secret='other', group='conductor')
+        token = image_peer._make_token('cache/digest')
+        self.config(image_peer_secret='secret', group='conductor')
+        response = requests.get(url,
+                                headers={image_peer.TOKEN_HEADER: token})
+        self.assertEqual(403, response.status_code)
+
+    def test_old_request_refused(self):
+        server = self._start_peer({'digest': b'image data'})
+        url = 'http://127.0.0.1:%d/cache/digest' % server.port
+        with mock.patch.object(image_peer.time, 'time',
+                               return_value=time.time() - 61):
+            token = image_peer._make_token('cache/digest')
+        response = requests.get(url,
+                                headers={image_peer.TOKEN_HEADER: token})
+        self.assertEqual(403, response.status_code)
+
+    def test_check_token(self):
+        token = image_peer._make_token('cache/digest')
+        self.assertTrue(image_peer._check_token(token, 'cache/digest'))
+        self.assertFalse(image_peer._check_token(token, 'cache/other'))
+        timestamp, signature = token.split(':')
+        self.assertFalse(image_peer._check_token(
+            '%d:%s' % (int(timestamp) + 1, signature), 'cache/digest'))
+        for bad in (None, '', signature, 'x:' + signature):
+            self.assertFalse(image_peer._check_token(bad, 'cache/digest'))
+
+    @mock.patch.object(requests, 'get')
+    def test_fetch_unsigned_checksum(self, get_mock):
+        self._start_peer()
+        response = get_mock.return_value
+        response.status_code = 200
+        response.headers = {
+            image_peer.CHECKSUM_HEADER: hashlib.md5(b'data').hexdigest(),
+            image_peer.SIGNATURE_HEADER: 'forged'}
+        response.iter_content.return_value = [b'data']
+        self.assertFalse(image_peer.fetch('cache', 'digest', self.dest_path))
+        self.assertFalse(os.path.exists(self.dest_path))
+
+    def test_fetch_hidden_files(self):
+        self._start_peer({'.index': b'index'})
+        self.assertFalse(image_peer.fetch('cache', '.index', self.dest_path))
+
+    @mock.patch.object(image_peer, '_file_checksum')
+    def test_fetch_bad_checksum(self, checksum_mock):
+        checksum_mock.return_value = hashlib.md5(b'other data').hexdigest()
+        self._start_peer({'digest': b'image data'})
+        self.assertFalse(image_peer.fetch('cache', 'digest', self.dest_path))
+        self.assertFalse(os.path.exists(self.dest_path))
+
+    @mock.patch.object(requests, 'get')
+    def test_fetch_connection_error(self, get_mock):
+        get_mock.side_effect = requests.ConnectionError()
+        self._start_peer({'digest': b'image data'})
+        self.assertFalse(image_peer.fetch('cache', 'digest', self.dest_path))
+
+    def test_file_checksum(self):
+        with open(self.dest_path, 'wb') as f:
+            f.write(b'image data')
+        stat = os.stat(self.dest_path)
+        self.addCleanup(image_peer._CHECKSUMS.pop, self.dest_path, None)
+        with mock.patch.object(image_peer.tpool, 'execute',
+                               wraps=image_peer.tpool.execute) as execute:
+            for i in range(2):
+                self.assertEqual(hashlib.md5(b'image data').hexdigest(),
+                                 image_peer._file_checksum(self.dest_path,
+                                                           stat))
+        execute.assert_called_once_with(image_peer._hash_file,
+                                        self.dest_path)
+
+    def test_head(self):
+        server = self._start_peer({'digest': b'image data'})
+        token = image_peer._make_token('cache/digest')
+        response = requests.head('http://127.0.0.1:%d/cache/digest'
+                                 % server.port,
+                                 headers={image_peer.TOKEN_HEADER: token})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('10', response.headers['Content-Length'])
+        checksum = hashlib.md5(b'image data').hexdigest()
+        self.assertEqual(checksum,
+                         response.headers[image_peer.CHECKSUM_HEADER])
+        self.assertEqual(image_peer._sign('cache/digest', checksum),
+                         response.headers[image_peer.SIGNATURE_HEADER])
+
+
+@mock.patch.object(images, 'fetch_to_raw')
+class ImageCachePeerTestCase(ImagePeerTestBase):
+
+    def setUp(self):
+        super(ImageCachePeerTestCase, self).setUp()
+        self.master_dir = tempfile.mkdtemp()
+        self.cache = image_cache.ImageCache(self.master_dir, None, None,
+                                            peer_name='cache')
+        self.addCleanup(image_peer._CACHES.pop, 'cache', None)
+        image_cache._INDEXES.clear()
+        self.addCleanup(image_cache._INDEXES.clear)
+
+    def test_download_from_peer(self, fetch_mock):
+        self._start_peer({'digest': b'image data'})
+        master_path = os.path.join(self.master_dir, 'digest')
+        self.cache._download_image('uuid', master_path, self.dest_path)
+        self.assertFalse(fetch_mock.called)
+        with open(master_path, 'rb') as f:
+            self.assertEqual(b'image data', f.read())
+        self.assertEqual(os.stat(master_path).st_ino,
+                         os.stat(self.dest_path).st_ino)
+
+    def test_download_not_on_peers(self, fetch_mock):
+        fetch_mock.side_effect = lambda ctx, uuid, path, service: (
+            open(path, 'wb').close())
+        self._start_peer()
+        master_path = os.path.join(self.master_dir, 'digest')
+        self.cache._download_image('uuid', master_path, self.dest_path)
+        fetch_mock.assert_called_once_with(None, 'uuid', mock.ANY, None)
+
+    @mock.patch.object(image_peer, 'fetch')
+    def test_download_peers_disabled(self, peer_fetch_mock, fetch_mock):
+        self.config(image_peer_port=0, group='conductor')
+        fetch_mock.side_effect = lambda ctx, uuid, path, service: (
+            open(path, 'wb').close())
+        master_path = os.path.join(self.master_dir, 'digest')
+        self.cache._download_image('uuid', master_path, self.dest_path)
+        self.assertFalse(peer_fetch_mock.called)
+        self.assertTrue(fetch_mock.called)
+
+    def test_register_cache(self, fetch_mock):
+        self.assertEqual(self.master_dir, image_peer._CACHES['cache'])
@@ -18,6 +18,11 @@
 
 import contextlib
 import fixtures
+import mock
+import os
+import struct
+import tempfile
+import zlib
 
 from ironic.common import exception
 from ironic.common import images
@@ -110,3 +115,243 @@ class IronicImagesTestCase(base.TestCase):
         self.assertEqual(expected_commands, self.executes)
 
         del self.executes
+
+
+@mock.patch('time.sleep')
+@mock.patch('time.time')
+class ImageDownloadThrottleTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ImageDownloadThrottleTestCase, self).setUp()
+        self.throttle = images.Throttle()
+
+    def test_unlimited(self, mock_time, mock_sleep):
+        self.throttle.consume(100 * 1024 * 1024)
+        self.assertFalse(mock_time.called)
+        self.assertFalse(mock_sleep.called)
+
+    def test_consume(self, mock_time, mock_sleep):
+        self.config(image_download_bandwidth=2)
+        mock_time.return_value = 100.0
+        # The first MiB goes out at once, the second one is delayed
+        self.throttle.consume(1024 * 1024)
+        self.assertFalse(mock_sleep.called)
+        self.throttle.consume(1024 * 1024)
+        mock_sleep.assert_called_once_with(0.5)
+
+    def test_consume_idle(self, mock_time, mock_sleep):
+        self.config(image_download_bandwidth=2)
+        mock_time.side_effect = iter([100.0, 101.0])
+        self.throttle.consume(1024 * 1024)
+        self.throttle.consume(1024 * 1024)
+        self.assertFalse(mock_sleep.called)
+
+    def test_consume_bandwidth(self, mock_time, mock_sleep):
+        throttle = images.Throttle(lambda: 4)
+        mock_time.return_value = 100.0
+        throttle.consume(1024 * 1024)
+        throttle.consume(1024 * 1024)
+        mock_sleep.assert_called_once_with(0.25)
+
+    @mock.patch.object(images, '_THROTTLE')
+    def test_throttled_file(self, mock_throttle, mock_time, mock_sleep):
+        image_file = mock.Mock()
+        throttled = images._ThrottledFile(image_file)
+        throttled.write('data')
+        mock_throttle.consume.assert_called_once_with(4)
+        image_file.write.assert_called_once_with('data')
+        self.assertEqual(image_file.fileno, throttled.fileno)
+
+
+class SniffImageInfoTestCase(base.TestCase):
+
+    def _write(self, data, size=None):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if size is not None:
+                f.truncate(size)
+        return path
+
+    def _qcow2(self, backing_file=b''):
+        header = struct.pack('>4sIQIIQ', b'QFI\xfb', 2,
+                             512 if backing_file else 0, len(backing_file),
+                             16, 10 * 1024 ** 3)
+        return (header.ljust(512, b'\x00') + backing_file).ljust(
+            4096, b'\x00')
+
+    def _vmdk(self, descriptor=b''):
+        header = struct.pack('<4sIIQQQQ', b'KDMV', 1, 3, 2 * 1024 ** 2, 128,
+                             1 if descriptor else 0, 20 if descriptor else 0)
+        return (header.ljust(512, b'\x00') + descriptor).ljust(
+            4096, b'\x00')
+
+    def _vhd(self, disk_type, parent=u''):
+        footer = struct.pack('>8sIIQ16xQQ4sI', b'conectix', 2, 0x10000, 512,
+                             1024 ** 3, 1024 ** 3, b'\x00' * 4, disk_type)
+        dynamic = b'cxsparse'.ljust(64, b'\x00') + parent.encode('utf-16-be')
+        return (footer.ljust(512, b'\x00') + dynamic).ljust(2048, b'\x00')
+
+    def test_raw(self):
+        info = images.sniff_image_info(self._write(b'\xeb\x63\x90',
+                                                   size=1024 ** 2))
+        self.assertEqual('raw', info.file_format)
+        self.assertEqual(1024 ** 2, info.virtual_size)
+        self.assertIsNone(info.backing_file)
+
+    def test_empty(self):
+        self.assertEqual('raw',
+                         images.sniff_image_info(self._write(b'')).file_format)
+
+    def test_qcow2(self):
+        info = images.sniff_image_info(self._write(self._qcow2()))
+        self.assertEqual('qcow2', info.file_format)
+        self.assertEqual(10 * 1024 ** 3, info.virtual_size)
+        self.assertIsNone(info.backing_file)
+
+    def test_qcow2_backing_file(self):
+        info = images.sniff_image_info(self._write(self._qcow2(b'base.img')))
+        self.assertEqual('qcow2', info.file_format)
+        self.assertEqual(b'base.img', info.backing_file)
+
+    def test_qcow_version_1(self):
+        header = struct.pack('>4sI', b'QFI\xfb', 1).ljust(512, b'\x00')
+        self.assertIsNone(images.sniff_image_info(self._write(header)))
+
+    def test_vmdk(self):
+        descriptor = b'# Disk DescriptorFile\nparentCID=ffffffff\n'
+        info = images.sniff_image_info(self._write(self._vmdk(descriptor)))
+        self.assertEqual('vmdk', info.file_format)
+        self.assertEqual(1024 ** 3, info.virtual_size)
+        self.assertIsNone(info.backing_file)
+
+    def test_vmdk_parent(self):
+        descriptor = b'parentFileNameHint="base.vmdk"\n'
+        info = images.sniff_image_info(self._write(self._vmdk(descriptor)))
+        self.assertEqual(b'base.vmdk', info.backing_file)
+
+    def test_vhd(self):
+        info = images.sniff_image_info(self._write(self._vhd(3)))
+        self.assertEqual('vpc', info.file_format)
+        self.assertEqual(1024 ** 3, info.virtual_size)
+        self.assertIsNone(info.backing_file)
+
+    def test_vhd_differencing(self):
+        info = images.sniff_image_info(self._write(self._vhd(4, u'base.vhd')))
+        self.assertEqual(u'base.vhd', info.backing_file)
+
+    def test_other_formats(self):
+        vdi = b'<<< Oracle VM VirtualBox Disk Image >>>\n'.ljust(
+            64, b'\x00') + b'\x7f\x10\xda\xbe'
+        for header in (b'QED\x00', vdi, b'# Disk DescriptorFile\n'):
+            self.assertIsNone(images.sniff_image_info(self._write(header)))
+
+    def test_other_format_magics(self):
+        for offset, magic in images._OTHER_FORMAT_MAGICS:
+            header = (b'\x00' * offset + magic).ljust(512, b'\x00')
+            self.assertIsNone(images.sniff_image_info(self._write(header)),
+                              magic)
+
+    def test_vhdx(self):
+        header = b'vhdxfile' + u'Microsoft Windows'.encode('utf-16-le')
+        self.assertIsNone(images.sniff_image_info(
+            self._write(header, size=1024 ** 2)))
+
+    def test_truncated_qcow2(self):
+        self.assertIsNone(images.sniff_image_info(
+            self._write(b'QFI\xfb\x00\x00\x00\x02')))
+
+    def test_dmg(self):
+        trailer = b'koly' + struct.pack('>II', 4, 512)
+        data = b'\x00' * 4096 + trailer.ljust(512, b'\x00')
+        self.assertIsNone(images.sniff_image_info(self._write(data)))
+
+    def test_dmg_trailer_elsewhere_is_raw(self):
+        data = b'koly'.ljust(4096, b'\x00')
+        info = images.sniff_image_info(self._write(data))
+        self.assertEqual('raw', info.file_format)
+
+    def test_missing_file(self):
+        self.assertIsNone(images.sniff_image_info('/nonexistent/image'))
+
+    @mock.patch.object(images, 'qemu_img_info')
+    def test_image_info_sniffed(self, mock_qemu_img_info):
+        info = images.image_info(self._write(self._qcow2()))
+        self.assertEqual('qcow2', info.file_format)
+        self.assertFalse(mock_qemu_img_info.called)
+
+    @mock.patch.object(images, 'qemu_img_info')
+    def test_image_info_unknown_format(self, mock_qemu_img_info):
+        path = self._write(b'QED\x00')
+        self.assertEqual(mock_qemu_img_info.return_value,
+                         images.image_info(path))
+        mock_qemu_img_info.assert_called_once_with(path)
+
+    @mock.patch.object(images, 'qemu_img_info')
+    def test_image_info_sniffing_disabled(self, mock_qemu_img_info):
+        self.config(sniff_image_format=False)
+        path = self._write(self._qcow2())
+        self.assertEqual(mock_qemu_img_info.return_value,
+                         images.image_info(path))
+
+    @mock.patch.object(images, 'qemu_img_info')
+    @mock.patch('ironic.common.utils.execute')
+    def test_image_to_raw_no_subprocess(self, mock_execute,
+                                        mock_qemu_img_info):
+        path_tmp = self._write(b'\x00' * 1024)
+        path = path_tmp + '.raw'
+        images.image_to_raw('image', path, path_tmp)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(mock_execute.called)
+        self.assertFalse(mock_qemu_img_info.called)
+
+    def test_image_to_raw_backing_file(self):
+        path_tmp = self._write(self._qcow2(b'base.img'))
+        self.assertRaises(exception.ImageUnacceptable, images.image_to_raw,
+                          'image', path_tmp + '.raw', path_tmp)
+        self.assertFalse(os.path.exists(path_tmp))
+
+
+class ReadImageHeadTestCase(base.TestCase):
+
+    def _write(self, data):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _qcow2(self, crypt_method=0):
+        # 512 byte clusters: header, L1 table, L2 table, then data
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+        compressed = compressor.compress(b'b' * 512) + compressor.flush()
+        header = struct.pack('>4sIQIIQIIQ', b'QFI\xfb', 3, 0, 0, 9, 4096,
+                             crypt_method, 1, 512)
+        l1_table = struct.pack('>Q', 1024)
+        l2_table = struct.pack('>QQQQ', 1536,
+                               images._QCOW2_COMPRESSED | 2048,
+                               0, images._QCOW2_ZERO)
+        return b''.join(part.ljust(512, b'\x00') for part in
+                        (header, l1_table, l2_table, b'a' * 512, compressed))
+
+    def test_raw(self):
+        path = self._write(b'\xeb\x63\x90' + b'\x00' * 1024)
+        self.assertEqual(b'\xeb\x63\x90\x00', images.read_image_head(path, 4))
+
+    def test_qcow2(self):
+        head = images.read_image_head(self._write(self._qcow2()), 8192)
+        self.assertEqual(b'a' * 512 + b'b' * 512 + b'\x00' * 3072, head)
+
+    def test_qcow2_partial_cluster(self):
+        head = images.read_image_head(self._write(self._qcow2()), 600)
+        self.assertEqual(b'a' * 512 + b'b' * 88, head)
+
+    def test_qcow2_encrypted(self):
+        path = self._write(self._qcow2(crypt_method=1))
+        self.assertIsNone(images.read_image_head(path, 512))
+
+    def test_other_format(self):
+        path = self._write(b'QED\x00'.ljust(512, b'\x00'))
+        self.assertIsNone(images.read_image_head(path, 512))
+
+    def test_missing_file(self):
+        self.assertIsNone(images.read_image_head('/nonexistent/image', 512))
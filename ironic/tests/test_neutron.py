@@ -14,6 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 import mock
 from neutronclient.common import exceptions as neutron_client_exc
 from neutronclient.v2_0 import client
@@ -35,6 +38,56 @@ from ironic.tests.objects import utils as object_utils
 CONF = cfg.CONF
 
 
+class FakeNeutronClient(object):
+    """Neutron client keeping ports in memory.
+
+    Ports are reported active once they were shown `polls_to_active`
+    times since their last update.
+    """
+
+    polls_to_active = 0
+
+    def __init__(self, **params):
+        self.params = params
+        self.ports = {}
+        self.active = 0
+        self.max_active = 0
+        self.fail_ports = set()
+        self.list_calls = 0
+
+    def update_port(self, port_id, body):
+        if port_id in self.fail_ports:
+            raise neutron_client_exc.NeutronClientException(status_code=500)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        # let the updates of the other ports start
+        time.sleep(0.01)
+        self.active -= 1
+        port = self.ports.setdefault(port_id, {'id': port_id})
+        port.update(body['port'])
+        port['polls'] = 0
+        return {'port': port}
+
+    def show_port(self, port_id):
+        try:
+            port = self.ports[port_id]
+        except KeyError:
+            raise neutron_client_exc.NeutronClientException(status_code=404)
+        return {'port': self._poll(port)}
+
+    def list_ports(self, id=None):
+        self.list_calls += 1
+        return {'ports': [self._poll(self.ports[port_id])
+                          for port_id in id or self.ports
+                          if port_id in self.ports]}
+
+    def _poll(self, port):
+        port['polls'] += 1
+        status = ('ACTIVE' if port['polls'] > self.polls_to_active
+                  else 'DOWN')
+        return dict(port, status=status)
+
+
 class TestNeutron(base.TestCase):
 
     def setUp(self):
@@ -54,6 +107,8 @@ class TestNeutron(base.TestCase):
         self.dbapi = dbapi.get_instance()
         self.context = context.get_admin_context()
         self.node = object_utils.create_test_node(self.context)
+        neutron.clear_clients()
+        self.addCleanup(neutron.clear_clients)
 
     def _create_test_port(self, **kwargs):
         p = db_utils.get_test_port(**kwargs)
@@ -230,7 +285,8 @@ class TestNeutron(base.TestCase):
                                   self.node.uuid) as task:
             neutron.update_neutron(task, self.node)
         mock_updo.assertCalleOnceWith('vif-uuid', opts)
-        mock_wait_neutron.assert_called_once_with(task)
+        mock_wait_neutron.assert_called_once_with(
+            task, mock.ANY, {'port-uuid': 'vif-uuid'}, self.node)
 
     @mock.patch('ironic.common.neutron._wait_for_neutron_update')
     @mock.patch('ironic.common.neutron.NeutronAPI.__init__')
@@ -257,7 +313,8 @@ class TestNeutron(base.TestCase):
                                   self.node.uuid) as task:
             neutron.update_neutron(task, self.node)
         self.assertEqual(2, mock_updo.call_count)
-        mock_wait_neutron.assert_called_once_with(task)
+        mock_wait_neutron.assert_called_once_with(
+            task, mock.ANY, {'p1': 'v1', 'p2': 'v2'}, self.node)
 
     @mock.patch('ironic.common.neutron._wait_for_neutron_update')
     @mock.patch('ironic.common.neutron.NeutronAPI.update_port_dhcp_opts')
@@ -276,21 +333,284 @@ class TestNeutron(base.TestCase):
         self.assertEqual(2, mock_updo.call_count)
         self.assertFalse(mock_wait_neutron.called)
 
-    def test__wait_for_neutron_update(self):
-        kw = {
-            'id': 190238451205398,
-            'uuid': utils.generate_uuid(),
-            'driver': 'fake_ssh'
-        }
-        node = object_utils.create_test_node(self.context, **kw)
-        mgr_utils.mock_the_extension_manager(driver="fake_ssh")
-        with task_manager.acquire(self.context, node.uuid) as task:
-            with mock.patch('time.sleep') as mock_sleep:
-                neutron._wait_for_neutron_update(task)
-                mock_sleep.assert_called_once_with(15)
+    @mock.patch.object(client.Client, '__init__')
+    def test_client_pool(self, mock_client_init):
+        mock_client_init.return_value = None
+        context_a = context.RequestContext(auth_token='token-a')
+        context_b = context.RequestContext(auth_token='token-b')
+        client_a = neutron.NeutronAPI(context_a).client
+        self.assertIs(client_a, neutron.NeutronAPI(context_a).client)
+        self.assertIsNot(client_a, neutron.NeutronAPI(context_b).client)
+        self.assertEqual(2, mock_client_init.call_count)
 
-    def test__wait_for_neutron_update_no_sleep(self):
+    @mock.patch.object(client.Client, '__init__')
+    def test_client_pool_full(self, mock_client_init):
+        self.config(client_pool_size=1, group='neutron')
+        mock_client_init.return_value = None
+        context_a = context.RequestContext(auth_token='token-a')
+        context_b = context.RequestContext(auth_token='token-b')
+        client_a = neutron.NeutronAPI(context_a).client
+        neutron.NeutronAPI(context_b)
+        self.assertIsNot(client_a, neutron.NeutronAPI(context_a).client)
+        self.assertEqual(3, mock_client_init.call_count)
+
+    @mock.patch.object(client.Client, '__init__')
+    def test_client_pool_disabled(self, mock_client_init):
+        self.config(client_pool_size=0, group='neutron')
+        mock_client_init.return_value = None
+        neutron.NeutronAPI(self.context)
+        neutron.NeutronAPI(self.context)
+        self.assertEqual(2, mock_client_init.call_count)
+
+    @mock.patch.object(client, 'Client', FakeNeutronClient)
+    @mock.patch('ironic.common.neutron.get_node_vif_ids')
+    def test_update_neutron_concurrent(self, mock_gnvi):
+        opts = pxe_utils.dhcp_options_for_instance()
+        mock_gnvi.return_value = {'p1': 'v1', 'p2': 'v2', 'p3': 'v3'}
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            neutron.update_neutron(task, opts)
+        fake_client = neutron.NeutronAPI(self.context).client
+        self.assertEqual(['v1', 'v2', 'v3'], sorted(fake_client.ports))
+        for port in fake_client.ports.values():
+            self.assertEqual(opts, port['extra_dhcp_opts'])
+        self.assertEqual(3, fake_client.max_active)
+
+    @mock.patch.object(client, 'Client', FakeNeutronClient)
+    @mock.patch.object(neutron, 'MAX_CONCURRENT_UPDATES', 2)
+    @mock.patch('ironic.common.neutron.get_node_vif_ids')
+    def test_update_neutron_concurrency_bounded(self, mock_gnvi):
+        mock_gnvi.return_value = dict(('p%d' % i, 'v%d' % i)
+                                      for i in range(5))
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            neutron.update_neutron(task, None)
+        fake_client = neutron.NeutronAPI(self.context).client
+        self.assertEqual(5, len(fake_client.ports))
+        self.assertEqual(2, fake_client.max_active)
+
+    @mock.patch('ironic.common.neutron.NeutronAPI.update_port_dhcp_opts')
+    @mock.patch('ironic.common.neutron.get_node_vif_ids')
+    def test_update_neutron_unexpected_error(self, mock_gnvi, mock_updo):
+        mock_gnvi.return_value = {'p1': 'v1', 'p2': 'v2'}
+        mock_updo.side_effect = [None, ValueError()]
         with task_manager.acquire(self.context, self.node.uuid) as task:
-            with mock.patch('time.sleep') as mock_sleep:
-                neutron._wait_for_neutron_update(task)
-                self.assertFalse(mock_sleep.called)
+            self.assertRaises(ValueError, neutron.update_neutron,
+                              task, None)
+
+
+@mock.patch.object(client, 'Client', FakeNeutronClient)
+@mock.patch('time.sleep')
+@mock.patch('time.time')
+class TestWaitForNeutronUpdate(base.TestCase):
+
+    def setUp(self):
+        super(TestWaitForNeutronUpdate, self).setUp()
+        mgr_utils.mock_the_extension_manager(driver='fake_ssh')
+        self.config(auth_strategy='noauth', group='neutron')
+        self.context = context.get_admin_context()
+        self.node = object_utils.create_test_node(self.context,
+                                                  driver='fake_ssh')
+        neutron.clear_clients()
+        self.addCleanup(neutron.clear_clients)
+        self.opts = pxe_utils.dhcp_options_for_instance()
+        self.vifs = {'p1': 'v1', 'p2': 'v2'}
+        self.clock = [100.0]
+        self.sleeps = []
+        # number of port checks made before each sleep
+        self.polls = []
+
+    def _wait(self, mock_time, mock_sleep, polls_to_active, applied=None):
+        api = neutron.NeutronAPI(self.context)
+        api.client.polls_to_active = polls_to_active
+        for vif in self.vifs.values():
+            api.client.ports[vif] = {'id': vif, 'polls': 0,
+                                     'extra_dhcp_opts': applied or self.opts}
+
+        def _sleep(seconds):
+            self.sleeps.append(seconds)
+            self.polls.append(sum(port['polls']
+                                  for port in api.client.ports.values()))
+            self.clock[0] += seconds
+
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            mock_time.side_effect = lambda: self.clock[0]
+            mock_sleep.side_effect = _sleep
+            neutron._wait_for_neutron_update(task, api, self.vifs,
+                                             self.opts)
+            mock_sleep.side_effect = None
+
+    def test_reported_before_agent_ready(self, mock_time, mock_sleep):
+        # NOTE: the ports are active and report their new options right
+        # away, the DHCP agents are still waited for.
+        self._wait(mock_time, mock_sleep, 0)
+        self.assertEqual([15], self.sleeps)
+        self.assertEqual([0], self.polls)
+        self.assertEqual(115.0, self.clock[0])
+
+    def test_no_min_wait(self, mock_time, mock_sleep):
+        self.config(dhcp_update_min_wait=0, group='neutron')
+        self._wait(mock_time, mock_sleep, 0)
+        self.assertEqual([], self.sleeps)
+
+    def test_backoff(self, mock_time, mock_sleep):
+        self._wait(mock_time, mock_sleep, 3)
+        self.assertEqual([15, 0.5, 1.0, 2.0], self.sleeps)
+
+    def test_deadline(self, mock_time, mock_sleep):
+        self.config(dhcp_update_timeout=10, group='neutron')
+        self._wait(mock_time, mock_sleep, 100)
+        self.assertEqual([15, 0.5, 1.0, 2.0, 4.0, 2.5], self.sleeps)
+
+    def test_options_not_applied(self, mock_time, mock_sleep):
+        self.config(dhcp_update_timeout=1, group='neutron')
+        other_opts = [{'opt_name': 'bootfile-name', 'opt_value': 'other'}]
+        self._wait(mock_time, mock_sleep, 0, applied=other_opts)
+        self.assertEqual([15, 0.5, 0.5], self.sleeps)
+
+    def test_not_ssh(self, mock_time, mock_sleep):
+        mgr_utils.mock_the_extension_manager(driver='fake')
+        node = object_utils.create_test_node(
+            self.context, id=2, uuid=utils.generate_uuid(), driver='fake')
+        api = mock.Mock()
+        with task_manager.acquire(self.context, node.uuid) as task:
+            neutron._wait_for_neutron_update(task, api, self.vifs,
+                                             self.opts)
+        self.assertFalse(api.is_port_ready.called)
+
+
+class TestDHCPBatch(base.TestCase):
+
+    def setUp(self):
+        super(TestDHCPBatch, self).setUp()
+        mgr_utils.mock_the_extension_manager(driver='fake_ssh')
+        self.config(auth_strategy='noauth', group='neutron')
+        self.config(dhcp_batch_window=0.05, dhcp_update_poll_interval=0.01,
+                    dhcp_update_min_wait=0, group='neutron')
+        self.context = context.get_admin_context()
+        neutron.clear_clients()
+        self.addCleanup(neutron.clear_clients)
+        self.opts = pxe_utils.dhcp_options_for_instance()
+        self.vifs = {}
+        self.nodes = []
+        for i in range(3):
+            node = object_utils.create_test_node(
+                self.context, id=i + 1, uuid=utils.generate_uuid(),
+                driver='fake_ssh')
+            self.nodes.append(node)
+            self.vifs[node.uuid] = {'p%da' % i: 'v%da' % i,
+                                    'p%db' % i: 'v%db' % i}
+        for patcher in (mock.patch.object(client, 'Client',
+                                          FakeNeutronClient),
+                        mock.patch.object(
+                            neutron, 'get_node_vif_ids',
+                            side_effect=lambda task: self.vifs[
+                                task.node.uuid])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = neutron.NeutronAPI(self.context).client
+
+    def _another_batch_running(self):
+        key = neutron.NeutronAPI(self.context).client_key
+        neutron._RUNNING_BATCHES[key] += 1
+        self.addCleanup(neutron._RUNNING_BATCHES.pop, key)
+
+    def _update_all(self, contexts=None):
+        errors = {}
+        contexts = contexts or [self.context] * len(self.nodes)
+        self.finished = {}
+        start = time.time()
+
+        def _update(node, ctx):
+            try:
+                with task_manager.acquire(ctx, node.uuid) as task:
+                    neutron.update_neutron(task, self.opts)
+            except Exception as e:
+                errors[node.uuid] = e
+            self.finished[node.uuid] = time.time() - start
+
+        threads = [threading.Thread(target=_update, args=(node, ctx))
+                   for node, ctx in zip(self.nodes, contexts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_batch(self):
+        self._another_batch_running()
+        self.client.polls_to_active = 2
+        self.assertEqual({}, self._update_all())
+        self.assertEqual(6, len(self.client.ports))
+        for port in self.client.ports.values():
+            self.assertEqual(self.opts, port['extra_dhcp_opts'])
+            self.assertEqual(3, port['polls'])
+        # every port of the batch was checked with a single request
+        self.assertEqual(3, self.client.list_calls)
+        self.assertEqual(6, self.client.max_active)
+        self.assertEqual({}, neutron._BATCHES)
+
+    def test_batch_user_tokens(self):
+        # NOTE: the deploys of different users are batched together, with
+        # the admin credentials.
+        self.config(auth_strategy='keystone', group='neutron')
+        self._another_batch_running()
+        api = neutron.NeutronAPI(self.context)
+        contexts = [context.RequestContext(auth_token='token%d' % i,
+                                           is_admin=True)
+                    for i in range(len(self.nodes))]
+        self.assertEqual({}, self._update_all(contexts))
+        self.assertEqual(6, len(api.client.ports))
+        self.assertEqual(1, api.client.list_calls)
+
+    @mock.patch.object(neutron.time, 'sleep')
+    def test_lone_deploy_not_delayed(self, mock_sleep):
+        with task_manager.acquire(self.context, self.nodes[0].uuid) as task:
+            neutron.update_neutron(task, self.opts)
+        self.assertEqual(2, len(self.client.ports))
+        self.assertNotIn(mock.call(CONF.neutron.dhcp_batch_window),
+                         mock_sleep.call_args_list)
+        self.assertEqual({}, neutron._RUNNING_BATCHES)
+
+    def test_batch_failures(self):
+        self.client.fail_ports = set(['v0a', 'v0b', 'v1a'])
+        errors = self._update_all()
+        self.assertEqual([self.nodes[0].uuid], list(errors))
+        self.assertIsInstance(errors[self.nodes[0].uuid],
+                              exception.FailedToUpdateDHCPOptOnPort)
+        self.assertEqual(['v1b', 'v2a', 'v2b'], sorted(self.client.ports))
+
+    @mock.patch.object(neutron, '_wait_until_ready')
+    def test_batch_no_wait(self, mock_wait):
+        mgr_utils.mock_the_extension_manager(driver='fake')
+        for node in self.nodes:
+            node.driver = 'fake'
+            node.save(self.context)
+        self.assertEqual({}, self._update_all())
+        self.assertEqual(6, len(self.client.ports))
+        self.assertFalse(mock_wait.called)
+
+    def test_batch_release_per_node(self):
+        # NOTE: the nodes which are not waited for, the one opening the
+        # batch included, are not held until the ports of the other nodes
+        # of their batch are ready.
+        self._another_batch_running()
+        self.config(dhcp_update_timeout=1, group='neutron')
+        self.client.polls_to_active = 1000
+        no_wait = set([self.nodes[0].uuid, self.nodes[2].uuid])
+        with mock.patch.object(neutron, '_needs_wait',
+                               side_effect=lambda task:
+                               task.node.uuid not in no_wait):
+            self.assertEqual({}, self._update_all())
+        for uuid in no_wait:
+            self.assertTrue(self.finished[uuid] < 0.5)
+        self.assertTrue(self.finished[self.nodes[1].uuid] >= 1)
+        for port_vif in ('v0a', 'v0b', 'v2a', 'v2b'):
+            self.assertEqual(0, self.client.ports[port_vif]['polls'])
+        self.assertEqual({}, neutron._BATCHES)
+
+    @mock.patch.object(neutron.NeutronAPI, 'update_port_dhcp_opts')
+    def test_batch_error(self, mock_updo):
+        mock_updo.side_effect = ValueError()
+        errors = self._update_all()
+        self.assertEqual(3, len(errors))
+        for error in errors.values():
+            self.assertIsInstance(error, ValueError)
@@ -15,7 +15,9 @@
 #    under the License.
 
 import os
+import tempfile
 
+import jinja2
 import mock
 from oslo.config import cfg
 
@@ -66,31 +68,74 @@ class TestPXEUtils(db_base.DbTestCase):
 
         self.assertEqual(rendered_template, expected_template)
 
-    @mock.patch('ironic.common.utils.create_link_without_raise')
-    @mock.patch('ironic.common.utils.unlink_without_raise')
     @mock.patch('ironic.drivers.utils.get_node_mac_addresses')
-    def test__write_mac_pxe_configs(self, get_macs_mock, unlink_mock,
-                                    create_link_mock):
-        macs = [
-            '00:11:22:33:44:55:66',
-            '00:11:22:33:44:55:67'
-        ]
-        get_macs_mock.return_value = macs
-        create_link_calls = [
-            mock.call(u'/tftpboot/1be26c0b-03f2-4d2e-ae87-c02d7f33c123/config',
-                      '/tftpboot/pxelinux.cfg/01-00-11-22-33-44-55-66'),
-            mock.call(u'/tftpboot/1be26c0b-03f2-4d2e-ae87-c02d7f33c123/config',
-                      '/tftpboot/pxelinux.cfg/01-00-11-22-33-44-55-67')
-        ]
-        unlink_calls = [
-            mock.call('/tftpboot/pxelinux.cfg/01-00-11-22-33-44-55-66'),
-            mock.call('/tftpboot/pxelinux.cfg/01-00-11-22-33-44-55-67')
-        ]
+    def test__write_mac_pxe_configs(self, get_macs_mock):
+        tftp_root = tempfile.mkdtemp()
+        self.config(tftp_root=tftp_root, group='pxe')
+        os.mkdir(os.path.join(tftp_root, 'pxelinux.cfg'))
+        get_macs_mock.return_value = ['00:11:22:33:44:55:66',
+                                      '00:11:22:33:44:55:67',
+                                      '00:11:22:33:44:55:68']
+        config_path = pxe_utils.get_pxe_config_file_path(self.node.uuid)
+        link_paths = [os.path.join(tftp_root, 'pxelinux.cfg',
+                                   '01-00-11-22-33-44-55-%d' % i)
+                      for i in (66, 67, 68)]
+        os.symlink(config_path, link_paths[0])
+        os.symlink('/other/config', link_paths[1])
+        link_inode = os.lstat(link_paths[0]).st_ino
+
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            pxe_utils._link_mac_pxe_configs(task)
+
+        for link_path in link_paths:
+            self.assertEqual(config_path, os.readlink(link_path))
+        # the link which was up to date was left untouched
+        self.assertEqual(link_inode, os.lstat(link_paths[0]).st_ino)
+        self.assertEqual(sorted(os.path.basename(p) for p in link_paths),
+                         sorted(os.listdir(os.path.join(tftp_root,
+                                                        'pxelinux.cfg'))))
+
+    @mock.patch.object(os, 'rename')
+    @mock.patch('ironic.drivers.utils.get_node_mac_addresses')
+    def test__write_mac_pxe_configs_failure(self, get_macs_mock,
+                                            rename_mock):
+        tftp_root = tempfile.mkdtemp()
+        self.config(tftp_root=tftp_root, group='pxe')
+        os.mkdir(os.path.join(tftp_root, 'pxelinux.cfg'))
+        get_macs_mock.return_value = ['00:11:22:33:44:55:66']
+        rename_mock.side_effect = OSError()
+
         with task_manager.acquire(self.context, self.node.uuid) as task:
             pxe_utils._link_mac_pxe_configs(task)
 
-        unlink_mock.assert_has_calls(unlink_calls)
-        create_link_mock.assert_has_calls(create_link_calls)
+        self.assertEqual([], os.listdir(os.path.join(tftp_root,
+                                                     'pxelinux.cfg')))
+
+    def test__get_template(self):
+        template = os.path.join(tempfile.mkdtemp(), 'template')
+        with open(template, 'w') as f:
+            f.write('first {{ pxe_options.value }}')
+        pxe_utils._TEMPLATES.clear()
+        self.addCleanup(pxe_utils._TEMPLATES.clear)
+
+        with mock.patch.object(jinja2, 'Environment',
+                               wraps=jinja2.Environment) as env_mock:
+            self.assertEqual('first 1',
+                             pxe_utils._build_pxe_config({'value': 1},
+                                                         template))
+            self.assertEqual('first 2',
+                             pxe_utils._build_pxe_config({'value': 2},
+                                                         template))
+            self.assertEqual(1, env_mock.call_count)
+
+            with open(template, 'w') as f:
+                f.write('second {{ pxe_options.value }}')
+            mtime = os.stat(template).st_mtime
+            os.utime(template, (mtime + 10, mtime + 10))
+            self.assertEqual('second 3',
+                             pxe_utils._build_pxe_config({'value': 3},
+                                                         template))
+            self.assertEqual(2, env_mock.call_count)
 
     @mock.patch('ironic.common.utils.write_to_file')
     @mock.patch.object(pxe_utils, '_build_pxe_config')
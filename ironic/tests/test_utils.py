@@ -328,6 +328,27 @@ class GenericUtilsTestCase(base.TestCase):
             self.assertRaises(exception.InvalidMAC,
                               utils.validate_and_normalize_mac, 'invalid-mac')
 
+    def test_write_to_file(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'file')
+        with open(path, 'w') as f:
+            f.write('old contents')
+        inode = os.stat(path).st_ino
+        utils.write_to_file(path, 'new contents')
+        with open(path) as f:
+            self.assertEqual('new contents', f.read())
+        # the file was replaced, not rewritten in place
+        self.assertNotEqual(inode, os.stat(path).st_ino)
+        self.assertEqual(['file'], os.listdir(directory))
+
+    @mock.patch.object(os, 'rename')
+    def test_write_to_file_failure(self, rename_mock):
+        rename_mock.side_effect = OSError()
+        directory = tempfile.mkdtemp()
+        self.assertRaises(OSError, utils.write_to_file,
+                          os.path.join(directory, 'file'), 'contents')
+        self.assertEqual([], os.listdir(directory))
+
     def test_safe_rstrip(self):
         value = '/test/'
         rstripped_value = '/test'
@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Replay a trace of image deployments against the master image cache
+eviction policies and report their hit rates.
+
+A trace has one image fetch per line: the image UUID and the image size in
+bytes, separated by whitespace. Lines starting with '#' are ignored. If no
+trace is given, a synthetic one is generated, with image popularity
+following a Zipf distribution.
+
+Usage: python tools/image_cache_replay.py --cache-size 20480 [trace]
+"""
+
+import argparse
+import heapq
+import random
+import sys
+
+from oslo import i18n
+
+i18n.install('ironic')
+
+from ironic.drivers.modules import image_cache
+
+
+def load_trace(trace_file):
+    trace = []
+    for line in trace_file:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        image, size = line.split()[:2]
+        trace.append((image, int(size)))
+    return trace
+
+
+def synthetic_trace(length, images, seed=None):
+    """Generate a trace of Zipf distributed fetches of images of 10 MiB to
+    10 GiB.
+    """
+    rand = random.Random(seed)
+    sizes = [int(10 * 1024 ** 2 * 1000 ** rand.random())
+             for i in range(images)]
+    weights = [1.0 / (rank + 1) for rank in range(images)]
+    total = sum(weights)
+    trace = []
+    for i in range(length):
+        point = rand.random() * total
+        for image, weight in enumerate(weights):
+            point -= weight
+            if point <= 0:
+                break
+        trace.append(('image-%d' % image, sizes[image]))
+    return trace
+
+
+def replay(trace, cache_size, policy_name):
+    """Replay a trace against an eviction policy.
+
+    The image being fetched is never evicted, like master images in use
+    are not evicted by the cache.
+
+    :returns: tuple (hit rate, byte hit rate).
+    """
+    policy = image_cache.EVICTION_POLICIES[policy_name]()
+    # image -> [size, last used, hits, priority], as in the cache index
+    entries = {}
+    heap = []
+    total_size = hits = hit_bytes = fetched_bytes = 0
+    for clock, (image, size) in enumerate(trace):
+        fetched_bytes += size
+        entry = entries.get(image)
+        if entry is None:
+            entry = entries[image] = [size, clock, 0, None]
+            total_size += size
+        else:
+            hits += 1
+            hit_bytes += size
+            entry[1] = clock
+            entry[2] += 1
+        entry[3] = policy.priority(*entry[:3])
+        heapq.heappush(heap, (entry[3], image))
+
+        current = None
+        while total_size > cache_size and heap:
+            priority, victim = heapq.heappop(heap)
+            entry = entries.get(victim)
+            if entry is None or entry[3] != priority:
+                continue
+            if victim == image:
+                current = (priority, victim)
+                continue
+            del entries[victim]
+            total_size -= entry[0]
+            policy.evicted(priority)
+        if current is not None:
+            heapq.heappush(heap, current)
+
+    if not trace:
+        return 0.0, 0.0
+    return (float(hits) / len(trace),
+            float(hit_bytes) / fetched_bytes if fetched_bytes else 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('trace', nargs='?', type=argparse.FileType('r'),
+                        help='trace file, "-" for standard input')
+    parser.add_argument('--cache-size', type=int, default=20480,
+                        help='cache size in MiB (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=10000,
+                        help='length of the synthetic trace')
+    parser.add_argument('--images', type=int, default=200,
+                        help='number of images in the synthetic trace')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic trace')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.length, args.images, args.seed)
+
+    print('%-6s %10s %15s' % ('policy', 'hit rate', 'byte hit rate'))
+    for policy_name in sorted(image_cache.EVICTION_POLICIES):
+        hit_rate, byte_hit_rate = replay(trace, args.cache_size * 1024 ** 2,
+                                         policy_name)
+        print('%-6s %9.1f%% %14.1f%%' % (policy_name, hit_rate * 100,
+                                         byte_hit_rate * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
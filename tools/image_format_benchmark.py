@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Measure the per-image overhead of detecting image formats.
+
+Times images.sniff_image_info(), which reads the image header in process,
+against images.qemu_img_info(), which runs "qemu-img info", on the given
+images. If no image is given, a sparse raw image and a qcow2 header are
+generated. "qemu-img info" is skipped if qemu-img is not installed.
+
+Usage: python tools/image_format_benchmark.py [--runs 100] [image ...]
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from oslo import i18n
+
+i18n.install('ironic')
+
+from ironic.common import images
+from ironic.common import utils
+
+
+def generate_images(directory):
+    raw_path = os.path.join(directory, 'disk.raw')
+    with open(raw_path, 'wb') as f:
+        f.truncate(10 * 1024 ** 3)
+    qcow2_path = os.path.join(directory, 'disk.qcow2')
+    with open(qcow2_path, 'wb') as f:
+        f.write(struct.pack('>4sIQIIQ', b'QFI\xfb', 2, 0, 0, 16,
+                            10 * 1024 ** 3).ljust(64 * 1024, b'\x00'))
+    return [raw_path, qcow2_path]
+
+
+def measure(func, path, runs):
+    start = time.time()
+    for i in range(runs):
+        info = func(path)
+    return (time.time() - start) / runs, info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('images', nargs='*', help='image files')
+    parser.add_argument('--runs', type=int, default=100,
+                        help='number of runs per image and method')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    paths = args.images
+    if not paths:
+        tmp_dir = tempfile.mkdtemp()
+        paths = generate_images(tmp_dir)
+
+    methods = [('sniff', images.sniff_image_info)]
+    try:
+        utils.execute('qemu-img', '--version')
+    except Exception:
+        print('qemu-img is not available, only timing header sniffing')
+    else:
+        methods.append(('qemu-img', images.qemu_img_info))
+
+    try:
+        print('%-30s %-9s %-7s %12s' % ('image', 'method', 'format',
+                                        'per image'))
+        for path in paths:
+            for name, func in methods:
+                elapsed, info = measure(func, path, args.runs)
+                print('%-30s %-9s %-7s %9.1f us' % (
+                    os.path.basename(path)[-30:], name,
+                    info.file_format if info else '?', elapsed * 1e6))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
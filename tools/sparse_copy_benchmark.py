@@ -0,0 +1,102 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Compare copying an image to a disk with dd and with the sparse copy.
+
+Generates a raw image of the given size, of which only a fraction holds
+data, and copies it to a file-backed target with "dd bs=1M oflag=direct"
+and with deploy_utils.sparse_copy(). Reports the bytes written and the
+wall time of each. The image is written as a sparse file, and optionally
+as a fully allocated one, as downloaded raw images are.
+
+Usage: python tools/sparse_copy_benchmark.py [--size-mb 1024] [--data 0.1]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from oslo import i18n
+
+i18n.install('ironic')
+
+from ironic.common import utils
+from ironic.drivers.modules import deploy_utils
+
+MiB = 1024 * 1024
+
+
+def generate_image(path, size_mb, data_ratio, allocated):
+    with open(path, 'wb') as f:
+        if allocated:
+            zeros = b'\0' * MiB
+            for i in range(size_mb):
+                f.write(zeros)
+        else:
+            f.truncate(size_mb * MiB)
+        data = os.urandom(MiB)
+        for mb in random.sample(range(size_mb), int(size_mb * data_ratio)):
+            f.seek(mb * MiB)
+            f.write(data)
+
+
+def run_dd(src, dst):
+    utils.execute('dd', 'if=%s' % src, 'of=%s' % dst, 'bs=1M',
+                  'oflag=direct', 'conv=notrunc')
+    return os.path.getsize(src)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-mb', type=int, default=1024,
+                        help='size of the image in MiB')
+    parser.add_argument('--data', type=float, default=0.1,
+                        help='fraction of the image holding data')
+    parser.add_argument('--allocated', action='store_true',
+                        help='also copy a fully allocated image')
+    parser.add_argument('--dir', help='directory to create the image and '
+                                      'target in, on the file system to test')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        image = os.path.join(tmp_dir, 'image')
+        target = os.path.join(tmp_dir, 'target')
+        layouts = [False, True] if args.allocated else [False]
+        print('%-10s %-7s %12s %10s %10s' % ('image', 'method',
+                                              'written MiB', 'time s',
+                                              'MiB/s'))
+        for allocated in layouts:
+            generate_image(image, args.size_mb, args.data, allocated)
+            for name, copy in (('dd', run_dd),
+                               ('sparse', deploy_utils.sparse_copy)):
+                with open(target, 'wb') as f:
+                    f.truncate(args.size_mb * MiB)
+                start = time.time()
+                written = copy(image, target)
+                elapsed = time.time() - start
+                print('%-10s %-7s %12.1f %10.2f %10.1f' % (
+                    'allocated' if allocated else 'sparse', name,
+                    float(written) / MiB, elapsed,
+                    args.size_mb / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())